@@ -6,7 +6,8 @@ from django.forms import Textarea
 from io import BytesIO
 
 from api.constants import S3_BUCKET_NAME, S3_BUCKET_IMAGES
-from holidaily.helpers.notification_helpers import award_and_notify_user_for_holiday
+from api.tasks import email_holiday_approval, send_pushes
+from holidaily.helpers.notification_helpers import award_user_for_holiday
 from django.conf import settings
 from .models import (
     UserProfile,
@@ -17,7 +18,7 @@ from .models import (
     UserCommentVotes,
     Post,
 )
-from django.db import models
+from django.db import models, transaction
 import logging
 from django.contrib import messages
 
@@ -76,6 +77,16 @@ class HolidayAdmin(admin.ModelAdmin):
         models.TextField: {"widget": Textarea(attrs={"rows": 3, "cols": 60})},
     }
 
+    def get_queryset(self, request):
+        queryset = super(HolidayAdmin, self).get_queryset(request)
+        return queryset.with_num_comments()
+
+    def num_comments(self, obj):
+        return obj.num_comments
+
+    num_comments.short_description = "Num comments"
+    num_comments.admin_order_field = "post_count"
+
     def get_form(self, request, obj=None, **kwargs):
         form = super(HolidayAdmin, self).get_form(request, obj, **kwargs)
         form.base_fields["image"].widget.attrs["style"] = "height: 1.25em;"
@@ -95,18 +106,24 @@ class HolidayAdmin(admin.ModelAdmin):
             and not obj.creator_awarded
         ):
 
-            push_sent = award_and_notify_user_for_holiday(obj)
-            if push_sent:
+            intent = award_user_for_holiday(obj)
+            if intent:
+                # Pushed in the background, emailed if the push doesn't reach them
+                transaction.on_commit(
+                    lambda: send_pushes.delay(
+                        [intent._asdict()], email_holiday_approval.s(obj.id)
+                    )
+                )
                 messages.add_message(
                     request,
                     messages.SUCCESS,
-                    f"{obj.creator.username} was notified of holiday approval!",
+                    f"{obj.creator.username} was awarded and will be notified of holiday approval!",
                 )
             else:
                 messages.add_message(
                     request,
                     messages.WARNING,
-                    f"Holiday approved, but {obj.creator.username} could not be reached for notification",
+                    f"Holiday approved, but {obj.creator.username} has no profile to award",
                 )
 
         if "image" in form.changed_data and "uploaded_image" not in form.changed_data:
@@ -172,8 +189,17 @@ class UserProfileAdmin(admin.ModelAdmin):
         "device_active",
         "ad_last_watched",
         "requested_confetti_alert",
+        "num_comments",
+        "holiday_submissions",
+        "approved_holidays",
+    )
+    readonly_fields = (
+        "avatar_full",
+        "referrer",
+        "num_comments",
+        "holiday_submissions",
+        "approved_holidays",
     )
-    readonly_fields = ("avatar_full", "referrer")
     raw_id_fields = ("user",)
 
 
@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = "api"
+
+    def ready(self):
+        # Keeps the holiday search and autocomplete indexes, cached feeds and
+        # the confetti leaderboard in sync with saves
+        import holidaily.helpers.cache_helpers  # noqa: F401
+        import holidaily.helpers.search_helpers  # noqa: F401
+        import holidaily.helpers.autocomplete_helpers  # noqa: F401
+        import holidaily.helpers.leaderboard_helpers  # noqa: F401
@@ -41,6 +41,15 @@ HOLIDAY_NOTIFICATION = 2
 POST_NOTIFICATION = 3
 LIKE_NOTIFICATION = 4
 LIKE_COMMENT_NOTIFICATION = 5
+# Types clients can mark read, by the name they send
+MARK_READ_TYPES = {
+    "comment": COMMENT_NOTIFICATION,
+    "post": POST_NOTIFICATION,
+    "like": LIKE_NOTIFICATION,
+    "like_comment": LIKE_COMMENT_NOTIFICATION,
+}
+MARK_READ_LIMIT = 200
+PUSH_RETRIES = 3
 
 CLOUDFRONT_DOMAIN = "https://d2cwe0vw7pxea6.cloudfront.net"
 S3_BUCKET_IMAGES = "https://holiday-images.s3.amazonaws.com"
@@ -71,3 +80,28 @@ HOLIDAILY_TRENDS = [
 ]
 
 CONFETTI_COOLDOWN_MINUTES = 1440
+
+# How long a user's celebrated holidays are cached, cleared when they vote
+CELEBRATING_CACHE_SECONDS = 60 * 60 * 24
+
+# Words left out of holiday search, nearly every holiday has them
+SEARCH_STOPWORDS = {"national", "international", "day", "the", "of", "and"}
+HOLIDAY_SEARCH_RESULTS = 50
+
+AUTOCOMPLETE_RESULTS = 8
+# Index entries looked at per suggestion request, bounds one letter prefixes
+AUTOCOMPLETE_SCAN_LIMIT = 200
+
+# Cached holiday feed pages, also how stale their vote counts can get
+FEED_CACHE_SECONDS = 60
+# Cached holiday details and post lists, the targets of daily push deep links
+HOLIDAY_CACHE_SECONDS = 60
+# Cache stampede protection, see single_flight()
+SINGLE_FLIGHT_LOCK_SECONDS = 30
+SINGLE_FLIGHT_STALE_SECONDS = 600
+SINGLE_FLIGHT_WAIT_SECONDS = 5
+SINGLE_FLIGHT_POLL_SECONDS = 0.05
+
+# Confetti leaderboard, and the users shown either side of the requesting user
+LEADERBOARD_SIZE = 50
+LEADERBOARD_NEIGHBORS = 2
@@ -0,0 +1,66 @@
+"""Simulate the burst of app opens after a daily push, against the local database"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory
+
+from api.models import Holiday
+from api.views import HolidayDetail, PostList
+from holidaily.helpers.cache_helpers import warm_holiday_caches
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("holiday_id", type=int)
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--threads", type=int, default=50)
+        parser.add_argument(
+            "--warm",
+            default=False,
+            action="store_true",
+            help="Warm the caches first, like daily_push does",
+        )
+
+    def handle(self, *args, **options):
+        holiday_id = options["holiday_id"]
+        holiday = Holiday.objects.get(pk=holiday_id)
+        factory = APIRequestFactory()
+        detail_view = HolidayDetail.as_view()
+        posts_view = PostList.as_view()
+
+        # Starts every run from a cold cache
+        cache.clear()
+        if options["warm"]:
+            warm_holiday_caches(holiday_id)
+
+        def open_app(_):
+            queries = []
+
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            start = time.perf_counter()
+            with connection.execute_wrapper(count_query):
+                detail_view(factory.get(f"/holidays/{holiday_id}/"), pk=holiday_id)
+                posts_view(factory.get("/posts/", {"holiday_id": holiday_id}))
+            connection.close()
+            return time.perf_counter() - start, len(queries)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+            results = list(pool.map(open_app, range(options["requests"])))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for latency, _ in results)
+        queries = sum(count for _, count in results)
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(
+            f"{holiday.name}: {len(results)} app opens in {elapsed:.2f}s, "
+            f"{queries} queries, p50 {p50:.1f}ms, p99 {p99:.1f}ms"
+        )
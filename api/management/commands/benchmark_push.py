@@ -0,0 +1,51 @@
+"""Measure push delivery throughput against the local database, without sending anything"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.models import UserProfile
+from holidaily.helpers.push_helpers import FakePushBackend, PushIntent, deliver_pushes
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.05,
+            help="Seconds each batch takes to reach APNs/FCM",
+        )
+
+    def handle(self, *args, **options):
+        user_ids = list(
+            UserProfile.objects.filter(logged_out=False, device_active=True)
+            .order_by("id")
+            .values_list("user_id", flat=True)[: options["users"]]
+        )
+        intents = [
+            PushIntent(
+                user_id, "Confetti is Ready!", "Benchmark", {"push_type": "rewards"}
+            )
+            for user_id in user_ids
+        ]
+        backend = FakePushBackend(latency=options["latency"])
+
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            delivered = deliver_pushes(intents, backend)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{sum(delivered.values())} of {len(intents)} pushes in {elapsed:.2f}s "
+            f"({len(intents) / max(elapsed, 1e-9):.0f}/s), {backend.batches} batches, "
+            f"{len(queries)} queries"
+        )
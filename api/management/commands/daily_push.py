@@ -1,12 +1,35 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from push_notifications.models import GCMDevice, APNSDevice
 
-from api.models import Holiday
+from api.models import Holiday, PushRun
+from api.tasks import send_daily_push_chunk
 from django.utils import timezone
+from holidaily.helpers.cache_helpers import warm_holiday_caches
+from holidaily.helpers.push_helpers import (
+    iter_device_chunks,
+    send_daily_push_with_badges,
+    start_push_runs,
+)
 import random
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--staggered",
+            default=False,
+            action="store_true",
+            help="Send in chunks through Celery, spread over --window. "
+            "Running it again resumes today's push.",
+        )
+        parser.add_argument(
+            "--window", type=int, default=settings.DAILY_PUSH_WINDOW_SECONDS
+        )
+        parser.add_argument(
+            "--chunk_size", type=int, default=settings.DAILY_PUSH_CHUNK_SIZE
+        )
+
     def handle(self, *args, **options):
         today = timezone.now().date()
         todays_holidays = (
@@ -14,31 +37,29 @@ class Command(BaseCommand):
             .exclude(push__isnull=True)
             .exclude(push__exact="")
         )
-        if todays_holidays.count() == 0:
+        started_run = PushRun.objects.filter(date=today).first()
+        if options["staggered"] and started_run:
+            # Resuming, stick with the holiday already being sent
+            random_day = started_run.holiday
+        elif todays_holidays.count() == 0:
             return "No holidays available"
-        random_day = random.choice(todays_holidays)
-        push = random_day.push if random_day.push else "Check out today's holidays!"
-        day_name = random_day.name
-        id = random_day.id
-
-        # FCM/APNs logic
-        androids = GCMDevice.objects.values("registration_id").distinct()
-        iphones = APNSDevice.objects.values("registration_id").distinct()
-
-        # todo set badge count to lambda for unique count per user. example:
-        # badge=lambda token: APNSDevice.objects.get(registration_id=token).user.get_badge()
-        # where get_badge() is a helper that returns 'unread' notifications value
-        iphones.send_message(
-            message={"title": day_name, "body": push},
-            extra={"holiday_id": id, "holiday_name": day_name, "push_type": "holiday"},
-            badge=1,
-        )
-        androids.send_message(
-            push,
-            title=day_name,
-            badge=1,
-            extra={"holiday_id": id, "holiday_name": day_name, "push_type": "holiday"},
-        )
+        else:
+            random_day = random.choice(todays_holidays)
+
+        # Every device is about to open this holiday at once
+        warm_holiday_caches(random_day.id)
+
+        if options["staggered"]:
+            runs = start_push_runs(random_day, options["window"], options["chunk_size"])
+            for run in runs:
+                if not run.finished:
+                    send_daily_push_chunk.delay(run.id)
+            return f"Queued {random_day.name} push for {len(runs)} platforms"
+
+        # FCM/APNs logic, in chunks to bound memory
+        for device_model in (APNSDevice, GCMDevice):
+            for device_ids in iter_device_chunks(device_model, options["chunk_size"]):
+                send_daily_push_with_badges(device_model, device_ids, random_day)
 
         # Delete invalid devices
         GCMDevice.objects.filter(active=False).delete()
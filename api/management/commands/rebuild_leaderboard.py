@@ -0,0 +1,11 @@
+"""Rebuild the confetti leaderboard from the database"""
+
+from django.core.management.base import BaseCommand
+
+from holidaily.helpers.leaderboard_helpers import rebuild_leaderboard
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        count = rebuild_leaderboard()
+        print(f"Ranked {count} profiles")
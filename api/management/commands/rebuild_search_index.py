@@ -0,0 +1,13 @@
+"""Rebuild the holiday search index from the database"""
+
+from django.core.management.base import BaseCommand
+
+from api.models import Holiday
+from holidaily.helpers.search_helpers import get_search_backend
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        holidays = Holiday.objects.only("id", "name", "description")
+        get_search_backend().rebuild(holidays.iterator())
+        print(f"Indexed {holidays.count()} holidays")
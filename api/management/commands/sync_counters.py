@@ -0,0 +1,69 @@
+"""Reconcile the denormalized UserProfile counters with the tables they count"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+
+from api.models import UserProfile, Comment, Holiday, UserNotifications
+
+COUNTER_FIELDS = (
+    "num_comments",
+    "holiday_submissions",
+    "approved_holidays",
+    "unread_notifications",
+)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--batch_size", type=int, default=500)
+
+    @staticmethod
+    def _actual_counts():
+        """ All counters from three GROUP BY queries, keyed by user id """
+        counts = {}
+        comment_counts = (
+            Comment.objects.values_list("user").annotate(total=Count("id")).order_by()
+        )
+        for user_id, total in comment_counts:
+            counts.setdefault(user_id, {})["num_comments"] = total
+
+        holiday_counts = (
+            Holiday.objects.filter(creator__isnull=False)
+            .values_list("creator")
+            .annotate(total=Count("id"), approved=Count("id", filter=Q(active=True)))
+            .order_by()
+        )
+        for user_id, total, approved in holiday_counts:
+            user_counts = counts.setdefault(user_id, {})
+            user_counts["holiday_submissions"] = total
+            user_counts["approved_holidays"] = approved
+
+        unread_counts = (
+            UserNotifications.objects.filter(user__isnull=False, read=False)
+            .values_list("user")
+            .annotate(total=Count("id"))
+            .order_by()
+        )
+        for user_id, total in unread_counts:
+            counts.setdefault(user_id, {})["unread_notifications"] = total
+        return counts
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        counts = self._actual_counts()
+
+        stale = []
+        profiles = UserProfile.objects.only("id", "user_id", *COUNTER_FIELDS)
+        for profile in profiles.iterator():
+            user_counts = counts.get(profile.user_id, {})
+            changed = False
+            for field in COUNTER_FIELDS:
+                actual = user_counts.get(field, 0)
+                if getattr(profile, field) != actual:
+                    setattr(profile, field, actual)
+                    changed = True
+            if changed:
+                stale.append(profile)
+
+        UserProfile.objects.bulk_update(stale, COUNTER_FIELDS, batch_size=batch_size)
+        self.stdout.write(f"Fixed counters for {len(stale)} profiles")
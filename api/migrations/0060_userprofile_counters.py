@@ -0,0 +1,58 @@
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_counters(apps, schema_editor):
+    UserProfile = apps.get_model("api", "UserProfile")
+    Comment = apps.get_model("api", "Comment")
+    Holiday = apps.get_model("api", "Holiday")
+
+    comment_counts = dict(
+        Comment.objects.values_list("user").annotate(total=Count("id")).order_by()
+    )
+    holiday_counts = {
+        creator: (total, approved)
+        for creator, total, approved in Holiday.objects.filter(creator__isnull=False)
+        .values_list("creator")
+        .annotate(total=Count("id"), approved=Count("id", filter=Q(active=True)))
+        .order_by()
+    }
+
+    profiles = []
+    for profile in UserProfile.objects.only("id", "user_id").iterator():
+        profile.num_comments = comment_counts.get(profile.user_id, 0)
+        submissions, approved = holiday_counts.get(profile.user_id, (0, 0))
+        profile.holiday_submissions = submissions
+        profile.approved_holidays = approved
+        profiles.append(profile)
+    UserProfile.objects.bulk_update(
+        profiles,
+        ["num_comments", "holiday_submissions", "approved_holidays"],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0059_auto_20201016_1141"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="approved_holidays",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="userprofile",
+            name="holiday_submissions",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="userprofile",
+            name="num_comments",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
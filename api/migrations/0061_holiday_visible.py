@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+
+def backfill_visible(apps, schema_editor):
+    Holiday = apps.get_model("api", "Holiday")
+    # Everything starts out visible, hide unapproved user submissions
+    Holiday.objects.filter(active=False, creator__isnull=False).update(visible=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0060_userprofile_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="holiday",
+            name="visible",
+            field=models.BooleanField(
+                default=True,
+                editable=False,
+                help_text="Active, or a regular holiday. Set on save",
+            ),
+        ),
+        migrations.RunPython(backfill_visible, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="holiday",
+            index=models.Index(
+                fields=["visible", "date"], name="api_holiday_visible_cfb0d4_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1 on 2026-10-18 09:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0061_holiday_visible"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PushRun",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "platform",
+                    models.CharField(
+                        choices=[("ios", "iOS"), ("android", "Android")], max_length=10
+                    ),
+                ),
+                (
+                    "rate",
+                    models.FloatField(
+                        help_text="Devices per second, shared by both platforms"
+                    ),
+                ),
+                ("chunk_size", models.IntegerField()),
+                ("last_device_id", models.IntegerField(default=0)),
+                ("sent", models.IntegerField(default=0)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+                (
+                    "holiday",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="api.holiday"
+                    ),
+                ),
+            ],
+            options={"unique_together": {("date", "platform")}},
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_unread(apps, schema_editor):
+    UserProfile = apps.get_model("api", "UserProfile")
+    UserNotifications = apps.get_model("api", "UserNotifications")
+
+    unread_counts = dict(
+        UserNotifications.objects.filter(user__isnull=False, read=False)
+        .values_list("user")
+        .annotate(total=Count("id"))
+        .order_by()
+    )
+
+    profiles = []
+    for profile in UserProfile.objects.only("id", "user_id").iterator():
+        profile.unread_notifications = unread_counts.get(profile.user_id, 0)
+        profiles.append(profile)
+    UserProfile.objects.bulk_update(profiles, ["unread_notifications"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0062_pushrun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="unread_notifications",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0063_userprofile_unread_notifications"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="usernotifications",
+            index=models.Index(
+                fields=["user", "read", "id"], name="api_usernot_user_id_d68341_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="usernotifications",
+            index=models.Index(
+                fields=["notification_type", "user", "id"],
+                name="api_usernot_notific_ec730d_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    UserNotifications = apps.get_model("api", "UserNotifications")
+    UserProfile = apps.get_model("api", "UserProfile")
+
+    duplicates = (
+        UserNotifications.objects.filter(
+            user__isnull=False, notification_id__isnull=False
+        )
+        .values_list("user", "notification_type", "notification_id")
+        .annotate(first_id=Min("id"), total=Count("id"))
+        .filter(total__gt=1)
+        .order_by()
+    )
+    affected_users = set()
+    for user_id, n_type, n_id, first_id, _ in duplicates.iterator():
+        UserNotifications.objects.filter(
+            user_id=user_id, notification_type=n_type, notification_id=n_id
+        ).exclude(id=first_id).delete()
+        affected_users.add(user_id)
+
+    # Deleted duplicates may have been counted as unread
+    for user_id in affected_users:
+        unread = UserNotifications.objects.filter(user_id=user_id, read=False).count()
+        UserProfile.objects.filter(user_id=user_id).update(unread_notifications=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0064_usernotifications_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="usernotifications",
+            constraint=models.UniqueConstraint(
+                fields=("user", "notification_type", "notification_id"),
+                name="unique_user_notification",
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1 on 2026-10-18 10:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("api", "0065_unique_user_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingLike",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("notification_type", models.IntegerField()),
+                ("entity_id", models.IntegerField()),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "liker",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={"unique_together": {("notification_type", "entity_id", "liker")}},
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0066_pendinglike"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pushrun",
+            name="rejected_device_ids",
+            field=models.JSONField(
+                default=list, help_text="Deleted when the run finishes"
+            ),
+        ),
+    ]
@@ -1,10 +1,14 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils.safestring import mark_safe
 from pygments.lexers import get_all_lexers
 from pygments.styles import get_all_styles
 
-from api.constants import S3_BUCKET_IMAGES
+from api.constants import S3_BUCKET_IMAGES, IOS, ANDROID
 from holidaily.settings import (
     HOLIDAY_IMAGE_WIDTH,
     HOLIDAY_IMAGE_HEIGHT,
@@ -26,9 +30,44 @@ VOTE_CHOICES = (
     (5, "down_from_up"),
 )
 NOTIFICATION_TYPES = ((0, "comment"), (1, "news"), (2, "holiday"))
+PLATFORM_CHOICES = ((IOS, "iOS"), (ANDROID, "Android"))
 
 
-class UserProfile(models.Model):
+class TracksLoadedValues:
+    """ Model mixin remembering field values as loaded, for signal handlers to diff against """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def changed_since_load(self, *fields) -> bool:
+        """ True for new objects, or if any of the fields differ from the database copy """
+        loaded = getattr(self, "_loaded_values", None)
+        if loaded is None:
+            return True
+        return any(f not in loaded or loaded[f] != self.__dict__.get(f) for f in fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # What was saved is the database copy now, post_save handlers have
+        # already compared against the old one
+        update_fields = kwargs.get("update_fields")
+        saved = {
+            f.attname: self.__dict__[f.attname]
+            for f in self._meta.concrete_fields
+            if f.attname in self.__dict__
+            and (
+                update_fields is None
+                or f.name in update_fields
+                or f.attname in update_fields
+            )
+        }
+        self._loaded_values = {**getattr(self, "_loaded_values", {}), **saved}
+
+
+class UserProfile(TracksLoadedValues, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE,)
     active = models.BooleanField(default=True)
     device_id = models.TextField(blank=True, null=True)
@@ -60,6 +99,20 @@ class UserProfile(models.Model):
         blank=True, null=True, help_text="Last time the user watched a reward ad"
     )
     requested_confetti_alert = models.BooleanField(default=False)
+    # Denormalized counts, see adjust_counters and the sync_counters command
+    num_comments = models.IntegerField(default=0)
+    holiday_submissions = models.IntegerField(default=0)
+    approved_holidays = models.IntegerField(default=0)
+    unread_notifications = models.IntegerField(default=0)
+
+    @classmethod
+    def adjust_counters(cls, user_id, **deltas):
+        """
+        Atomically add to a user's counters, i.e. adjust_counters(1, num_comments=1)
+        """
+        deltas = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if user_id is not None and deltas:
+            cls.objects.filter(user_id=user_id).update(**deltas)
 
     def avatar_s3_path(self):
         if not self.profile_image:
@@ -97,20 +150,26 @@ class UserProfile(models.Model):
     avatar_preview.short_description = "Avatar"
     avatar_full.short_description = "Avatar"
 
-    @property
-    def num_comments(self):
-        return Comment.objects.filter(user=self.user).count()
-
-    @property
-    def holiday_submissions(self):
-        return Holiday.objects.filter(creator=self.user).count()
 
-    @property
-    def approved_holidays(self):
-        return Holiday.objects.filter(creator=self.user, active=True).count()
+class HolidayQuerySet(models.QuerySet):
+    def with_num_comments(self):
+        """
+        Annotate the number of undeleted posts as post_count, read by
+        Holiday.num_comments instead of counting per holiday.
+        """
+        posts = (
+            Post.objects.filter(holiday=OuterRef("pk"), deleted=False)
+            .order_by()
+            .values("holiday")
+            .annotate(total=Count("id"))
+            .values("total")
+        )
+        return self.annotate(
+            post_count=Coalesce(Subquery(posts, output_field=IntegerField()), 0)
+        )
 
 
-class Holiday(models.Model):
+class Holiday(TracksLoadedValues, models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField()
     votes = models.IntegerField(default=0)
@@ -131,6 +190,12 @@ class Holiday(models.Model):
         default=True,
         help_text="Will holiday appear in the app. If false, will still appear if no creator",
     )
+    # Denormalized from active/creator so feeds can filter on one indexed column
+    visible = models.BooleanField(
+        default=True,
+        editable=False,
+        help_text="Active, or a regular holiday. Set on save",
+    )
     blurb = models.TextField(
         blank=True, null=True, help_text="Short description appearing in Holiday list"
     )
@@ -154,9 +219,60 @@ class Holiday(models.Model):
         null=True, blank=True, help_text="Additional notes about this holiday"
     )
 
+    objects = HolidayQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["visible", "date"])]
+
+    def save(self, *args, **kwargs):
+        # Who the holiday was counted for in the database copy
+        loaded = getattr(self, "_loaded_values", {})
+        update_fields = kwargs.get("update_fields")
+        counted_fields = {"active", "creator", "creator_id"}
+        if update_fields is not None and not counted_fields & set(update_fields):
+            # Neither is written, i.e. changed in memory but saved later
+            counted_as = None
+        elif self._state.adding:
+            counted_as = (None, False)
+        elif "creator_id" in loaded and "active" in loaded:
+            counted_as = (loaded["creator_id"], loaded["active"])
+        else:
+            counted_as = None
+
+        self.visible = self.active or self.creator_id is None
+        if update_fields is not None and counted_fields & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"visible"}
+
+        with transaction.atomic():
+            super(Holiday, self).save(*args, **kwargs)
+            if counted_as is not None:
+                self._update_creator_counters(counted_as)
+
+    def _update_creator_counters(self, counted_as):
+        """ Keep the creator's submission/approval counts in sync on create and approval """
+        old_creator_id, old_active = counted_as
+        if old_creator_id != self.creator_id:
+            UserProfile.adjust_counters(
+                old_creator_id,
+                holiday_submissions=-1,
+                approved_holidays=-1 if old_active else 0,
+            )
+            UserProfile.adjust_counters(
+                self.creator_id,
+                holiday_submissions=1,
+                approved_holidays=1 if self.active else 0,
+            )
+        elif old_active != self.active:
+            UserProfile.adjust_counters(
+                self.creator_id, approved_holidays=1 if self.active else -1
+            )
+
     @property
     def num_comments(self):
         # Note, this doesn't currently include replies
+        if hasattr(self, "post_count"):
+            # Annotated by Holiday.objects.with_num_comments()
+            return self.post_count
         return self.post_set.filter(deleted=False).count()
 
     def get_image(self):
@@ -204,6 +320,13 @@ class Comment(models.Model):
     likes = models.IntegerField(default=0)
     user_likes = models.ManyToManyField(User, related_name="liked_comments")
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        with transaction.atomic():
+            super(Comment, self).save(*args, **kwargs)
+            if created:
+                UserProfile.adjust_counters(self.user_id, num_comments=1)
+
     @property
     def replies(self):
         replies = Comment.objects.get(parent=self)
@@ -224,6 +347,22 @@ class Comment(models.Model):
         return f"{self.content[:100]}..."
 
 
+# Deletes go through signals so cascaded deletes are counted too. They are sent
+# inside the delete's transaction.
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    UserProfile.adjust_counters(instance.user_id, num_comments=-1)
+
+
+@receiver(post_delete, sender=Holiday)
+def holiday_deleted(sender, instance, **kwargs):
+    UserProfile.adjust_counters(
+        instance.creator_id,
+        holiday_submissions=-1,
+        approved_holidays=-1 if instance.active else 0,
+    )
+
+
 class UserHolidayVotes(models.Model):
     user = models.ForeignKey(User, models.CASCADE)
     holiday = models.ForeignKey(Holiday, on_delete=models.CASCADE)
@@ -248,11 +387,35 @@ class UserNotifications(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     title = models.CharField(max_length=150)
 
+    class Meta:
+        indexes = [
+            # A user's inbox and unread notifications
+            models.Index(fields=["user", "read", "id"]),
+            # News for everyone, user is null
+            models.Index(fields=["notification_type", "user", "id"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "notification_type", "notification_id"],
+                name="unique_user_notification",
+            )
+        ]
+
     def save(self, *args, **kwargs):
-        super(UserNotifications, self).save(*args, **kwargs)
+        created = self._state.adding
+        with transaction.atomic():
+            super(UserNotifications, self).save(*args, **kwargs)
+            if created and not self.read:
+                UserProfile.adjust_counters(self.user_id, unread_notifications=1)
 
 
-class Post(models.Model):
+@receiver(post_delete, sender=UserNotifications)
+def notification_deleted(sender, instance, **kwargs):
+    if not instance.read:
+        UserProfile.adjust_counters(instance.user_id, unread_notifications=-1)
+
+
+class Post(TracksLoadedValues, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField(blank=True, null=True)
     holiday = models.ForeignKey(Holiday, on_delete=models.CASCADE)
@@ -282,3 +445,47 @@ class Post(models.Model):
 
     get_image.short_description = "Image Preview"
     get_image_small.short_description = "Image Preview"
+
+
+class PushRun(models.Model):
+    """
+    Progress of a staggered daily push to one platform. Devices are sent to in
+    id order, each chunk is claimed by saving last_device_id before sending so a
+    resumed or duplicated run never sends to a device twice.
+    """
+
+    holiday = models.ForeignKey(Holiday, on_delete=models.CASCADE)
+    date = models.DateField()
+    platform = models.CharField(max_length=10, choices=PLATFORM_CHOICES)
+    rate = models.FloatField(help_text="Devices per second, shared by both platforms")
+    chunk_size = models.IntegerField()
+    last_device_id = models.IntegerField(default=0)
+    sent = models.IntegerField(default=0)
+    rejected_device_ids = models.JSONField(
+        default=list, help_text="Deleted when the run finishes"
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ("date", "platform")
+
+    def __str__(self):
+        return f"{self.date} {self.platform} push"
+
+
+class PendingLike(models.Model):
+    """
+    A like its author hasn't been notified of yet. Likes on the same post or
+    comment are merged into one notification and push by the
+    flush_like_notifications task, once the first is LIKE_COALESCE_SECONDS old.
+    """
+
+    # LIKE_NOTIFICATION or LIKE_COMMENT_NOTIFICATION
+    notification_type = models.IntegerField()
+    entity_id = models.IntegerField()
+    liker = models.ForeignKey(User, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("notification_type", "entity_id", "liker")
@@ -1,8 +1,17 @@
 from datetime import timedelta
 
-from factory.django import get_model
+from django.db.models import Prefetch
 from rest_framework import serializers
+from rest_framework.utils import model_meta
 
+from holidaily.helpers.context_helpers import (
+    build_serializer_context,
+    get_avatar_url,
+    resolve_notification_entities,
+    get_profile_resolver,
+)
+from holidaily.helpers.comment_helpers import flatten_replies
+from holidaily.helpers.counter_helpers import get_counter
 from holidaily.utils import normalize_time
 from .models import (
     Holiday,
@@ -35,7 +44,29 @@ from logging import getLogger
 logger = getLogger("holidaily")
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class SavesSentFieldsMixin:
+    """
+    Updates only save the fields sent, so a stale copy of a counter never
+    overwrites an F() update or flush_counters made meanwhile
+    """
+
+    def update(self, instance, validated_data):
+        info = model_meta.get_field_info(instance)
+        many_to_many = {}
+        for attr, value in validated_data.items():
+            if attr in info.relations and info.relations[attr].to_many:
+                many_to_many[attr] = value
+            else:
+                setattr(instance, attr, value)
+        instance.save(
+            update_fields=[attr for attr in validated_data if attr not in many_to_many]
+        )
+        for attr, value in many_to_many.items():
+            getattr(instance, attr).set(value)
+        return instance
+
+
+class UserProfileSerializer(SavesSentFieldsMixin, serializers.ModelSerializer):
     username = serializers.SerializerMethodField()
     premium = serializers.BooleanField()
     profile_image = serializers.SerializerMethodField()
@@ -47,19 +78,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     def get_profile_image(self, obj):
         requesting_user = self.context.get("requesting_user", None)
-        # Don't censor user's own avatar
-        if not obj.profile_image:
-            return None
-        elif requesting_user:
-            if (
-                requesting_user.lower() == obj.user.username.lower()
-                or obj.avatar_approved
-            ):
-                return f"{CLOUDFRONT_DOMAIN}/{obj.profile_image}"
-        elif obj.avatar_approved:
-            return f"{CLOUDFRONT_DOMAIN}/{obj.profile_image}"
-        else:
-            return None
+        return get_avatar_url(obj, requesting_user)
 
     def get_last_online(self, obj):
         if obj.last_launched:
@@ -86,6 +105,16 @@ class UserProfileSerializer(serializers.ModelSerializer):
                 return unlock_countdown
         return None
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Leaderboard scores, already including unflushed confetti
+        scores = self.context.get("confetti", {})
+        if instance.id in scores:
+            data["confetti"] = scores[instance.id]
+        else:
+            data["confetti"] = get_counter(instance, "confetti")
+        return data
+
     class Meta:
         model = UserProfile
         fields = (
@@ -100,6 +129,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
             "confetti_cooldown",
             "requested_confetti_alert",
         )
+        read_only_fields = ("holiday_submissions", "approved_holidays", "num_comments")
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -112,23 +142,43 @@ class UserSerializer(serializers.ModelSerializer):
     num_comments = serializers.SerializerMethodField()
     device_active = serializers.SerializerMethodField()
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """ Load each user's profile along with the users, 2 queries for any page size """
+        return queryset.prefetch_related(
+            Prefetch("userprofile_set", queryset=UserProfile.objects.order_by("id"))
+        )
+
+    def _get_profile(self, obj):
+        """ The user's profile, looked up once and shared by every profile field """
+        if not hasattr(obj, "_serializer_profile"):
+            if "userprofile_set" in getattr(obj, "_prefetched_objects_cache", {}):
+                profiles = obj.userprofile_set.all()
+                profile = profiles[0] if profiles else None
+            else:
+                profile = obj.userprofile_set.order_by("id").first()
+            if profile is None:
+                raise UserProfile.DoesNotExist(f"{obj.username} has no profile")
+            obj._serializer_profile = profile
+        return obj._serializer_profile
+
     def get_is_premium(self, obj):
-        return UserProfile.objects.get(user=obj).premium
+        return self._get_profile(obj).premium
 
     def get_is_active(self, obj):
-        return UserProfile.objects.get(user=obj).active
+        return self._get_profile(obj).active
 
     def get_confetti(self, obj):
-        return UserProfile.objects.get(user=obj).confetti
+        return get_counter(self._get_profile(obj), "confetti")
 
     def get_approved_holidays(self, obj):
-        return UserProfile.objects.get(user=obj).approved_holidays
+        return self._get_profile(obj).approved_holidays
 
     def get_num_comments(self, obj):
-        return UserProfile.objects.get(user=obj).num_comments
+        return self._get_profile(obj).num_comments
 
     def get_last_online(self, obj):
-        profile = UserProfile.objects.get(user=obj)
+        profile = self._get_profile(obj)
         if profile.last_launched:
             time_ago = humanize.naturaltime(timezone.now() - profile.last_launched)
             return normalize_time(time_ago, "precise")
@@ -136,14 +186,14 @@ class UserSerializer(serializers.ModelSerializer):
             return "a while ago"
 
     def get_profile_image(self, obj):
-        profile = UserProfile.objects.get(user=obj)
+        profile = self._get_profile(obj)
         if profile.profile_image:
             return f"{CLOUDFRONT_DOMAIN}/{profile.profile_image}"
         else:
             return None
 
     def get_device_active(self, obj):
-        return UserProfile.objects.get(user=obj).device_active
+        return self._get_profile(obj).device_active
 
     class Meta:
         model = User
@@ -162,10 +212,10 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(SavesSentFieldsMixin, serializers.ModelSerializer):
     id = serializers.IntegerField()
     content = serializers.CharField()
-    holiday_id = serializers.ReadOnlyField(source="holiday.pk")
+    holiday_id = serializers.ReadOnlyField()
     user = serializers.ReadOnlyField(source="user.username")
     timestamp = serializers.DateTimeField()
     votes = serializers.IntegerField()
@@ -181,6 +231,10 @@ class CommentSerializer(serializers.ModelSerializer):
     def get_liked(self, obj):
         username = self.context.get("username", None)
         if username:
+            # Resolved for the whole page by build_serializer_context
+            liked_comments = self.context.get("liked_comments", None)
+            if liked_comments is not None:
+                return obj.id in liked_comments
             liked = obj.user_likes.filter(username=username).exists()
             return liked
         else:
@@ -198,6 +252,9 @@ class CommentSerializer(serializers.ModelSerializer):
     def get_vote_status(self, obj):
         username = self.context.get("username", None)
         if username:
+            vote_statuses = self.context.get("vote_statuses", None)
+            if vote_statuses is not None:
+                return vote_statuses.get(obj.id, None)
             if UserCommentVotes.objects.filter(
                 user__username=username, comment=obj, choice__in=UPVOTE_ONLY
             ).exists():
@@ -212,34 +269,18 @@ class CommentSerializer(serializers.ModelSerializer):
             return None
 
     def get_avatar(self, obj):
-        profile = UserProfile.objects.get(user=obj.user)
-        avatar = (
-            f"{CLOUDFRONT_DOMAIN}/{profile.profile_image}"
-            if profile and profile.avatar_approved
-            else None
-        )
-        return avatar
-
-    def _get_replies(self, comment):
-        """ Recursively get comment reply chain """
-        reply_chain = []
-        replies = comment.comment_set.filter(deleted=False).order_by("-votes", "-id")
-
-        for c in replies:
-            reply_chain.append(c)
-            if c.comment_set.all().count() > 0:
-                child_replies = self._get_replies(c)
-                reply_chain.extend(child_replies)
-
-        return reply_chain
+        username = self.context.get("username", None)
+        return get_profile_resolver(self.context).avatar(obj.user_id, username)
 
     def get_replies(self, obj):
         # TODO limit this / pagination
-        username = self.context.get("username", None)
-        replies = self._get_replies(obj)
-        return CommentSerializer(
-            replies, many=True, context={"username": username}
-        ).data
+        context = self.context
+        if obj.id not in context.get("reply_children", {}):
+            # Serialized without a context from build_serializer_context
+            context = build_serializer_context(context.get("username"), [obj])
+        replies = flatten_replies(obj, context["reply_children"])
+        # The context covers replies too, so nested replies don't query
+        return CommentSerializer(replies, many=True, context=context).data
 
     class Meta:
         model = Comment
@@ -295,6 +336,10 @@ class HolidaySerializer(serializers.ModelSerializer):
     def get_celebrating(self, obj):
         username = self.context.get("username", None)
         if username:
+            # Resolved once per request by get_celebrated_holiday_ids
+            celebrating = self.context.get("celebrating", None)
+            if celebrating is not None:
+                return obj.id in celebrating
             celebrating = UserHolidayVotes.objects.filter(
                 user__username=username, holiday=obj, choice__in=UPVOTE_ONLY
             ).exists()
@@ -348,53 +393,27 @@ class UserNotificationsSerializer(serializers.ModelSerializer):
         elif obj.notification_type == LIKE_COMMENT_NOTIFICATION:
             return "Comment"
 
+    def _get_entity(self, obj):
+        # Resolved for the whole page by build_notification_context
+        entities = self.context.get("notification_entities", None)
+        if entities is None:
+            entities = resolve_notification_entities([obj])
+        return entities.get((obj.notification_type, obj.notification_id), None)
+
     def get_holiday_id(self, obj):
-        try:
-            if obj.notification_type == LIKE_NOTIFICATION:
-                liked_post = Post.objects.filter(pk=obj.notification_id).first()
-                if liked_post:
-                    return liked_post.holiday.id
-            elif obj.notification_type == HOLIDAY_NOTIFICATION:
-                holiday = Holiday.objects.filter(pk=obj.notification_id).first()
-                if holiday:
-                    return holiday.id
-            else:
-                # Directly linked to holiday via holiday FK
-                entity = (
-                    get_model("api", self.get_notification_type(obj))
-                    .objects.filter(pk=obj.notification_id)
-                    .first()
-                )
-                if entity:
-                    return entity.holiday.id
-        except AttributeError:
-            logger.warning(
-                f"{obj.notification_type} notification is not linked to holiday."
-            )
-        return None
+        entity = self._get_entity(obj)
+        return entity.holiday_id if entity else None
 
     def get_time_since(self, obj):
         time_ago = humanize.naturaltime(timezone.now() - obj.timestamp)
         return normalize_time(time_ago, "precise")
 
     def get_icon(self, obj):
-        profile = None
-
-        if obj.notification_type == COMMENT_NOTIFICATION:
-            c = Comment.objects.filter(id=obj.notification_id).first()
-            if c:
-                profile = UserProfile.objects.filter(user=c.user).first()
-        elif obj.notification_type == POST_NOTIFICATION:
-            p = Post.objects.filter(id=obj.notification_id).first()
-            if p:
-                profile = UserProfile.objects.filter(user=p.user).first()
         # todo get icon for likes
-        icon = (
-            f"{CLOUDFRONT_DOMAIN}/{profile.profile_image}"
-            if profile and profile.avatar_approved
-            else None
-        )
-        return icon
+        entity = self._get_entity(obj)
+        if entity is None or entity.author_id is None:
+            return None
+        return get_profile_resolver(self.context).avatar(entity.author_id)
 
     class Meta:
         model = UserNotifications
@@ -412,7 +431,7 @@ class UserNotificationsSerializer(serializers.ModelSerializer):
         )
 
 
-class PostSerializer(serializers.ModelSerializer):
+class PostSerializer(SavesSentFieldsMixin, serializers.ModelSerializer):
     time_since = serializers.SerializerMethodField()
     deleted = serializers.BooleanField()
     time_since_edit = serializers.SerializerMethodField()
@@ -435,17 +454,16 @@ class PostSerializer(serializers.ModelSerializer):
             return normalize_time(time_ago, "precise", short=True)
 
     def get_avatar(self, obj):
-        profile = UserProfile.objects.get(user=obj.user)
-        avatar = (
-            f"{CLOUDFRONT_DOMAIN}/{profile.profile_image}"
-            if profile and profile.avatar_approved
-            else None
-        )
-        return avatar
+        username = self.context.get("username", None)
+        return get_profile_resolver(self.context).avatar(obj.user_id, username)
 
     def get_liked(self, obj):
         username = self.context.get("username", None)
         if username:
+            # Resolved for the whole page by build_serializer_context
+            liked_posts = self.context.get("liked_posts", None)
+            if liked_posts is not None:
+                return obj.id in liked_posts
             liked = obj.user_likes.filter(username=username).exists()
             return liked
         else:
@@ -466,20 +484,13 @@ class PostSerializer(serializers.ModelSerializer):
 
     def get_comments(self, obj):
         # TODO possibly limit these results for pagination
-        comments = Comment.objects.filter(parent_post=obj, deleted=False)
-        username = self.context.get("username", None)
-        if username:
-            profile = UserProfile.objects.get(user__username=username)
-            blocked_users = profile.blocked_users.all()
-            reported_comments = profile.reported_comments.all().only("id")
-            comments = comments.exclude(user__in=blocked_users).exclude(
-                id__in=reported_comments
-            )
-        comments = comments.order_by("-id")
-        data = CommentSerializer(
-            comments, many=True, context={"username": username}
-        ).data
-        return data
+        context = self.context
+        if obj.id not in context.get("post_comments", {}):
+            # Serialized without a context from build_serializer_context
+            context = build_serializer_context(context.get("username"), posts=[obj])
+        comments = context["post_comments"][obj.id]
+        # The context covers the comments and their replies too
+        return CommentSerializer(comments, many=True, context=context).data
 
     def get_holiday_name(self, obj):
         return obj.holiday.name
@@ -1,10 +1,34 @@
+from io import StringIO
 from logging import getLogger
-from typing import Tuple
+from typing import List, Optional, Tuple
+from celery import signature
 from celery.decorators import task
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from push_notifications.exceptions import NotificationError
 
-from api.models import UserProfile
-from holidaily.helpers.notification_helpers import send_push_to_user, send_email_to_user
+from api.constants import COMMENT_NOTIFICATION, PUSH_RETRIES
+from api.models import UserProfile, PushRun, Comment, Post, Holiday
+from holidaily.helpers.counter_helpers import flush_counters as flush_counter_deltas
+from holidaily.helpers.notification_helpers import (
+    flush_like_notifications as flush_likes,
+    email_mention,
+    mention_push_intent,
+    notify_mentioned_users,
+    send_push_to_user,
+    send_email_to_user,
+)
+from holidaily.helpers.push_helpers import (
+    DEVICE_MODELS,
+    PushIntent,
+    claim_push_chunk,
+    deliver_pushes,
+    find_rejected,
+    get_push_bucket,
+    record_rejected_devices,
+    send_daily_push_with_badges,
+)
 from django.core.cache import cache
 
 logger = getLogger("holidaily")
@@ -34,3 +58,127 @@ def confetti_notification(user_id: int) -> Tuple[bool, str]:
                 return True, f"{user.username} notified by email"
         return False, f"{user.username} could not be notified by push or email"
     return False, f"{user.username} disabled confetti notification"
+
+
+@task()
+def send_daily_push_chunk(run_id: int, reserved: bool = False) -> Tuple[bool, str]:
+    """ Send the next chunk of a staggered daily push, then queue the one after """
+    run = PushRun.objects.select_related("holiday").get(id=run_id)
+    if run.finished:
+        return False, f"{run} already finished"
+    if not reserved:
+        delay = get_push_bucket(run).take(run.chunk_size)
+        if delay > 0:
+            send_daily_push_chunk.apply_async((run_id, True), countdown=delay)
+            return True, f"{run} waiting {delay:.1f}s"
+
+    device_model = DEVICE_MODELS[run.platform]
+    device_ids = claim_push_chunk(run_id)
+    if device_ids is None:
+        run.refresh_from_db(fields=["rejected_device_ids"])
+        # Unless they were registered again since
+        device_model.objects.filter(
+            id__in=run.rejected_device_ids, active=False
+        ).delete()
+        return True, f"{run} finished"
+    try:
+        failed = send_daily_push_with_badges(device_model, device_ids, run.holiday)
+        record_rejected_devices(run_id, find_rejected(device_model, failed))
+    finally:
+        send_daily_push_chunk.delay(run_id)
+    return True, f"{run} sent to {len(device_ids)} devices"
+
+
+def _get_mention_source(n_type: int, entity_id: int):
+    model = Comment if n_type == COMMENT_NOTIFICATION else Post
+    return model.objects.select_related("user", "holiday").filter(id=entity_id).first()
+
+
+@task()
+def notify_mentions(n_type: int, entity_id: int) -> Tuple[bool, str]:
+    """ Notify everyone mentioned in a new comment or post, pushing to them in one batch """
+    notification = _get_mention_source(n_type, entity_id)
+    if notification is None:
+        return False, f"{entity_id} was deleted before mentions were sent"
+    user_ids = notify_mentioned_users(notification)
+    if user_ids:
+        intents = [
+            mention_push_intent(user, notification)._asdict()
+            for user in User.objects.filter(id__in=user_ids)
+        ]
+        send_pushes.delay(intents, email_mentions.s(n_type, entity_id))
+    return True, f"{len(user_ids)} users mentioned"
+
+
+@task()
+def email_mentions(
+    user_ids: List[int], n_type: int, entity_id: int
+) -> Tuple[bool, str]:
+    """ Email the mentioned users send_pushes couldn't reach """
+    notification = _get_mention_source(n_type, entity_id)
+    if notification is None:
+        return False, f"{entity_id} was deleted before mentions were emailed"
+    emailed = sum(
+        email_mention(user, notification)
+        for user in User.objects.filter(id__in=user_ids)
+    )
+    return emailed > 0, f"Emailed {emailed} of {len(user_ids)} mentioned users"
+
+
+@task()
+def email_holiday_approval(user_ids: List[int], holiday_id: int) -> Tuple[bool, str]:
+    """ Email the creator of an approved holiday if send_pushes couldn't reach them """
+    holiday = Holiday.objects.select_related("creator").filter(id=holiday_id).first()
+    if holiday is None:
+        return False, f"{holiday_id} was deleted before its approval was emailed"
+    if send_email_to_user(holiday.creator, holiday, approval=True):
+        return True, f"{holiday.creator.username} emailed of holiday approval"
+    return (
+        False,
+        f"{holiday.creator.username} could not be notified of holiday approval",
+    )
+
+
+# Connection problems are worth another try, rejected devices are dealt with
+# by deliver_pushes
+@task(
+    autoretry_for=(NotificationError, OSError),
+    retry_backoff=True,
+    max_retries=PUSH_RETRIES,
+)
+def send_pushes(
+    intents: List[dict], fallback: Optional[dict] = None
+) -> Tuple[bool, str]:
+    """
+    Send queued pushes, PushIntents as dicts, batched by platform and payload.
+    The ids of users that couldn't be reached are passed to the fallback task.
+    """
+    delivered = deliver_pushes(PushIntent(**intent) for intent in intents)
+    undelivered = [user_id for user_id, sent in delivered.items() if not sent]
+    if fallback and undelivered:
+        signature(fallback).delay(undelivered)
+    sent = len(delivered) - len(undelivered)
+    return sent > 0, f"Sent {sent} of {len(intents)} pushes"
+
+
+@task()
+def flush_like_notifications() -> Tuple[bool, str]:
+    """ Run every minute by celery beat, see CELERYBEAT_SCHEDULE """
+    intents = flush_likes(settings.LIKE_COALESCE_SECONDS)
+    delivered = deliver_pushes(intents)
+    return True, f"{len(intents)} like notifications, {sum(delivered.values())} pushed"
+
+
+@task()
+def flush_counters() -> Tuple[bool, str]:
+    """ Run every 10 seconds by celery beat, see CELERYBEAT_SCHEDULE """
+    flushed = flush_counter_deltas()
+    return True, f"{flushed} counters flushed"
+
+
+@task()
+def sync_counters() -> Tuple[bool, str]:
+    """ Run nightly by celery beat, see CELERYBEAT_SCHEDULE """
+    out = StringIO()
+    call_command("sync_counters", stdout=out)
+    return True, out.getvalue().strip()
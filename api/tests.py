@@ -1,9 +1,100 @@
-from rest_framework.test import APITestCase
+import json
+import warnings
+from datetime import timedelta
+from unittest import mock
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from push_notifications.models import APNSDevice, GCMDevice
+from rest_framework.test import APITestCase, APITransactionTestCase
 from api import factories
+from api.models import (
+    Holiday,
+    Comment,
+    UserCommentVotes,
+    UserHolidayVotes,
+    UserProfile,
+    UserNotifications,
+    PendingLike,
+    Post,
+)
+from api.serializers import (
+    CommentSerializer,
+    UserSerializer,
+    HolidaySerializer,
+    PostSerializer,
+)
 from rest_framework import status as rest_status
-from api.constants import NO_DEVICE_ERROR
+from api.constants import (
+    IOS,
+    ANDROID,
+    COMMENT_NOTIFICATION,
+    NEWS_NOTIFICATION,
+    POST_NOTIFICATION,
+    LIKE_NOTIFICATION,
+    LIKE_COMMENT_NOTIFICATION,
+    HOLIDAY_NOTIFICATION,
+    NO_DEVICE_ERROR,
+    UP,
+    DOWN,
+    UPVOTE,
+    DOWNVOTE,
+    CLOUDFRONT_DOMAIN,
+)
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.base import CacheKeyWarning
+from django.core.management import call_command
+from holidaily.helpers.autocomplete_helpers import (
+    autocomplete_index,
+    HolidayAutocompleteIndex,
+)
+from holidaily.helpers.cache_helpers import (
+    FEED_VERSION_CACHE_KEY,
+    get_celebrated_holiday_ids,
+    single_flight,
+    warm_holiday_caches,
+)
+from holidaily.helpers.comment_helpers import load_comment_threads
+from holidaily.helpers.context_helpers import build_serializer_context
+from holidaily.helpers.counter_helpers import (
+    CounterUnavailable,
+    flush_counters,
+    get_counter,
+    get_counter_backend,
+    incr_counter,
+)
+from holidaily.helpers.leaderboard_helpers import (
+    add_to_leaderboard,
+    get_leaderboard,
+    rebuild_leaderboard,
+)
+from holidaily.helpers.notification_helpers import (
+    add_notification,
+    add_notifications,
+    cancel_like_notification,
+    flush_like_notifications,
+    get_unread_count,
+    mark_notifications_read,
+    queue_like_notification,
+)
+from holidaily.helpers.push_helpers import (
+    claim_push_chunk,
+    deliver_pushes,
+    DjangoPushBackend,
+    FakePushBackend,
+    get_push_backend,
+    PushIntent,
+    send_daily_push_with_badges,
+    start_push_runs,
+    TokenBucket,
+)
+from holidaily.helpers.search_helpers import get_search_backend
+from holidaily.celery import app as celery_app
+from api.tasks import notify_mentions, send_daily_push_chunk, sync_counters
 
 
 class UserLoginTest(APITestCase):
@@ -92,3 +183,1328 @@ class UserRegisterTest(APITestCase):
             format="json",
         )
         self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+
+
+class CommentThreadTest(APITestCase):
+    def setUp(self):
+        self.user = factories.UserFactory()
+        self.holiday = Holiday.objects.create(
+            name="Test Day", description="A day for testing", date=timezone.now()
+        )
+
+    def comment(self, parent=None, votes=0, deleted=False):
+        return Comment.objects.create(
+            content="comment",
+            holiday=self.holiday,
+            user=self.user,
+            timestamp=timezone.now(),
+            parent=parent,
+            votes=votes,
+            deleted=deleted,
+        )
+
+    def test_threads_ordered_with_padding(self):
+        root = self.comment(votes=5)
+        low_reply = self.comment(parent=root, votes=0)
+        top_reply = self.comment(parent=root, votes=3)
+        nested_reply = self.comment(parent=top_reply)
+        other_root = self.comment(votes=1)
+        # Deleted top level comments with no replies are skipped
+        self.comment(deleted=True)
+
+        with self.assertNumQueries(3):
+            threads = load_comment_threads(self.holiday.id, 0)
+
+        self.assertEqual(
+            [[(c.id, depth) for c, depth in thread] for thread in threads],
+            [
+                [
+                    (root.id, 10),
+                    (top_reply.id, 30),
+                    (nested_reply.id, 50),
+                    (low_reply.id, 30),
+                ],
+                [(other_root.id, 10)],
+            ],
+        )
+
+
+class SerializerContextTest(APITestCase):
+    def setUp(self):
+        self.user = factories.UserProfileFactory(profile_image="avatar.png").user
+        self.holiday = Holiday.objects.create(
+            name="Test Day", description="A day for testing", date=timezone.now()
+        )
+        self.comments = [
+            Comment.objects.create(
+                content="comment",
+                holiday=self.holiday,
+                user=self.user,
+                timestamp=timezone.now(),
+            )
+            for _ in range(3)
+        ]
+
+    def test_viewer_state_resolved_per_page(self):
+        up, down, liked = self.comments
+        UserCommentVotes.objects.create(user=self.user, comment=up, choice=UP)
+        UserCommentVotes.objects.create(user=self.user, comment=down, choice=DOWN)
+        liked.user_likes.add(self.user)
+
+        # Replies, votes, likes and profiles
+        with self.assertNumQueries(4):
+            context = build_serializer_context(
+                self.user.username, comments=self.comments
+            )
+        self.assertEqual(context["vote_statuses"], {up.id: UPVOTE, down.id: DOWNVOTE})
+        self.assertEqual(context["liked_comments"], {liked.id})
+
+        data = CommentSerializer(self.comments, many=True, context=context).data
+        self.assertEqual([c["vote_status"] for c in data], [UPVOTE, DOWNVOTE, None])
+        self.assertEqual([c["liked"] for c in data], [False, False, True])
+        # Unapproved avatars are only visible to their owner
+        self.assertEqual(data[0]["avatar"], f"{CLOUDFRONT_DOMAIN}/avatar.png")
+        data = CommentSerializer(self.comments, many=True).data
+        self.assertIsNone(data[0]["avatar"])
+
+    def test_post_comments_resolved_with_the_page(self):
+        viewer = factories.UserProfileFactory()
+        blocked = factories.UserProfileFactory().user
+        viewer.blocked_users.add(blocked)
+        posts = [
+            Post.objects.create(
+                user=self.user, holiday=self.holiday, timestamp=timezone.now()
+            )
+            for _ in range(2)
+        ]
+        on_post = {}
+        for post in posts:
+            on_post[post] = [
+                Comment.objects.create(
+                    content="comment",
+                    holiday=self.holiday,
+                    user=user,
+                    parent_post=post,
+                    timestamp=timezone.now(),
+                )
+                for user in (self.user, blocked, self.user)
+            ]
+        viewer.reported_comments.add(on_post[posts[1]][2])
+        posts = list(Post.objects.select_related("user", "holiday").order_by("id"))
+
+        # Post likes, blocked and reported once for the page, then comments,
+        # replies, votes, likes and profiles
+        with self.assertNumQueries(10):
+            context = build_serializer_context(viewer.user.username, posts=posts)
+        with self.assertNumQueries(0):
+            data = PostSerializer(posts, many=True, context=context).data
+        self.assertEqual(
+            [[c["id"] for c in p["comments"]] for p in data],
+            [
+                [on_post[posts[0]][2].id, on_post[posts[0]][0].id],
+                [on_post[posts[1]][0].id],
+            ],
+        )
+
+    def test_replies_resolved_with_the_page(self):
+        def reply(parent, **kwargs):
+            return Comment.objects.create(
+                content="reply",
+                holiday=self.holiday,
+                user=self.user,
+                parent=parent,
+                timestamp=timezone.now(),
+                **kwargs,
+            )
+
+        first, second, _ = self.comments
+        low = reply(first)
+        top = reply(first, votes=2)
+        nested = reply(top)
+        deleted = reply(second, deleted=True)
+        reply(deleted)
+        nested.user_likes.add(self.user)
+
+        with self.assertNumQueries(4):
+            context = build_serializer_context(
+                self.user.username, comments=self.comments
+            )
+        with self.assertNumQueries(0):
+            data = CommentSerializer(self.comments, many=True, context=context).data
+        self.assertEqual(
+            [r["id"] for r in data[0]["replies"]], [top.id, nested.id, low.id]
+        )
+        self.assertEqual(
+            [r["id"] for r in data[0]["replies"][0]["replies"]], [nested.id]
+        )
+        self.assertTrue(data[0]["replies"][1]["liked"])
+        self.assertEqual(data[1]["replies"], [])
+
+
+class ProfileCounterTest(APITestCase):
+    def setUp(self):
+        self.profile = factories.UserProfileFactory()
+        self.user = self.profile.user
+
+    def test_counters_follow_comments_and_holidays(self):
+        holiday = Holiday.objects.create(
+            name="Submitted Day",
+            description="A user submitted day",
+            date=timezone.now(),
+            creator=self.user,
+            active=False,
+        )
+        comment = Comment.objects.create(
+            content="comment",
+            holiday=holiday,
+            user=self.user,
+            timestamp=timezone.now(),
+        )
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.num_comments, 1)
+        self.assertEqual(self.profile.holiday_submissions, 1)
+        self.assertEqual(self.profile.approved_holidays, 0)
+
+        # Approval, saving again doesn't count twice. Saving other fields
+        # first, like award_and_notify_user_for_holiday does, counts nothing.
+        holiday = Holiday.objects.get(id=holiday.id)
+        holiday.active = True
+        holiday.creator_awarded = True
+        holiday.save(update_fields=["creator_awarded"])
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.approved_holidays, 0)
+        holiday.save()
+        holiday.save()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.approved_holidays, 1)
+
+        comment.delete()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.num_comments, 0)
+
+        # Reconciling leaves correct counters alone and fixes drifted ones
+        UserProfile.objects.filter(id=self.profile.id).update(num_comments=7)
+        self.assertEqual(sync_counters(), (True, "Fixed counters for 1 profiles"))
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.num_comments, 0)
+        self.assertEqual(self.profile.holiday_submissions, 1)
+
+        holiday.delete()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.holiday_submissions, 0)
+
+    def test_profile_updates_leave_counters_alone(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                "/user/", {"username": self.user.username, "logout": "true"}
+            )
+        updates = [
+            q["sql"] for q in queries if q["sql"].startswith('UPDATE "api_userprofile"')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"logged_out"', updates[0])
+        self.assertNotIn('"confetti"', updates[0])
+        self.assertNotIn('"num_comments"', updates[0])
+        self.assertEqual(self.profile.approved_holidays, 0)
+
+
+class UnreadCounterTest(APITestCase):
+    def setUp(self):
+        self.profile = factories.UserProfileFactory()
+        self.user = self.profile.user
+        self.other = factories.UserProfileFactory().user
+
+    def unread(self):
+        self.profile.refresh_from_db()
+        return self.profile.unread_notifications
+
+    def test_counter_follows_notifications(self):
+        for n_id in (1, 2, 3):
+            add_notification(n_id, COMMENT_NOTIFICATION, self.user, "hi", "title")
+        # Same comment, someone else's notification
+        add_notification(1, COMMENT_NOTIFICATION, self.other, "hi", "title")
+        self.assertEqual(self.unread(), 3)
+
+        data = {
+            "username": self.user.username,
+            "mark_read_id": 1,
+            "mark_read_type": "comment",
+        }
+        response = self.client.post("/notifications/", data)
+        self.assertEqual(response.data["unread"], 2)
+        # Marking read again doesn't count twice
+        response = self.client.post("/notifications/", data)
+        self.assertEqual(response.data["unread"], 2)
+        self.assertFalse(
+            UserNotifications.objects.get(user=self.other, notification_id=1).read
+        )
+
+        UserNotifications.objects.get(user=self.user, notification_id=2).delete()
+        self.assertEqual(self.unread(), 1)
+
+        data = {"username": self.user.username, "clear_notifications": True}
+        response = self.client.post("/notifications/", data)
+        self.assertEqual(response.data["unread"], 1)
+        self.assertEqual(self.unread(), 0)
+
+        UserProfile.objects.filter(id=self.profile.id).update(unread_notifications=5)
+        add_notification(4, COMMENT_NOTIFICATION, self.user, "hi", "title")
+        call_command("sync_counters")
+        self.assertEqual(self.unread(), 1)
+
+    def test_notifications_added_once(self):
+        self.assertIsNotNone(
+            add_notification(1, LIKE_NOTIFICATION, self.user, "hi", "title")
+        )
+        self.assertIsNone(
+            add_notification(1, LIKE_NOTIFICATION, self.user, "hi", "title")
+        )
+        users = [self.user.id, self.other.id]
+        self.assertEqual(
+            add_notifications(1, LIKE_NOTIFICATION, users, "hi", "title"),
+            [self.other.id],
+        )
+        self.assertEqual(
+            add_notifications(1, LIKE_NOTIFICATION, users, "hi", "title"), []
+        )
+        self.assertEqual(UserNotifications.objects.count(), 2)
+        self.assertEqual(self.unread(), 1)
+
+    def test_concurrent_add_counted_once(self):
+        add_notification(1, LIKE_NOTIFICATION, self.user, "hi", "title")
+        users = [self.user.id, self.other.id]
+        # Added by someone else after add_notifications looked
+        with mock.patch.object(
+            UserNotifications.objects,
+            "filter",
+            return_value=UserNotifications.objects.none(),
+        ):
+            self.assertEqual(
+                add_notifications(1, LIKE_NOTIFICATION, users, "hi", "title"),
+                [self.other.id],
+            )
+        self.assertEqual(UserNotifications.objects.count(), 2)
+        self.assertEqual(
+            list(
+                UserProfile.objects.filter(user_id__in=users)
+                .order_by("user_id")
+                .values_list("unread_notifications", flat=True)
+            ),
+            [1, 1],
+        )
+
+    def test_bulk_mark_read(self):
+        for n_id in (1, 2, 3):
+            add_notification(n_id, COMMENT_NOTIFICATION, self.user, "hi", "title")
+            add_notification(n_id, LIKE_NOTIFICATION, self.user, "hi", "title")
+        add_notification(1, COMMENT_NOTIFICATION, self.other, "hi", "title")
+
+        data = {
+            "username": self.user.username,
+            "notifications": ["comment:1", "like:2", "like:9"],
+        }
+        # User, one UPDATE and its counter adjustment in a savepoint, unread count
+        with self.assertNumQueries(6):
+            response = self.client.post("/notifications/read/", data)
+        self.assertEqual(response.data["unread"], 4)
+        self.assertEqual(UserNotifications.objects.filter(read=True).count(), 2)
+
+        # Everything up to the second comment notification
+        up_to_id = UserNotifications.objects.get(
+            user=self.user, notification_type=COMMENT_NOTIFICATION, notification_id=2
+        ).id
+        data = {"username": self.user.username, "up_to_id": up_to_id}
+        response = self.client.post("/notifications/read/", data)
+        self.assertEqual(response.data["unread"], 2)
+        self.assertEqual(self.unread(), 2)
+        self.assertFalse(UserNotifications.objects.get(user=self.other).read)
+
+        data = {"username": self.user.username, "notifications": ["news:1"]}
+        response = self.client.post("/notifications/read/", data)
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+
+class NotificationInboxTest(APITestCase):
+    def test_entities_resolved_per_type(self):
+        user = factories.UserProfileFactory().user
+        author = factories.UserProfileFactory(
+            profile_image="author.png", avatar_approved=True
+        ).user
+        holiday = Holiday.objects.create(
+            name="Inbox Day", description="A day", date=timezone.now()
+        )
+        post = Post.objects.create(
+            user=author, holiday=holiday, content="@user", timestamp=timezone.now()
+        )
+        comment = Comment.objects.create(
+            user=author, holiday=holiday, content="@user", timestamp=timezone.now()
+        )
+        for n_id, n_type in (
+            (comment.id, COMMENT_NOTIFICATION),
+            (post.id, POST_NOTIFICATION),
+            (post.id, LIKE_NOTIFICATION),
+            (comment.id, LIKE_COMMENT_NOTIFICATION),
+            (holiday.id, HOLIDAY_NOTIFICATION),
+            (post.id + 100, POST_NOTIFICATION),
+        ):
+            add_notification(n_id, n_type, user, "content", "title")
+
+        # User, inbox, news, unread count, then one query per model and profiles
+        with self.assertNumQueries(8):
+            response = self.client.post("/notifications/", {"username": user.username})
+        results = response.data["results"]
+        self.assertEqual(
+            [n["holiday_id"] for n in results], [None] + [holiday.id] * 5,
+        )
+        avatar = f"{CLOUDFRONT_DOMAIN}/author.png"
+        self.assertEqual(
+            [n["icon"] for n in results], [None, None, None, None, avatar, avatar]
+        )
+
+    @override_settings(NOTIFICATION_PAGE_SIZE=2)
+    def test_inbox_and_news_paged_together(self):
+        user = factories.UserProfileFactory().user
+        other = factories.UserProfileFactory().user
+        for n_id, owner in enumerate((user, None, other, user, None)):
+            n_type = NEWS_NOTIFICATION if owner is None else COMMENT_NOTIFICATION
+            UserNotifications.objects.create(
+                notification_id=n_id,
+                notification_type=n_type,
+                user=owner,
+                content="",
+                title="",
+            )
+
+        pages, cursor = [], None
+        for _ in range(2):
+            data = {"username": user.username}
+            if cursor:
+                data["cursor"] = cursor
+            response = self.client.post("/notifications/", data).data
+            pages.append([n["notification_id"] for n in response["results"]])
+            cursor = response["next_cursor"]
+        self.assertEqual(pages, [[4, 3], [1, 0]])
+        self.assertIsNone(cursor)
+
+        response = self.client.get("/notifications/", {"cursor": "nope"})
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+
+class MentionFanoutTest(APITransactionTestCase):
+    def setUp(self):
+        # Run the fan-out in the test without a broker
+        eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", eager)
+
+    def test_mentions_notified_after_commit(self):
+        author = factories.UserProfileFactory(user__username="author").user
+        mentioned = [
+            factories.UserProfileFactory(user__username=username).user
+            for username in ("alice", "bob")
+        ]
+        holiday = Holiday.objects.create(
+            name="Mention Day", description="A day", date=timezone.now()
+        )
+        data = {
+            "username": author.username,
+            "holiday": holiday.id,
+            "content": "@alice @bob @nobody @author hello",
+        }
+        pushed = []
+
+        def deliver(intents):
+            # Only alice has a device to push to
+            intents = list(intents)
+            pushed.extend(intents)
+            return {i.user_id: i.user_id == mentioned[0].id for i in intents}
+
+        with mock.patch("api.tasks.deliver_pushes", side_effect=deliver), mock.patch(
+            "api.tasks.email_mention", return_value=True
+        ) as email_mention:
+            response = self.client.post("/comments/", data)
+            # Mentioned again by an edit, not notified twice
+            notify_mentions.delay(COMMENT_NOTIFICATION, response.data["id"])
+
+        # Pushed in one batch, emailing whoever it didn't reach
+        self.assertEqual(
+            sorted(intent.user_id for intent in pushed), [u.id for u in mentioned]
+        )
+        self.assertEqual(pushed[0].title, "author mentioned you on Mention Day")
+        self.assertEqual(
+            [call[0][0] for call in email_mention.call_args_list], mentioned[1:]
+        )
+        notifications = UserNotifications.objects.order_by("user_id")
+        self.assertEqual([n.user for n in notifications], mentioned)
+        self.assertEqual(notifications[0].title, "author on Mention Day")
+        self.assertEqual(
+            list(
+                UserProfile.objects.filter(user__in=mentioned).values_list(
+                    "unread_notifications", flat=True
+                )
+            ),
+            [1, 1],
+        )
+
+
+class LikeCoalescingTest(APITestCase):
+    def test_likes_merged_into_one_notification(self):
+        author = factories.UserProfileFactory().user
+        holiday = Holiday.objects.create(
+            name="Like Day", description="A day", date=timezone.now()
+        )
+        post = Post.objects.create(
+            user=author, holiday=holiday, timestamp=timezone.now()
+        )
+        likers = [
+            factories.UserProfileFactory(user__username=username).user
+            for username in ("alice", "bob", "carol")
+        ]
+        for liker in likers:
+            post.user_likes.add(liker)
+            queue_like_notification(post, liker)
+        queue_like_notification(post, likers[0])
+        post.user_likes.remove(likers[2])
+        cancel_like_notification(post, likers[2])
+
+        self.assertEqual(flush_like_notifications(60), [])
+        intents = flush_like_notifications(0)
+        self.assertEqual(len(intents), 1)
+        self.assertEqual(intents[0].user_id, author.id)
+        notification = UserNotifications.objects.get()
+        self.assertEqual(
+            notification.content, "bob and 1 other liked your post on Like Day"
+        )
+        self.assertEqual(intents[0].body, notification.content)
+
+        # Read, then liked again, replaces the notification with an unread one
+        mark_notifications_read(author.id)
+        post.user_likes.add(likers[2])
+        queue_like_notification(post, likers[2])
+        flush_like_notifications(0)
+        notification = UserNotifications.objects.get()
+        # Still counting the likes notified before
+        self.assertEqual(
+            notification.content, "carol and 2 others liked your post on Like Day"
+        )
+        self.assertFalse(notification.read)
+        self.assertEqual(get_unread_count(author.id), 1)
+        self.assertFalse(PendingLike.objects.exists())
+
+    def test_likes_kept_when_notifying_fails(self):
+        post = Post.objects.create(
+            user=factories.UserProfileFactory().user,
+            holiday=Holiday.objects.create(
+                name="Like Day", description="A day", date=timezone.now()
+            ),
+            timestamp=timezone.now(),
+        )
+        queue_like_notification(post, factories.UserProfileFactory().user)
+        with mock.patch(
+            "holidaily.helpers.notification_helpers.build_push_intent",
+            side_effect=RuntimeError,
+        ):
+            with self.assertRaises(RuntimeError):
+                flush_like_notifications(0)
+        self.assertTrue(PendingLike.objects.exists())
+        self.assertFalse(UserNotifications.objects.exists())
+        self.assertEqual(len(flush_like_notifications(0)), 1)
+
+
+class UserSerializerTest(APITestCase):
+    def test_profile_loaded_once_per_page(self):
+        for confetti in range(3):
+            factories.UserProfileFactory(confetti=confetti)
+        users = UserSerializer.setup_eager_loading(User.objects.order_by("id"))
+
+        with self.assertNumQueries(2):
+            data = UserSerializer(users, many=True).data
+        self.assertEqual([u["confetti"] for u in data], [0, 1, 2])
+        self.assertEqual(data[0]["last_online"], "a while ago")
+
+
+class HolidayCommentCountTest(APITestCase):
+    def test_num_comments_annotated(self):
+        user = factories.UserFactory()
+        holidays = [
+            Holiday.objects.create(
+                name=f"Day {i}", description="A day", date=timezone.now()
+            )
+            for i in range(3)
+        ]
+        for deleted in (False, False, True):
+            Post.objects.create(
+                user=user,
+                holiday=holidays[0],
+                timestamp=timezone.now(),
+                deleted=deleted,
+            )
+
+        with self.assertNumQueries(1):
+            data = HolidaySerializer(
+                Holiday.objects.with_num_comments().order_by("id"), many=True
+            ).data
+        self.assertEqual([h["num_comments"] for h in data], [2, 0, 0])
+
+
+class CelebratingTest(APITestCase):
+    def test_vote_refreshes_celebrated_holidays(self):
+        user = factories.UserFactory()
+        holiday = Holiday.objects.create(
+            name="Test Day", description="A day for testing", date=timezone.now()
+        )
+        self.assertEqual(get_celebrated_holiday_ids(user.username), set())
+
+        response = self.client.post(
+            f"/holidays/{holiday.id}/", {"vote": UP, "username": user.username}
+        )
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(get_celebrated_holiday_ids(user.username), {holiday.id})
+        with self.assertNumQueries(0):
+            get_celebrated_holiday_ids(user.username)
+
+
+@override_settings(HOLIDAY_PAGE_SIZE=2)
+class HolidayFeedCursorTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        today = timezone.now().date()
+        self.upcoming = [
+            Holiday.objects.create(
+                name=f"Upcoming Day {i}",
+                description="A day for testing",
+                date=today + timedelta(days=i // 2),
+            )
+            for i in range(5)
+        ]
+        self.past = [
+            Holiday.objects.create(
+                name=f"Past Day {i}",
+                description="A day for testing",
+                date=today - timedelta(days=1 + i // 2),
+            )
+            for i in range(3)
+        ]
+
+    def walk_feed(self, **params):
+        names, cursor = [], ""
+        while cursor is not None:
+            response = self.client.post("/holidays/", {"cursor": cursor, **params})
+            self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+            names.extend(h["name"] for h in response.data["results"])
+            cursor = response.data["next_cursor"]
+        return names
+
+    def test_upcoming_feed_pages_by_cursor(self):
+        self.assertEqual(self.walk_feed(), [h.name for h in self.upcoming])
+
+    def test_past_feed_pages_by_cursor(self):
+        # Newest first, ties broken by newest id
+        self.assertEqual(
+            self.walk_feed(past=True), ["Past Day 1", "Past Day 0", "Past Day 2"],
+        )
+
+    def test_new_holiday_does_not_shift_pages(self):
+        response = self.client.post("/holidays/", {"cursor": "", "past": True})
+        first_page = [h["name"] for h in response.data["results"]]
+        # Sorts ahead of the cursor, an offset page would repeat a holiday
+        Holiday.objects.create(
+            name="Late Addition",
+            description="A day for testing",
+            date=self.past[0].date,
+        )
+        response = self.client.post(
+            "/holidays/", {"cursor": response.data["next_cursor"], "past": True}
+        )
+        second_page = [h["name"] for h in response.data["results"]]
+        self.assertEqual(first_page, ["Past Day 1", "Past Day 0"])
+        self.assertEqual(second_page, ["Past Day 2"])
+
+    def test_invalid_cursor(self):
+        response = self.client.post("/holidays/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+    def test_bad_positions_never_reach_the_cache_key(self):
+        # Errors where memcached would, instead of only warning
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", CacheKeyWarning)
+            for data in (
+                {"cursor": "not a cursor\n" * 40},
+                {"page": "1 OR 1"},
+            ):
+                response = self.client.post("/holidays/", data)
+                self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+
+class HolidayVisibilityTest(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_visible_follows_approval(self):
+        creator = factories.UserProfileFactory().user
+        holiday = Holiday.objects.create(
+            name="Submitted Day",
+            description="A day for testing",
+            date=timezone.now() + timedelta(days=1),
+            creator=creator,
+            active=False,
+        )
+        self.assertFalse(Holiday.objects.get(id=holiday.id).visible)
+        response = self.client.post("/holidays/", {"page": 0})
+        self.assertEqual(response.data["results"], [])
+
+        holiday.active = True
+        holiday.save(update_fields=["active"])
+        self.assertTrue(Holiday.objects.get(id=holiday.id).visible)
+        response = self.client.post("/holidays/", {"page": 0})
+        self.assertEqual(
+            [h["name"] for h in response.data["results"]], ["Submitted Day"]
+        )
+
+    def test_regular_holidays_are_visible(self):
+        holiday = Holiday.objects.create(
+            name="Regular Day",
+            description="A day for testing",
+            date=timezone.now(),
+            active=False,
+        )
+        self.assertTrue(Holiday.objects.get(id=holiday.id).visible)
+
+
+class HolidaySearchTest(APITestCase):
+    def setUp(self):
+        today = timezone.now()
+        self.pizza = Holiday.objects.create(
+            name="National Pizza Day", description="Eat a slice", date=today
+        )
+        self.pie = Holiday.objects.create(
+            name="Pie Day", description="Pizza pie counts too", date=today
+        )
+        self.chocolate = Holiday.objects.create(
+            name="Chocolate Day", description="Dessert first", date=today
+        )
+        get_search_backend().rebuild(Holiday.objects.all())
+
+    def search(self, term):
+        return get_search_backend().search(term, 10)
+
+    def test_name_matches_rank_above_description(self):
+        self.assertEqual(self.search("pizza"), [self.pizza.id, self.pie.id])
+
+    def test_prefix_and_typo_matches(self):
+        self.assertEqual(self.search("choc"), [self.chocolate.id])
+        self.assertEqual(self.search("chocolte"), [self.chocolate.id])
+        self.assertEqual(self.search("dessert"), [self.chocolate.id])
+
+    def test_stopwords_are_ignored(self):
+        self.assertEqual(self.search("national day"), [])
+
+    def test_index_follows_saves(self):
+        self.chocolate.name = "Cocoa Day"
+        self.chocolate.save()
+        get_search_backend().index(self.chocolate)
+        self.assertEqual(self.search("chocolate"), [])
+        self.assertEqual(self.search("cocoa"), [self.chocolate.id])
+
+    def test_search_endpoint_hides_unapproved(self):
+        submitted = Holiday.objects.create(
+            name="Pizza Party Day",
+            description="Unapproved",
+            date=timezone.now(),
+            creator=factories.UserProfileFactory().user,
+            active=False,
+        )
+        get_search_backend().index(submitted)
+        response = self.client.post("/search/", {"search": "pizza"})
+        self.assertEqual(
+            [h["name"] for h in response.data["results"]],
+            ["National Pizza Day", "Pie Day"],
+        )
+
+
+class AutocompleteTest(APITestCase):
+    def setUp(self):
+        self.index = HolidayAutocompleteIndex()
+        self.index.rebuild(
+            [(1, "National Pizza Day", 5), (2, "Pie Day", 10), (3, "Pizza Party", 1)]
+        )
+
+    def suggest(self, prefix):
+        return [s.name for s in self.index.suggest(prefix, 10)]
+
+    def test_names_starting_with_prefix_come_first(self):
+        self.assertEqual(self.suggest("piz"), ["Pizza Party", "National Pizza Day"])
+        self.assertEqual(
+            self.suggest("P"), ["Pie Day", "Pizza Party", "National Pizza Day"]
+        )
+        self.assertEqual(self.suggest("national piz"), ["National Pizza Day"])
+        self.assertEqual(self.suggest("day"), [])
+
+    def test_update_applies_changes(self):
+        holiday = Holiday(id=2, name="Cake Day", visible=True, votes=10)
+        self.index.update(holiday.id, holiday, None)
+        self.assertEqual(self.suggest("pie"), [])
+        self.assertEqual(self.suggest("cake"), ["Cake Day"])
+
+        holiday.visible = False
+        self.index.update(holiday.id, holiday, None)
+        self.assertEqual(self.suggest("cake"), [])
+        self.index.update(1, None, None)
+        self.assertEqual(self.suggest("piz"), ["Pizza Party"])
+
+    def test_memory_budget_keeps_most_voted(self):
+        with override_settings(AUTOCOMPLETE_MEMORY_BUDGET=self.index.size - 1):
+            self.index.rebuild(
+                [
+                    (2, "Pie Day", 10),
+                    (1, "National Pizza Day", 5),
+                    (3, "Pizza Party", 1),
+                ]
+            )
+        self.assertEqual(self.suggest("piz"), ["National Pizza Day"])
+
+    def test_endpoint_does_not_query(self):
+        Holiday.objects.create(
+            name="Donut Day", description="A day for testing", date=timezone.now()
+        )
+        autocomplete_index.rebuild(
+            [(h.id, h.name, h.votes) for h in Holiday.objects.all()]
+        )
+        with self.assertNumQueries(0):
+            response = self.client.get("/autocomplete/", {"q": "don"})
+        self.assertEqual(response.data["results"][0]["name"], "Donut Day")
+
+
+class FeedCacheTest(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = factories.UserProfileFactory().user
+        self.holiday = Holiday.objects.create(
+            name="Cached Day", description="A day for testing", date=timezone.now()
+        )
+        UserHolidayVotes.objects.create(user=self.user, holiday=self.holiday, choice=UP)
+
+    def feed(self, **params):
+        response = self.client.post("/holidays/", {"page": 0, **params})
+        return response.data["results"]
+
+    def test_celebrating_is_per_user(self):
+        self.assertFalse(self.feed()[0]["celebrating"])
+        with self.assertNumQueries(0):
+            self.feed()
+        self.assertTrue(self.feed(username=self.user.username)[0]["celebrating"])
+
+    def test_saves_invalidate_feed(self):
+        self.assertEqual(self.feed()[0]["num_comments"], 0)
+        # Vote counts are left to expire
+        holiday = Holiday.objects.get(id=self.holiday.id)
+        holiday.votes += 1
+        holiday.save()
+        self.assertEqual(self.feed()[0]["votes"], 0)
+
+        Post.objects.create(
+            user=self.user, holiday=self.holiday, timestamp=timezone.now()
+        )
+        self.assertEqual(self.feed()[0]["num_comments"], 1)
+
+        holiday.name = "Renamed Day"
+        holiday.save()
+        self.assertEqual(self.feed()[0]["name"], "Renamed Day")
+
+
+class HolidayPostsCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.holiday = Holiday.objects.create(
+            name="Posting Day", description="A day for testing", date=now
+        )
+        self.viewer = factories.UserProfileFactory(profile_image="viewer.jpg")
+        blocked = factories.UserProfileFactory().user
+        other = factories.UserProfileFactory(
+            profile_image="other.jpg", avatar_approved=True
+        ).user
+        self.viewer.blocked_users.add(blocked)
+
+        posts = {}
+        for user in (self.viewer.user, blocked, other):
+            posts[user] = Post.objects.create(
+                user=user, holiday=self.holiday, timestamp=now, content="Hi"
+            )
+        reported = Post.objects.create(user=other, holiday=self.holiday, timestamp=now)
+        self.viewer.reported_posts.add(reported)
+        posts[other].user_likes.add(self.viewer.user)
+
+        comments = [
+            Comment.objects.create(
+                user=user,
+                holiday=self.holiday,
+                parent_post=posts[other],
+                timestamp=now,
+                content="Reply",
+            )
+            for user in (self.viewer.user, blocked, other)
+        ]
+        reply = Comment.objects.create(
+            user=blocked,
+            holiday=self.holiday,
+            parent=comments[2],
+            timestamp=now,
+            content="Nested",
+        )
+        reply.user_likes.add(self.viewer.user)
+        UserCommentVotes.objects.create(
+            user=self.viewer.user, comment=comments[2], choice=DOWN
+        )
+
+    def uncached_posts(self, username):
+        """ PostList before caching """
+        posts = Post.objects.filter(holiday=self.holiday, deleted=False)
+        if username:
+            profile = UserProfile.objects.get(user__username=username)
+            posts = posts.exclude(user__in=profile.blocked_users.all()).exclude(
+                id__in=profile.reported_posts.all()
+            )
+        posts = list(posts.order_by("-id"))
+        return PostSerializer(
+            posts, many=True, context=build_serializer_context(username, posts=posts)
+        ).data
+
+    def test_matches_uncached_posts(self):
+        warm_holiday_caches(self.holiday.id)
+        for username in (None, self.viewer.user.username):
+            params = {"holiday_id": self.holiday.id}
+            if username:
+                params["username"] = username
+            response = self.client.get("/posts/", params)
+            self.assertEqual(
+                json.loads(json.dumps(response.data["results"])),
+                json.loads(json.dumps(self.uncached_posts(username))),
+            )
+        posts = {p["user"]: p for p in response.data["results"]}
+        self.assertEqual(len(posts), 2)
+        self.assertEqual(posts[self.viewer.user.username]["avatar"][-10:], "viewer.jpg")
+        comments = list(posts.values())[0]["comments"]
+        self.assertEqual(len(comments), 2)
+        self.assertEqual(comments[0]["vote_status"], DOWNVOTE)
+        self.assertTrue(comments[0]["replies"][0]["liked"])
+
+    def test_warm_cache_serves_without_queries(self):
+        warm_holiday_caches(self.holiday.id)
+        with self.assertNumQueries(0):
+            self.client.get("/posts/", {"holiday_id": self.holiday.id})
+            self.client.get(f"/holidays/{self.holiday.id}/")
+
+    def test_flushed_likes_outdate_cached_posts(self):
+        get_counter_backend().reset()
+        post = Post.objects.get(user=self.viewer.user)
+
+        def cached_likes():
+            posts = self.client.get("/posts/", {"holiday_id": self.holiday.id})
+            return {p["id"]: p["likes"] for p in posts.data["results"]}[post.id]
+
+        self.assertEqual(cached_likes(), 0)
+        incr_counter(Post, post.id, "likes", 2)
+        flush_counters()
+        self.assertEqual(cached_likes(), 2)
+
+
+class SingleFlightTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stale_value_served_while_rebuilding(self):
+        single_flight("sf_test", lambda: "old", 60, version=1)
+        # Someone else is rebuilding version 2
+        cache.add("sf_test_lock", 1)
+        self.assertEqual(single_flight("sf_test", lambda: "new", 60, version=2), "old")
+        cache.delete("sf_test_lock")
+        self.assertEqual(single_flight("sf_test", lambda: "new", 60, version=2), "new")
+
+
+@override_settings(PUSH_BACKEND="holidaily.helpers.push_helpers.FakePushBackend")
+class StaggeredPushTest(APITestCase):
+    def setUp(self):
+        get_push_backend().reset()
+
+    def test_chunks_resume_without_resending(self):
+        holiday = Holiday.objects.create(
+            name="Push Day", description="A day for testing", date=timezone.now()
+        )
+        devices = [
+            APNSDevice.objects.create(registration_id=token, active=active)
+            for token, active in (
+                ("a", True),
+                ("b", True),
+                ("a", True),
+                ("c", True),
+                ("d", False),
+            )
+        ]
+        ios_run = [r for r in start_push_runs(holiday, 60, 2) if r.platform == IOS][0]
+
+        self.assertEqual(claim_push_chunk(ios_run.id), [devices[0].id, devices[1].id])
+        # Token "a" was already sent to
+        self.assertEqual(claim_push_chunk(ios_run.id), [devices[3].id])
+        self.assertIsNone(claim_push_chunk(ios_run.id))
+        ios_run.refresh_from_db()
+        self.assertIsNotNone(ios_run.finished)
+        self.assertEqual(ios_run.sent, 3)
+
+        # Starting again picks up the same, finished run
+        self.assertIn(ios_run, start_push_runs(holiday, 60, 2))
+        self.assertIsNone(claim_push_chunk(ios_run.id))
+
+    def test_finished_run_deletes_only_its_rejected_devices(self):
+        eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", eager)
+        backend = get_push_backend()
+        backend.reject = {"bad"}
+        self.addCleanup(setattr, backend, "reject", set())
+        holiday = Holiday.objects.create(
+            name="Push Day", description="A day for testing", date=timezone.now()
+        )
+        for token, active in (("ok", True), ("bad", True), ("old", False)):
+            APNSDevice.objects.create(registration_id=token, active=active)
+        ios_run = [r for r in start_push_runs(holiday, 60, 1) if r.platform == IOS][0]
+
+        send_daily_push_chunk(ios_run.id, True)
+
+        ios_run.refresh_from_db()
+        self.assertIsNotNone(ios_run.finished)
+        # Deactivated before the run, for some other reason, so kept
+        self.assertEqual(
+            sorted(APNSDevice.objects.values_list("registration_id", flat=True)),
+            ["ok", "old"],
+        )
+
+    def test_badges_count_unread_notifications(self):
+        holiday = Holiday.objects.create(
+            name="Push Day", description="A day for testing", date=timezone.now()
+        )
+        busy = factories.UserProfileFactory().user
+        quiet = factories.UserProfileFactory().user
+        for read in (False, False, False, True):
+            UserNotifications.objects.create(
+                user=busy, notification_type=0, read=read, content="", title=""
+            )
+        devices = [
+            APNSDevice.objects.create(registration_id=token, user=user)
+            for token, user in (("a", busy), ("b", quiet), ("c", None), ("d", busy))
+        ]
+
+        backend = get_push_backend()
+        with self.assertNumQueries(2):
+            send_daily_push_with_badges(APNSDevice, [d.id for d in devices], holiday)
+        # One batch per badge, nobody gets less than the holiday itself
+        self.assertEqual(backend.batches, 2)
+        badges = {device_id: badge for _, device_id, _, badge, _ in backend.sent}
+        self.assertEqual(
+            badges,
+            {devices[0].id: 3, devices[1].id: 1, devices[2].id: 1, devices[3].id: 3},
+        )
+
+    def test_pushes_batched_and_rejects_cleaned_up(self):
+        profiles = [factories.UserProfileFactory(platform=IOS) for _ in range(2)]
+        profiles.append(factories.UserProfileFactory(platform=ANDROID))
+        without_device = factories.UserProfileFactory(platform=IOS)
+        flaky = factories.UserProfileFactory(platform=IOS)
+        for profile, token in zip(profiles + [flaky], ("old", "bad", "b", "flaky")):
+            model = GCMDevice if profile.platform == ANDROID else APNSDevice
+            model.objects.create(registration_id=token, user=profile.user)
+        latest = APNSDevice.objects.create(registration_id="a", user=profiles[0].user)
+        # Deactivated earlier, never sent to or counted as rejected
+        APNSDevice.objects.create(
+            registration_id="gone", user=profiles[0].user, active=False
+        )
+
+        backend = FakePushBackend(reject=["bad"], fail=["flaky"])
+        intents = [
+            PushIntent(p.user_id, "title", "body", {"push_type": "rewards"})
+            for p in profiles + [without_device, flaky]
+        ]
+        delivered = deliver_pushes(intents, backend)
+
+        self.assertEqual(
+            delivered,
+            {
+                profiles[0].user_id: True,
+                profiles[1].user_id: False,
+                profiles[2].user_id: True,
+                without_device.user_id: False,
+                flaky.user_id: False,
+            },
+        )
+        # All three iOS users in one batch, only to their latest active device
+        self.assertEqual(backend.batches, 2)
+        self.assertIn(
+            (IOS, latest.id, "title", 0, {"push_type": "rewards", "unread": 0}),
+            backend.sent,
+        )
+        self.assertFalse(APNSDevice.objects.filter(registration_id="bad").exists())
+        # A temporary failure keeps the device
+        self.assertTrue(APNSDevice.objects.filter(registration_id="flaky").exists())
+        self.assertTrue(APNSDevice.objects.filter(registration_id="gone").exists())
+        self.assertEqual(
+            list(
+                UserProfile.objects.filter(device_active=False)
+                .order_by("id")
+                .values_list("id", flat=True)
+            ),
+            [profiles[1].id, without_device.id],
+        )
+
+    def test_push_results_decide_failures(self):
+        user = factories.UserProfileFactory().user
+        ios = {
+            token: APNSDevice.objects.create(registration_id=token, user=user).id
+            for token in ("ok", "gone", "bad", "busy")
+        }
+        apns_results = [
+            {
+                "ok": "Success",
+                "gone": ("Unregistered", 1600000000),
+                "bad": "BadDeviceToken",
+                "busy": "TooManyRequests",
+            }
+        ]
+        with mock.patch(
+            "push_notifications.models.APNSDeviceQuerySet.send_message",
+            return_value=apns_results,
+        ):
+            failed = DjangoPushBackend().send(
+                APNSDevice, list(ios.values()), "title", "body", 0, {}
+            )
+        self.assertEqual(failed, {ios["gone"], ios["bad"], ios["busy"]})
+        # Only tokens that will never work again are deactivated
+        self.assertEqual(
+            set(APNSDevice.objects.filter(active=False).values_list("id", flat=True)),
+            {ios["gone"], ios["bad"]},
+        )
+
+        android = {
+            token: GCMDevice.objects.create(registration_id=token, user=user).id
+            for token in ("ok", "down")
+        }
+        fcm_response = {
+            "failure": 1,
+            "results": [
+                {"message_id": "1", "original_registration_id": "ok"},
+                {"error": "Unavailable", "original_registration_id": "down"},
+            ],
+        }
+        with mock.patch(
+            "push_notifications.models.GCMDeviceQuerySet.send_message",
+            return_value=[fcm_response],
+        ):
+            failed = DjangoPushBackend().send(
+                GCMDevice, list(android.values()), "title", "body", 0, {}
+            )
+        self.assertEqual(failed, {android["down"]})
+
+    def test_token_bucket_spreads_sends(self):
+        cache.clear()
+        bucket = TokenBucket("test_bucket", rate=10, capacity=5)
+        self.assertEqual(bucket.take(5), 0)
+        self.assertAlmostEqual(bucket.take(5), 0.5, places=1)
+        self.assertAlmostEqual(bucket.take(5), 1.0, places=1)
+
+
+class CounterServiceTest(APITestCase):
+    def setUp(self):
+        get_counter_backend().reset()
+        self.author = factories.UserProfileFactory()
+        self.liker = factories.UserProfileFactory()
+        self.holiday = Holiday.objects.create(
+            name="Count Day", description="A day", date=timezone.now()
+        )
+        self.post = Post.objects.create(
+            user=self.author.user, holiday=self.holiday, timestamp=timezone.now()
+        )
+
+    def test_likes_buffered_until_flush(self):
+        response = self.client.patch(
+            f"/posts/{self.post.id}/",
+            {
+                "like": "true",
+                "likes": 100,
+                "device_id": self.liker.device_id,
+                "username": self.liker.user.username,
+            },
+            format="json",
+        )
+        self.assertEqual(response.json()["likes"], 1)
+        self.post.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual((self.post.likes, self.author.confetti), (0, 0))
+        self.assertEqual(get_counter(self.author, "confetti"), 1)
+
+        self.assertEqual(flush_counters(), 2)
+        self.post.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual((self.post.likes, self.author.confetti), (1, 1))
+        self.assertEqual(get_counter(self.author, "confetti"), 1)
+
+    def test_reads_include_pending_deltas(self):
+        cache.clear()
+        comment = Comment.objects.create(
+            user=self.author.user,
+            holiday=self.holiday,
+            parent_post=self.post,
+            timestamp=timezone.now(),
+        )
+        # Cached before the increments
+        self.client.get(f"/holidays/{self.holiday.id}/")
+        self.client.get("/posts/", {"holiday_id": self.holiday.id})
+        incr_counter(Holiday, self.holiday.id, "votes", 2)
+        incr_counter(Post, self.post.id, "likes", 1)
+        incr_counter(Comment, comment.id, "votes", 3)
+        incr_counter(Comment, comment.id, "likes", 1)
+
+        holiday = self.client.get(f"/holidays/{self.holiday.id}/").data["results"]
+        self.assertEqual(holiday["votes"], 2)
+        feed = self.client.post("/holidays/", {"page": 0}).data["results"]
+        self.assertEqual(feed[0]["votes"], 2)
+        posts = self.client.get("/posts/", {"holiday_id": self.holiday.id})
+        post = posts.data["results"][0]
+        self.assertEqual(post["likes"], 1)
+        self.assertEqual(
+            (post["comments"][0]["votes"], post["comments"][0]["likes"]), (3, 1)
+        )
+        threads = self.client.post("/comments/", {"holiday": self.holiday.id})
+        thread_comment = threads.data["results"][0][0]
+        self.assertEqual((thread_comment["votes"], thread_comment["likes"]), (3, 1))
+
+        feed_version = cache.get(FEED_VERSION_CACHE_KEY)
+        flush_counters()
+        holiday = self.client.get(f"/holidays/{self.holiday.id}/").data["results"]
+        self.assertEqual(holiday["votes"], 2)
+        # Only the flushed holiday is rebuilt, not every feed page
+        self.assertEqual(cache.get(FEED_VERSION_CACHE_KEY), feed_version)
+
+    def test_overlapping_flushes_write_once(self):
+        incr_counter(Post, self.post.id, "likes", 1)
+        backend = get_counter_backend()
+        claim = backend.claim
+        overlapping = []
+
+        def claim_during_flush():
+            claimed = claim()
+            if not overlapping:
+                # Another worker's flush, starting before this one releases
+                overlapping.append(None)
+                overlapping[0] = flush_counters()
+            return claimed
+
+        with mock.patch.object(backend, "claim", side_effect=claim_during_flush):
+            self.assertEqual(flush_counters(), 1)
+        self.assertEqual(overlapping, [0])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes, 1)
+        self.assertEqual(flush_counters(), 0)
+
+    def test_flush_batches_by_delta(self):
+        comments = [
+            Comment.objects.create(
+                user=self.author.user, holiday=self.holiday, timestamp=timezone.now()
+            )
+            for _ in range(3)
+        ]
+        for comment in comments:
+            incr_counter(Comment, comment.id, "votes", 1)
+        incr_counter(Comment, comments[0].id, "votes", 1)
+        incr_counter(Holiday, self.holiday.id, "votes", -1)
+
+        # Votes +2, votes +1 and the holiday, inside a savepoint, then the
+        # comments' holidays to outdate their cached posts
+        with self.assertNumQueries(6):
+            flush_counters()
+        self.assertEqual([c.votes for c in Comment.objects.order_by("id")], [2, 1, 1])
+        self.assertEqual(Holiday.objects.get().votes, -1)
+        self.assertEqual(flush_counters(), 0)
+
+    def test_writes_through_when_backend_unavailable(self):
+        with mock.patch.object(
+            get_counter_backend(), "incr", side_effect=CounterUnavailable("down")
+        ):
+            incr_counter(UserProfile, self.author.id, "confetti", 3)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.confetti, 3)
+        self.assertEqual(flush_counters(), 0)
+
+
+class LeaderboardTest(APITransactionTestCase):
+    def setUp(self):
+        get_counter_backend().reset()
+        get_leaderboard().reset()
+        self.profiles = [
+            factories.UserProfileFactory(confetti=confetti)
+            for confetti in (5, 30, 10, 20, 0)
+        ]
+        factories.UserProfileFactory(confetti=100, user__is_staff=True)
+        call_command("rebuild_leaderboard")
+
+    def test_top_and_rank_with_neighbors(self):
+        me = self.profiles[0]
+        response = self.client.post(
+            "/users/top", {"requesting_user": me.user.username}
+        ).json()
+        ranked = [self.profiles[i].user.username for i in (1, 3, 2, 0)]
+        self.assertEqual([p["username"] for p in response["results"]], ranked)
+        self.assertEqual([p["rank"] for p in response["results"]], [1, 2, 3, 4])
+        self.assertEqual(response["rank"], 4)
+        self.assertEqual([p["confetti"] for p in response["neighbors"]], [20, 10, 5, 0])
+
+    def test_follows_confetti_changes(self):
+        # Unflushed likes and rewards count straight away
+        incr_counter(UserProfile, self.profiles[0].id, "confetti", 50)
+        late = factories.UserProfileFactory(confetti=25)
+        self.profiles[1].confetti = 1
+        self.profiles[1].save(update_fields=["confetti"])
+
+        entries = get_leaderboard().top(3)
+        self.assertEqual(
+            [(e.profile_id, e.confetti) for e in entries],
+            [(self.profiles[0].id, 55), (late.id, 25), (self.profiles[3].id, 20)],
+        )
+        self.assertEqual(get_leaderboard().around(self.profiles[1].id, 0)[0].rank, 5)
+
+    def test_increments_add_missing_profiles_but_not_staff(self):
+        missing, promoted = self.profiles[4], self.profiles[3]
+        get_leaderboard().remove(missing.id)
+        incr_counter(UserProfile, missing.id, "confetti", 7)
+        self.assertEqual(get_leaderboard().around(missing.id, 0)[0].confetti, 7)
+
+        promoted.user.is_staff = True
+        promoted.user.save()
+        incr_counter(UserProfile, promoted.id, "confetti", 50)
+        self.assertEqual(get_leaderboard().around(promoted.id, 0), [])
+        promoted.user.is_staff = False
+        promoted.user.save()
+        self.assertEqual(get_leaderboard().around(promoted.id, 0)[0].confetti, 70)
+
+    def test_increments_during_rebuild_kept(self):
+        first, last = self.profiles[0], self.profiles[4]
+        read = []
+
+        def pending_while_incremented(model, field, pks):
+            # Both land after the first batch is read, before the last one is
+            if read:
+                add_to_leaderboard(first.id, 9)
+                add_to_leaderboard(last.id, 4)
+            read.append(pks)
+            return {}
+
+        with mock.patch(
+            "holidaily.helpers.leaderboard_helpers.REBUILD_BATCH_SIZE", 3
+        ), mock.patch(
+            "holidaily.helpers.counter_helpers.get_pending_deltas",
+            side_effect=pending_while_incremented,
+        ):
+            self.assertEqual(rebuild_leaderboard(), 5)
+
+        self.assertEqual(len(read), 2)
+        self.assertEqual(get_leaderboard().around(first.id, 0)[0].confetti, 14)
+        # Not read yet when incremented, the read counts it instead
+        self.assertEqual(get_leaderboard().around(last.id, 0)[0].confetti, 0)
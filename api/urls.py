@@ -15,8 +15,10 @@ urlpatterns = [
     path("comments/<int:pk>/", views.CommentDetail.as_view(), name="comment-detail"),
     path("comments/", views.CommentList.as_view(), name="comment-list"),
     path("notifications/", views.UserNotificationsView.as_view(), name="notifications"),
+    path("notifications/read/", views.mark_read_view, name="mark-read"),
     path("news/", views.UserNotificationsView.as_view(), name="news"),
     path("search/", views.HolidayList.as_view(), name="search"),
+    path("autocomplete/", views.autocomplete_view, name="autocomplete"),
     path("pending/", views.UserHolidays.as_view(), name="pending"),
     path("submit/", views.UserHolidays.as_view(), name="submit"),
     path("tweets/", views.tweets_view, name="tweets_view"),
@@ -1,18 +1,53 @@
 import humanize
 import pytz
+from typing import List
+from django.db import transaction
 from django.db.models import Q
 from django.forms import model_to_dict
 from elasticsearch_dsl import Search
 from push_notifications.models import APNSDevice, GCMDevice
 from rest_framework.decorators import api_view
 
+from holidaily.helpers.autocomplete_helpers import autocomplete_index
+from holidaily.helpers.cache_helpers import (
+    get_cached_feed,
+    get_cached_holiday,
+    get_cached_holiday_posts,
+    get_celebrated_holiday_ids,
+    invalidate_celebrated_holidays,
+    with_celebrating,
+)
+from holidaily.helpers.comment_helpers import load_comment_threads
+from holidaily.helpers.counter_helpers import add_pending_counts, incr_counter
+from holidaily.helpers.leaderboard_helpers import (
+    LeaderboardEntry,
+    get_leaderboard_entries,
+)
+from holidaily.helpers.context_helpers import (
+    add_pending_comment_counts,
+    add_pending_post_counts,
+    build_serializer_context,
+    build_notification_context,
+    get_comment_vote_statuses,
+    personalize_posts,
+    ProfileResolver,
+)
 from holidaily.helpers.notification_helpers import (
     send_slack,
-    notify_mentioned_users,
-    notify_liked_user,
+    queue_like_notification,
+    cancel_like_notification,
+    get_unread_count,
+    mark_notifications_read,
 )
+from holidaily.helpers.search_helpers import get_search_backend, SearchUnavailable
 from holidaily.permissions import UpdateObjectPermission
-from holidaily.utils import sync_devices, normalize_time
+from holidaily.utils import (
+    decode_date_cursor,
+    sync_devices,
+    normalize_time,
+    paginate_by_date,
+    paginate_newest_by_id,
+)
 from .models import (
     Holiday,
     UserHolidayVotes,
@@ -49,34 +84,56 @@ from api.constants import (
     SINGLE_DOWN,
     UP_FROM_DOWN,
     DOWN_FROM_UP,
-    DOWNVOTE_ONLY,
-    UPVOTE_ONLY,
     NEWS_NOTIFICATION,
     COMMENT_NOTIFICATION,
-    MAX_COMMENT_DEPTH,
+    POST_NOTIFICATION,
     TRUTHY_STRS,
-    REPLY_DEPTH,
     ANDROID,
     IOS,
     S3_BUCKET_NAME,
     CLOUDFRONT_DOMAIN,
     S3_BUCKET_IMAGES,
     CONFETTI_COOLDOWN_MINUTES,
-    POST_NOTIFICATION,
-    LIKE_NOTIFICATION,
-    LIKE_COMMENT_NOTIFICATION,
+    HOLIDAY_SEARCH_RESULTS,
+    AUTOCOMPLETE_RESULTS,
+    MARK_READ_TYPES,
+    MARK_READ_LIMIT,
+    LEADERBOARD_SIZE,
+    LEADERBOARD_NEIGHBORS,
 )
 from api.exceptions import RequestError, DeniedError
 import re
 import html
+from collections import defaultdict
+from functools import reduce
+from operator import or_
 from django.conf import settings
-from api.tasks import confetti_notification
+from api.tasks import confetti_notification, notify_mentions
 from django.core.cache import cache
 import logging
 
 logger = logging.getLogger("holidaily")
 
 
+def serialize_leaderboard(
+    entries: List[LeaderboardEntry], requesting_user: str
+) -> List[dict]:
+    """ Leaderboard entries as profiles with their rank, 1 query for any number """
+    profiles = UserProfile.objects.select_related("user").in_bulk(
+        [e.profile_id for e in entries]
+    )
+    # Deleted since the leaderboard was last updated
+    entries = [e for e in entries if e.profile_id in profiles]
+    context = {
+        "requesting_user": requesting_user,
+        "confetti": {e.profile_id: e.confetti for e in entries},
+    }
+    data = UserProfileSerializer(
+        [profiles[e.profile_id] for e in entries], many=True, context=context
+    ).data
+    return [{**profile, "rank": e.rank} for profile, e in zip(data, entries)]
+
+
 class UserList(APIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -85,9 +142,10 @@ class UserList(APIView):
         search = request.GET.get("search", None)
         if search:
             # User searching for another user to mention
+            profiles = UserProfile.objects.select_related("user")
             user_list = (
-                UserProfile.objects.filter(user__username=search)
-                or UserProfile.objects.filter(user__username__istartswith=search)[:5]
+                profiles.filter(user__username=search)
+                or profiles.filter(user__username__istartswith=search)[:5]
             )
             serializer = UserProfileSerializer(user_list, many=True)
             results = {"results": serializer.data}
@@ -103,9 +161,12 @@ class UserList(APIView):
         requesting_user = request.POST.get("requesting_user", None)
         device_update = request.POST.get("device_update", None)
         if username:
-            user = User.objects.get(username=username)
-            # Keep device id up to date
-            profile = UserProfile.objects.filter(user=user).first()
+            user = UserSerializer.setup_eager_loading(User.objects).get(
+                username=username
+            )
+            # Keep device id up to date, same instance the serializer reads from
+            profiles = user.userprofile_set.all()
+            profile = profiles[0] if profiles else None
             if profile:
                 update_fields = ["last_launched", "logged_out"]
                 if device_id and device_id != profile.device_id:
@@ -137,7 +198,7 @@ class UserList(APIView):
             if device_update:
                 if profile and device_update != profile.device_id:
                     profile.device_id = device_update
-                    profile.save()
+                    profile.save(update_fields=["device_id"])
                 sync_devices(device_update, platform, user)
 
         elif device_id and platform:
@@ -146,13 +207,22 @@ class UserList(APIView):
             return Response(results)
         elif requesting_user:
             # Confetti leaderboard
-            user_list = UserProfile.objects.filter(
-                confetti__gt=0, user__is_staff=False
-            ).order_by("-confetti")[:50]
-            serializer = UserProfileSerializer(
-                user_list, many=True, context={"requesting_user": requesting_user}
+            profile_id = (
+                UserProfile.objects.filter(user__username=requesting_user)
+                .order_by("id")
+                .values_list("id", flat=True)
+                .first()
             )
-            results = {"results": serializer.data}
+            top, around = get_leaderboard_entries(
+                LEADERBOARD_SIZE, profile_id, LEADERBOARD_NEIGHBORS
+            )
+            results = {"results": serialize_leaderboard(top, requesting_user)}
+            if around is not None:
+                # The requesting user and those either side, if they are ranked
+                results["rank"] = next(
+                    (e.rank for e in around if e.profile_id == profile_id), None
+                )
+                results["neighbors"] = serialize_leaderboard(around, requesting_user)
             return Response(results)
         else:
             raise RequestError("Please provide a username for POST requests")
@@ -203,7 +273,7 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
 
         if logout is not None:
             profile.logged_out = bool(logout)
-            profile.save()
+            profile.save(update_fields=["logged_out"])
             results = {
                 "message": f"{username} logout status changed to: {logout}",
                 "status": HTTP_200_OK,
@@ -217,7 +287,14 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
             profile.premium_token = token
             profile.premium_state = state
             profile.premium = True
-            profile.save()
+            profile.save(
+                update_fields=[
+                    "premium_id",
+                    "premium_token",
+                    "premium_state",
+                    "premium",
+                ]
+            )
             send_slack(
                 f":moneybag: PREMIUM HYPE :moneybag: _{username}_ bought premium!",
                 channel="hype",
@@ -229,7 +306,7 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
             notify = True if notify_cooldown in TRUTHY_STRS else False
             if notify != profile.requested_confetti_alert:
                 profile.requested_confetti_alert = notify
-                profile.save()
+                profile.save(update_fields=["requested_confetti_alert"])
 
             if notify:
                 user_id = profile.user.id
@@ -259,9 +336,9 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
         elif reward:
             # User earned confetti
             reward_amount = request.POST.get("reward", None)
-            profile.confetti += int(reward_amount)
+            incr_counter(UserProfile, profile.id, "confetti", int(reward_amount))
             profile.ad_last_watched = timezone.now()
-            profile.save()
+            profile.save(update_fields=["ad_last_watched"])
 
             if profile.requested_confetti_alert:
                 user_id = profile.user.id
@@ -295,7 +372,7 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
             )
             profile.profile_image = file_name
             profile.avatar_approved = False
-            profile.save()
+            profile.save(update_fields=["profile_image", "avatar_approved"])
             results = {
                 "avatar": f"{CLOUDFRONT_DOMAIN}/{file_name}",
                 "status": HTTP_200_OK,
@@ -318,7 +395,7 @@ class UserProfileDetail(generics.RetrieveUpdateDestroyAPIView):
 
 
 class UserDetail(generics.RetrieveAPIView):
-    queryset = User.objects.all()
+    queryset = UserSerializer.setup_eager_loading(User.objects.all())
     serializer_class = UserSerializer
 
 
@@ -329,21 +406,36 @@ class HolidayList(generics.GenericAPIView):
     def get(self, request):
         top_holidays = request.GET.get("top", None)
         by_name = request.GET.get("name", None)
+        holidays_with_counts = Holiday.objects.with_num_comments()
         if top_holidays:
             # Top Holidays
-            holidays = Holiday.objects.filter(active=True).order_by("-votes")[:10]
+            holidays = holidays_with_counts.filter(active=True).order_by("-votes")[:10]
         elif by_name:
-            holidays = Holiday.objects.filter(name=by_name, active=True)
+            holidays = holidays_with_counts.filter(name=by_name, active=True)
         else:
             # Not used in app, just a default
             today = timezone.now()
-            holidays = Holiday.objects.filter(
+            holidays = holidays_with_counts.filter(
                 date__range=[today - timedelta(days=7), today], active=True
             ).order_by("-date")
         serializer = HolidaySerializer(holidays, many=True)
+        add_pending_counts(Holiday, serializer.data)
         results = {"results": serializer.data}
         return Response(results)
 
+    @staticmethod
+    def _search_holidays(holidays, search):
+        """ Visible holidays matching a search term, most relevant first """
+        try:
+            ranked_ids = get_search_backend().search(search, HOLIDAY_SEARCH_RESULTS)
+        except SearchUnavailable as e:
+            logger.error(f"Holiday search failed, searching names instead: {e}")
+            search = search.lower().replace("national", "").replace("day", "").strip()
+            return holidays.filter(name__icontains=search, visible=True)
+        rank = {holiday_id: i for i, holiday_id in enumerate(ranked_ids)}
+        matches = holidays.filter(id__in=ranked_ids, visible=True)
+        return sorted(matches, key=lambda h: rank[h.id])
+
     def post(self, request):
 
         username = request.POST.get("username", None)
@@ -352,6 +444,9 @@ class HolidayList(generics.GenericAPIView):
         past = request.POST.get("past", None)
         # 2.0+ will always send page
         page = request.POST.get("page", None)
+        # Sent by clients that page by keyset, empty for the first page
+        cursor = request.POST.get("cursor", None)
+        holidays_with_counts = Holiday.objects.with_num_comments()
 
         if search:
             is_date = False
@@ -371,59 +466,95 @@ class HolidayList(generics.GenericAPIView):
                     is_date = True
                     date_val = datetime.strptime(search.split(" ")[0], "%d.%m.%Y")
                 except:  # noqa
-                    search = (
-                        search.lower()
-                        .replace("national", "")
-                        .replace("day", "")
-                        .strip()
-                    )
+                    pass
 
             if is_date:
-                holidays = Holiday.objects.filter(
-                    Q(date=date_val),
-                    Q(active=True) | (Q(active=False) & Q(creator__isnull=True)),
-                )
+                holidays = holidays_with_counts.filter(date=date_val, visible=True)
             else:
-                holidays = Holiday.objects.filter(
-                    Q(name__icontains=search),
-                    Q(active=True) | (Q(active=False) & Q(creator__isnull=True)),
-                )
+                holidays = self._search_holidays(holidays_with_counts, search)
 
         elif holidays_by:
-            holidays = Holiday.objects.filter(
-                creator__username=holidays_by, active=True
+            holidays = holidays_with_counts.filter(
+                creator__username=holidays_by, visible=True
             ).order_by("-votes")
-        elif past:
-            today = timezone.now()
-            chunk = int(page) * settings.HOLIDAY_PAGE_SIZE
-            holidays = Holiday.objects.filter(
-                Q(date__lt=today, active=True)
-                | Q(date__lt=today, active=False, creator__isnull=True)
-            ).order_by("-date")[chunk : chunk + settings.HOLIDAY_PAGE_SIZE]
+        elif past or page is not None or cursor is not None:
+            # The same for everyone but celebrating, so cached for all users
+            feed = "past" if past else "upcoming"
+            # Keyed on the decoded position, client input never reaches the cache key
+            if cursor:
+                date, pk = decode_date_cursor(cursor)
+                position = f"cursor_{date}_{pk}"
+            elif cursor is not None:
+                position = "cursor_first"
+            else:
+                try:
+                    position = f"page_{int(page)}"
+                except ValueError:
+                    raise RequestError("Invalid page")
+            results = get_cached_feed(
+                feed, position, lambda: self._feed_page(past, page, cursor)
+            )
+            results = with_celebrating(results, username)
+            add_pending_counts(Holiday, results["results"])
+            return Response(results)
         else:
-            # Default endpoint for all users
+            # TODO legacy < 2.0, needs -date because of range & no pagination
             today = timezone.now()
-            if page is not None:
-                chunk = int(page) * settings.HOLIDAY_PAGE_SIZE
-                holidays = Holiday.objects.filter(
-                    Q(date=today, active=True)
-                    | (
-                        Q(date__gt=today, active=True)
-                        | Q(date__gt=today, active=False, creator__isnull=True)
-                    )
-                ).order_by("date")[chunk : chunk + settings.HOLIDAY_PAGE_SIZE]
-            else:
-                # TODO legacy < 2.0, needs -date because of range & no pagination
-                holidays = Holiday.objects.filter(
-                    date__range=[today - timedelta(days=7), today], active=True
-                ).order_by("-date")
+            holidays = holidays_with_counts.filter(
+                date__range=[today - timedelta(days=7), today], active=True
+            ).order_by("-date")
 
         serializer = HolidaySerializer(
-            holidays, many=True, context={"username": username}
+            holidays,
+            many=True,
+            context={
+                "username": username,
+                "celebrating": get_celebrated_holiday_ids(username),
+            },
         )
+        add_pending_counts(Holiday, serializer.data)
         results = {"results": serializer.data}
         return Response(results)
 
+    @staticmethod
+    def _feed_page(past, page, cursor):
+        """ A page of the upcoming or past feed, by page number or cursor """
+        holidays_with_counts = Holiday.objects.with_num_comments()
+        today = timezone.now()
+        next_cursor = None
+        if past:
+            holidays = holidays_with_counts.filter(date__lt=today, visible=True)
+            if cursor is not None:
+                holidays, next_cursor = paginate_by_date(
+                    holidays, cursor, settings.HOLIDAY_PAGE_SIZE, descending=True
+                )
+            else:
+                chunk = int(page) * settings.HOLIDAY_PAGE_SIZE
+                holidays = holidays.order_by("-date")[
+                    chunk : chunk + settings.HOLIDAY_PAGE_SIZE
+                ]
+        else:
+            # Unapproved regular holidays are hidden on the day itself
+            upcoming = Q(visible=True) & (
+                Q(date__gt=today) | Q(date=today, active=True)
+            )
+            if cursor is not None:
+                holidays, next_cursor = paginate_by_date(
+                    holidays_with_counts.filter(upcoming),
+                    cursor,
+                    settings.HOLIDAY_PAGE_SIZE,
+                )
+            else:
+                chunk = int(page) * settings.HOLIDAY_PAGE_SIZE
+                holidays = holidays_with_counts.filter(upcoming).order_by("date")[
+                    chunk : chunk + settings.HOLIDAY_PAGE_SIZE
+                ]
+
+        results = {"results": HolidaySerializer(holidays, many=True).data}
+        if cursor is not None:
+            results["next_cursor"] = next_cursor
+        return results
+
 
 class UserHolidays(HolidayList):
     def post(self, request):
@@ -497,30 +628,38 @@ class HolidayDetail(APIView):
 
     def get_object(self, pk):
         try:
-            return Holiday.objects.get(pk=pk)
+            return Holiday.objects.with_num_comments().get(pk=pk)
         except Holiday.DoesNotExist:
             raise HTTP_404_NOT_FOUND
 
+    def get_cached(self, pk):
+        """
+        The holiday serialized for anonymous users, shared between requests,
+        with votes not yet flushed
+        """
+        holiday = get_cached_holiday(pk)
+        if holiday is None:
+            self.get_object(pk)
+        add_pending_counts(Holiday, [holiday])
+        return holiday
+
     def get(self, request, pk):
-        holiday = self.get_object(pk)
-        serializer = HolidaySerializer(holiday)
-        results = {"results": serializer.data}
+        results = {"results": self.get_cached(pk)}
         return Response(results)
 
     def post(self, request, pk):
         vote = request.POST.get("vote", None)
         username = request.POST.get("username", None)
-        holiday = self.get_object(pk)
 
         if vote:
+            holiday = self.get_object(pk)
             vote = int(vote)
             if vote in UPVOTE_CHOICES:
-                holiday.votes += 1
+                incr_counter(Holiday, holiday.id, "votes", 1)
             elif vote in DOWNVOTE_CHOICES:
-                holiday.votes -= 1
+                incr_counter(Holiday, holiday.id, "votes", -1)
             else:
                 raise RequestError("Invalid vote type")
-            holiday.save()
             user_vote, created = UserHolidayVotes.objects.get_or_create(
                 user__username=username,
                 holiday=holiday,
@@ -529,12 +668,13 @@ class HolidayDetail(APIView):
             if not created and user_vote.choice != vote:
                 user_vote.choice = vote
                 user_vote.save()
+            invalidate_celebrated_holidays(username)
             results = {"status": HTTP_200_OK, "message": "OK"}
             return Response(results)
         else:
-            holiday = self.get_object(pk)
-            serializer = HolidaySerializer(holiday, context={"username": username})
-            results = {"results": serializer.data}
+            holiday = self.get_cached(pk)
+            celebrating = pk in get_celebrated_holiday_ids(username)
+            results = {"results": {**holiday, "celebrating": celebrating}}
             return Response(results)
 
 
@@ -574,29 +714,28 @@ class CommentDetail(generics.RetrieveUpdateAPIView):
         if "content" in data and data["content"] != updated_comment.content:
             data["edited"] = timezone.now()
 
+        # Counted below, never written from the request
+        data.pop("likes", None)
         if "like" in data:
             liked = data["like"] in TRUTHY_STRS
-            current_likes = updated_comment.likes
             author = UserProfile.objects.get(user=updated_comment.user)
+            delta = 1 if liked else -1
+            incr_counter(Comment, updated_comment.id, "likes", delta)
+            incr_counter(UserProfile, author.id, "confetti", delta)
             if liked:
-                data["likes"] = current_likes + 1
-                author.confetti += 1
                 updated_comment.user_likes.add(profile.user)
                 # No need to notify if liking their own post
                 if updated_comment.user != profile.user:
-                    cache_key = f"comment_like_notification_{updated_comment.id}_{profile.user.id}"
-                    if not cache.get(cache_key):
-                        cache.set(cache_key, 1, 300)
-                        notify_liked_user(updated_comment, profile.user)
+                    queue_like_notification(updated_comment, profile.user)
             else:
-                data["likes"] = current_likes - 1
-                author.confetti -= 1
                 updated_comment.user_likes.remove(profile.user)
+                cancel_like_notification(updated_comment, profile.user)
 
         serializer = self.get_serializer(self.get_object(), data=data, partial=True)
         serializer.is_valid(raise_exception=True)
         self.perform_update(serializer)
         results = serializer.data
+        add_pending_comment_counts([results])
         # TODO this is for legacy apps before post update, need this response
         results.update({"status": 200, "message": "OK"})
         return Response(results)
@@ -613,21 +752,17 @@ class CommentDetail(generics.RetrieveUpdateAPIView):
             vote = int(vote)
             profile = UserProfile.objects.filter(user=comment.user).first()
             if vote in SINGLE_UP:
-                comment.votes += 1
-                profile.confetti += 1
+                delta = 1
             elif vote in SINGLE_DOWN:
-                comment.votes -= 1
-                profile.confetti -= 1
+                delta = -1
             elif vote == UP_FROM_DOWN:
-                comment.votes += 2
-                profile.confetti += 2
+                delta = 2
             elif vote == DOWN_FROM_UP:
-                comment.votes -= 2
-                profile.confetti -= 2
+                delta = -2
             else:
                 raise RequestError("Invalid vote type")
-            comment.save()
-            profile.save()
+            incr_counter(Comment, comment.id, "votes", delta)
+            incr_counter(UserProfile, profile.id, "confetti", delta)
             user_vote, created = UserCommentVotes.objects.get_or_create(
                 user__username=username,
                 comment=comment,
@@ -640,7 +775,8 @@ class CommentDetail(generics.RetrieveUpdateAPIView):
             return Response(results)
         elif report:
             comment.reports += 1
-            comment.save()
+            # Leaves votes and likes to incr_counter
+            comment.save(update_fields=["reports"])
             user_profile = UserProfile.objects.get(user__username=username)
             user_profile.reported_comments.add(comment)
             if block:
@@ -656,7 +792,7 @@ class CommentDetail(generics.RetrieveUpdateAPIView):
         else:
             comment = self.get_object()
             serializer = CommentSerializer(comment, context={"username": username})
-            results = {"results": serializer.data}
+            results = {"results": add_pending_comment_counts([serializer.data])[0]}
             return Response(results)
 
 
@@ -677,40 +813,15 @@ class CommentList(generics.GenericAPIView):
         else:
             raise RequestError("Invalid query")
 
+        comments = list(comments)
         serializer = CommentSerializer(
-            comments, many=True, context={"username": username}
+            comments,
+            many=True,
+            context=build_serializer_context(username, comments=comments),
         )
-        results = {"results": serializer.data}
+        results = {"results": add_pending_comment_counts(serializer.data)}
         return Response(results)
 
-    def get_replies(self, comment, username):
-        """ Recursively get comment reply chain """
-        reply_chain = []
-        replies = comment.comment_set.all().order_by("-votes", "-id")
-
-        for c in replies:
-            reply_chain.append(c)
-            if c.comment_set.all().count() > 0:
-                child_replies = self.get_replies(c, username)
-                reply_chain.extend(child_replies)
-
-        return reply_chain
-
-    def get_vote_status(self, username, obj):
-        if username:
-            if UserCommentVotes.objects.filter(
-                user__username=username, comment=obj, choice__in=UPVOTE_ONLY
-            ).exists():
-                return "up"
-            elif UserCommentVotes.objects.filter(
-                user__username=username, comment=obj, choice__in=DOWNVOTE_ONLY
-            ).exists():
-                return "down"
-            else:
-                return None
-        else:
-            return None
-
     def post(self, request):
         username = request.POST.get("username", None)
         content = request.POST.get("content", None)
@@ -752,7 +863,7 @@ class CommentList(generics.GenericAPIView):
             comment_user = comment.user.id
             if device_user == comment_user:
                 comment.deleted = True
-                comment.save()
+                comment.save(update_fields=["deleted"])
                 results = {
                     "status": HTTP_200_OK,
                     "message": "Comment flagged for deletion",
@@ -782,7 +893,9 @@ class CommentList(generics.GenericAPIView):
                     parent_post=post,
                 )
                 new_comment.save()
-                notify_mentioned_users(new_comment)
+                transaction.on_commit(
+                    lambda: notify_mentions.delay(COMMENT_NOTIFICATION, new_comment.id)
+                )
                 results = CommentSerializer(new_comment).data
                 # TODO legacy
                 results.update({"status": HTTP_200_OK, "message": "OK"})
@@ -794,23 +907,12 @@ class CommentList(generics.GenericAPIView):
 
         elif holiday:
             page = int(request.POST.get("page", 0))
-            chunk = page * settings.COMMENT_PAGE_SIZE
-            comment_list = []
-            # All the parents with no children
-            comments = (
-                Holiday.objects.get(id=holiday)
-                .comment_set.filter(parent__isnull=True)
-                .order_by("-votes", "-id")
-            )[chunk : chunk + settings.COMMENT_PAGE_SIZE]
-            for c in comments:
-                comment_group = [c]
-                if c.comment_set.all().count() > 0:
-                    replies = self.get_replies(c, username)
-                    comment_group.extend(replies)
-                # Skip deleted top level comments with no replies
-                if len(comment_group) == 1 and comment_group[0].deleted:
-                    continue
-                comment_list.append(comment_group)
+            comment_list = load_comment_threads(holiday, page)
+            thread_comments = [c for thread in comment_list for c, depth in thread]
+            vote_statuses = get_comment_vote_statuses(
+                username, (c.id for c in thread_comments)
+            )
+            profiles = ProfileResolver(c.user_id for c in thread_comments)
 
             # Custom serializing for padding/vote status, etc.
             results = []
@@ -821,38 +923,14 @@ class CommentList(generics.GenericAPIView):
                 reported_comments = profile.reported_comments.all()
             for sub_list in comment_list:
                 serialized_sublist = []
-                # Entire thread parent, default padding
-                depth = 10
-                padding_dict = {}
-                for c in sub_list:
-                    # Replies
+                for c, depth in sub_list:
                     c_dict = model_to_dict(c)
-                    avatar = None
-                    comment_profile = UserProfile.objects.filter(user=c.user).first()
-                    if comment_profile and comment_profile.profile_image:
-                        if (
-                            comment_profile.user.username == username
-                            or comment_profile.avatar_approved
-                        ):
-                            avatar = (
-                                f"{CLOUDFRONT_DOMAIN}/{comment_profile.profile_image}"
-                            )
-                    if not c.parent:
-                        c_dict["depth"] = depth
-                    else:
-                        # If parent is in dict, inherit its padding
-                        if c.parent in padding_dict:
-                            depth = padding_dict[c.parent]
-                        else:
-                            # Otherwise add new parent to dict
-                            if depth <= MAX_COMMENT_DEPTH:
-                                depth += REPLY_DEPTH
-                            padding_dict[c.parent] = depth
-                        c_dict["depth"] = depth
+                    avatar = profiles.avatar(c.user_id, username)
+                    c_dict["depth"] = depth
                     c_dict["time_since"] = c.time_since
                     c_dict["user"] = c.user.username
                     c_dict["avatar"] = avatar
-                    c_dict["vote_status"] = self.get_vote_status(username, c)
+                    c_dict["vote_status"] = vote_statuses.get(c.id, None)
                     c_dict["edited"] = c.time_since_edit
                     c_dict["blocked"] = False
                     c_dict["reported"] = False
@@ -863,14 +941,21 @@ class CommentList(generics.GenericAPIView):
 
                     serialized_sublist.append(c_dict)
                 results.append(serialized_sublist)
+            add_pending_counts(Comment, (c for thread in results for c in thread))
             results = {"results": results}
             return Response(results)
         elif activity:
-            comments = Comment.objects.filter(
-                user__username=activity, deleted=False
-            ).order_by("-id")[:50]
-            serializer = CommentSerializer(comments, many=True)
-            results = {"results": serializer.data}
+            comments = list(
+                Comment.objects.filter(user__username=activity, deleted=False)
+                .select_related("user")
+                .order_by("-id")[:50]
+            )
+            serializer = CommentSerializer(
+                comments,
+                many=True,
+                context=build_serializer_context(None, comments=comments),
+            )
+            results = {"results": add_pending_comment_counts(serializer.data)}
             return Response(results)
 
         else:
@@ -884,57 +969,119 @@ class UserNotificationsView(generics.GenericAPIView):
 
     def get(self, request):
         # News page
-        notifications = UserNotifications.objects.filter(
-            notification_type=NEWS_NOTIFICATION
-        ).order_by("-id")[:20]
-        serializer = UserNotificationsSerializer(notifications, many=True)
-        results = {"results": serializer.data}
+        notifications, next_cursor = paginate_newest_by_id(
+            [
+                UserNotifications.objects.filter(
+                    notification_type=NEWS_NOTIFICATION
+                ).select_related("user")
+            ],
+            request.GET.get("cursor", None),
+            settings.NOTIFICATION_PAGE_SIZE,
+        )
+        serializer = UserNotificationsSerializer(
+            notifications, many=True, context=build_notification_context(notifications),
+        )
+        results = {"results": serializer.data, "next_cursor": next_cursor}
         return Response(results)
 
     def post(self, request):
         username = request.POST.get("username", None)
         clear_notifications = request.POST.get("clear_notifications", None)
         mark_read_id = request.POST.get("mark_read_id", None)
+        user_id = (
+            User.objects.filter(username=username).values_list("id", flat=True).first()
+        )
         if mark_read_id:
             mark_read_type = request.POST.get("mark_read_type", None)
             # n_type used to find unique type/pk combo, can have many in this table
-            n_type = None
-            if mark_read_type == "comment":
-                n_type = COMMENT_NOTIFICATION
-            elif mark_read_type == "post":
-                n_type = POST_NOTIFICATION
-            elif mark_read_type == "like":
-                n_type = LIKE_NOTIFICATION
-            elif mark_read_type == "like_comment":
-                n_type = LIKE_COMMENT_NOTIFICATION
-            # Can add more types in the future
+            n_type = MARK_READ_TYPES.get(mark_read_type, None)
             if n_type is not None:
-                notification = UserNotifications.objects.filter(
-                    notification_type=n_type, notification_id=mark_read_id
-                ).first()
-                if notification:
-                    notification.read = True
-                    notification.save()
+                mark_notifications_read(
+                    user_id, notification_type=n_type, notification_id=mark_read_id
+                )
             else:
                 raise RequestError(f"Notification type {mark_read_type} not valid")
-            unread = UserNotifications.objects.filter(
-                user__username=username, read=False
-            ).count()
-            results = {"status": HTTP_200_OK, "unread": unread}
+            results = {"status": HTTP_200_OK, "unread": get_unread_count(user_id)}
             return Response(results)
 
-        notifications = UserNotifications.objects.filter(
-            Q(user__username=username)
-            | (Q(notification_type=NEWS_NOTIFICATION) & Q(user__isnull=True))
-        ).order_by("-id")[:20]
-        unread = UserNotifications.objects.filter(user__username=username, read=False)
-        serializer = UserNotificationsSerializer(notifications, many=True)
-        results = {"results": serializer.data, "unread": unread.count()}
+        # The user's own notifications and news for everyone, paged as one feed
+        inbox = (
+            UserNotifications.objects.filter(user_id=user_id)
+            if user_id is not None
+            else UserNotifications.objects.none()
+        )
+        news = UserNotifications.objects.filter(
+            notification_type=NEWS_NOTIFICATION, user__isnull=True
+        )
+        notifications, next_cursor = paginate_newest_by_id(
+            [inbox.select_related("user"), news],
+            request.POST.get("cursor", None),
+            settings.NOTIFICATION_PAGE_SIZE,
+        )
+        serializer = UserNotificationsSerializer(
+            notifications, many=True, context=build_notification_context(notifications),
+        )
+        results = {
+            "results": serializer.data,
+            "unread": get_unread_count(user_id),
+            "next_cursor": next_cursor,
+        }
         if clear_notifications:
-            unread.update(read=True)
+            mark_notifications_read(user_id)
         return Response(results)
 
 
+@api_view(["POST"])
+def mark_read_view(request):
+    """
+    Mark many notifications read at once, given as "type:id" notifications
+    (i.e. comment:12) and/or everything up to an id with up_to_id
+    """
+    username = request.data.get("username", None)
+    user_id = (
+        User.objects.filter(username=username).values_list("id", flat=True).first()
+    )
+    if user_id is None:
+        raise RequestError("Please provide a valid username")
+    if hasattr(request.data, "getlist"):
+        pairs = request.data.getlist("notifications")
+    else:
+        pairs = request.data.get("notifications", None) or []
+    up_to_id = request.data.get("up_to_id", None)
+    if len(pairs) > MARK_READ_LIMIT:
+        raise RequestError(f"Can only mark {MARK_READ_LIMIT} notifications at a time")
+
+    ids_by_type = defaultdict(set)
+    for pair in pairs:
+        mark_read_type, _, mark_read_id = str(pair).partition(":")
+        n_type = MARK_READ_TYPES.get(mark_read_type, None)
+        if n_type is None:
+            raise RequestError(f"Notification type {mark_read_type} not valid")
+        if not mark_read_id.isdigit():
+            raise RequestError(f"Notification id {mark_read_id} not valid")
+        ids_by_type[n_type].add(int(mark_read_id))
+
+    selected = [
+        Q(notification_type=n_type, notification_id__in=ids)
+        for n_type, ids in ids_by_type.items()
+    ]
+    if up_to_id is not None:
+        if not str(up_to_id).isdigit():
+            raise RequestError(f"Notification id {up_to_id} not valid")
+        selected.append(Q(id__lte=int(up_to_id)))
+    if selected:
+        mark_notifications_read(user_id, reduce(or_, selected))
+    return Response({"status": HTTP_200_OK, "unread": get_unread_count(user_id)})
+
+
+@api_view(["GET"])
+def autocomplete_view(request):
+    suggestions = autocomplete_index.suggest(
+        request.GET.get("q", ""), AUTOCOMPLETE_RESULTS
+    )
+    return Response({"results": [s._asdict() for s in suggestions]})
+
+
 @api_view(["GET"])
 def tweets_view(request):
     page = int(request.GET.get("page", 0))
@@ -1011,31 +1158,28 @@ class PostDetail(generics.RetrieveUpdateAPIView):
         if "content" in data and data["content"] != updated_post.content:
             data["edited"] = timezone.now()
 
+        # Counted below, never written from the request
+        data.pop("likes", None)
         if "like" in data:
             liked = data["like"] in TRUTHY_STRS
-            current_likes = updated_post.likes
             author = UserProfile.objects.get(user=updated_post.user)
+            delta = 1 if liked else -1
+            incr_counter(Post, updated_post.id, "likes", delta)
+            incr_counter(UserProfile, author.id, "confetti", delta)
             if liked:
-                data["likes"] = current_likes + 1
-                author.confetti += 1
                 updated_post.user_likes.add(profile.user)
                 # No need to notify if liking their own post
                 if updated_post.user != profile.user:
-                    cache_key = (
-                        f"post_like_notification_{updated_post.id}_{profile.user.id}"
-                    )
-                    if not cache.get(cache_key):
-                        cache.set(cache_key, 1, 300)
-                        notify_liked_user(updated_post, profile.user)
+                    queue_like_notification(updated_post, profile.user)
             else:
-                data["likes"] = current_likes - 1
-                author.confetti -= 1
                 updated_post.user_likes.remove(profile.user)
-            author.save(update_fields=["confetti"])
+                cancel_like_notification(updated_post, profile.user)
         serializer = self.get_serializer(self.get_object(), data=data, partial=True)
         serializer.is_valid(raise_exception=True)
         self.perform_update(serializer)
-        return Response(serializer.data)
+        results = serializer.data
+        add_pending_post_counts([results])
+        return Response(results)
 
 
 class PostList(APIView):
@@ -1050,22 +1194,13 @@ class PostList(APIView):
         page = request.GET.get("page", 0)
 
         if holiday_id:
-            h = Holiday.objects.filter(pk=holiday_id).first()
-            if h:
-                posts = Post.objects.filter(holiday=h, deleted=False)
+            # Shared by everyone, push notifications send the whole app here
+            posts = get_cached_holiday_posts(int(holiday_id))
+            if posts is not None:
                 if username:
-                    profile = UserProfile.objects.get(user__username=username)
-                    blocked_users = profile.blocked_users.all()
-                    reported_posts = profile.reported_posts.all().only("id")
-                    posts = posts.exclude(user__in=blocked_users).exclude(
-                        id__in=reported_posts
-                    )
-                posts = posts.order_by("-id")
+                    posts = personalize_posts(posts, username)
                 # TODO pagination
-                serializer = PostSerializer(
-                    posts, many=True, context={"username": username}
-                )
-                results = {"results": serializer.data}
+                results = {"results": add_pending_post_counts(posts)}
                 return Response(results)
             else:
                 results = {
@@ -1080,15 +1215,19 @@ class PostList(APIView):
                 Post.objects
                 # Undeletd posts on active holidays only
                 .filter(deleted=False, holiday__active=True)
+                .select_related("user", "holiday")
                 .order_by(
                     "-timestamp",
                     "-comment__timestamp"
                 )
              )[chunk: chunk + settings.HOLIDAY_PAGE_SIZE]
+            today_posts = list(today_posts)
             serializer = PostSerializer(
-                today_posts, many=True, context={"username": username}
+                today_posts,
+                many=True,
+                context=build_serializer_context(username, posts=today_posts),
             )
-            results = {"results": serializer.data}
+            results = {"results": add_pending_post_counts(serializer.data)}
             return Response(results)
 
         raise RequestError("Please pass a holiday id")
@@ -1116,7 +1255,9 @@ class PostList(APIView):
                 image=image_link,
             )
             if content:
-                notify_mentioned_users(new_post)
+                transaction.on_commit(
+                    lambda: notify_mentions.delay(POST_NOTIFICATION, new_post.id)
+                )
             results = {
                 "status": HTTP_200_OK,
                 "post_id": new_post.id,
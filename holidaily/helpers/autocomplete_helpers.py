@@ -0,0 +1,220 @@
+import heapq
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api.constants import SEARCH_STOPWORDS, AUTOCOMPLETE_SCAN_LIMIT
+from api.models import Holiday
+import logging
+
+logger = logging.getLogger("holidaily")
+
+# Bumped on every indexed change, tells other processes to rebuild
+VERSION_CACHE_KEY = "autocomplete_version"
+# Tuple and list slot per entry, on top of the key string itself
+ENTRY_OVERHEAD = sys.getsizeof(("", 0)) + 8
+
+
+class Suggestion(NamedTuple):
+    id: int
+    name: str
+
+
+class _IndexedHoliday(NamedTuple):
+    name: str
+    normalized: str
+    votes: int
+    keys: List[str]
+    size: int
+
+
+def normalize(text: str) -> str:
+    """ Lowercase words separated by single spaces, punctuation dropped """
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower().replace("'", "")))
+
+
+def _keys(normalized: str) -> List[str]:
+    """ The name from each word on, so "piz" suggests National Pizza Day """
+    words = normalized.split(" ")
+    return [
+        " ".join(words[i:])
+        for i in range(len(words))
+        if i == 0 or words[i] not in SEARCH_STOPWORDS
+    ]
+
+
+class HolidayAutocompleteIndex:
+    """
+    Prefix index of visible holiday names, a sorted list of (key, holiday id)
+    searched with bisect. Built from the database on first use, after that only
+    the cache is checked for changes made by other processes, every
+    AUTOCOMPLETE_CHECK_SECONDS.
+
+    Suggestions are ranked by votes as of the last rebuild, votes alone don't
+    trigger one. Past AUTOCOMPLETE_MEMORY_BUDGET the least voted holidays are
+    left out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: List[Tuple[str, int]] = []
+        self._holidays: Dict[int, _IndexedHoliday] = {}
+        self._size = 0
+        self._loaded = False
+        self._version = None
+        self._checked_at = 0.0
+
+    @property
+    def size(self) -> int:
+        """ Approximate bytes used by the index entries """
+        return self._size
+
+    def _add(self, holiday_id: int, name: str, votes: int) -> bool:
+        normalized = normalize(name)
+        if not normalized:
+            return True
+        keys = _keys(normalized)
+        size = sum(sys.getsizeof(key) + ENTRY_OVERHEAD for key in keys)
+        if self._size + size > settings.AUTOCOMPLETE_MEMORY_BUDGET:
+            return False
+        for key in keys:
+            insort(self._entries, (key, holiday_id))
+        self._holidays[holiday_id] = _IndexedHoliday(
+            name, normalized, votes, keys, size
+        )
+        self._size += size
+        return True
+
+    def _remove(self, holiday_id: int) -> None:
+        indexed = self._holidays.pop(holiday_id, None)
+        if indexed is None:
+            return
+        for key in indexed.keys:
+            del self._entries[bisect_left(self._entries, (key, holiday_id))]
+        self._size -= indexed.size
+
+    def rebuild(self, holidays: Iterable[Tuple[int, str, int]]) -> None:
+        """
+        :param holidays: (id, name, votes) of every visible holiday, most voted
+        first so the budget keeps the popular ones
+        """
+        with self._lock:
+            self._entries, self._holidays, self._size = [], {}, 0
+            skipped = 0
+            for holiday_id, name, votes in holidays:
+                if not self._add(holiday_id, name, votes):
+                    skipped += 1
+            if skipped:
+                logger.warning(
+                    f"Autocomplete memory budget reached, {skipped} holidays left out"
+                )
+            self._loaded = True
+
+    def _refresh_if_stale(self) -> None:
+        now = time.monotonic()
+        if (
+            self._loaded
+            and now - self._checked_at < settings.AUTOCOMPLETE_CHECK_SECONDS
+        ):
+            return
+        self._checked_at = now
+        version = cache.get(VERSION_CACHE_KEY)
+        if self._loaded and version == self._version:
+            return
+        # Read before taking the lock, so suggestions aren't blocked on MySQL
+        holidays = list(
+            Holiday.objects.filter(visible=True)
+            .order_by("-votes", "id")
+            .values_list("id", "name", "votes")
+        )
+        self.rebuild(holidays)
+        self._version = version
+
+    def update(
+        self, holiday_id: int, holiday: Optional[Holiday], version: Optional[int]
+    ) -> None:
+        """
+        Apply a saved or deleted holiday to this process's index
+        :param holiday_id: id of the changed holiday
+        :param holiday: the saved holiday, None if deleted
+        :param version: version after bumping for this change
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove(holiday_id)
+            if holiday is not None and holiday.visible:
+                self._add(holiday_id, holiday.name, holiday.votes)
+            # Any other change since our last check still needs a rebuild
+            if version is not None and self._version is not None:
+                if version == self._version + 1:
+                    self._version = version
+
+    def suggest(self, prefix: str, limit: int) -> List[Suggestion]:
+        """
+        Holidays with a word starting with prefix. Names starting with it come
+        first, then by votes.
+        """
+        self._refresh_if_stale()
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        matches = {}
+        with self._lock:
+            entries = self._entries
+            i = bisect_left(entries, (prefix,))
+            end = min(len(entries), i + AUTOCOMPLETE_SCAN_LIMIT)
+            while i < end and entries[i][0].startswith(prefix):
+                holiday_id = entries[i][1]
+                matches[holiday_id] = self._holidays[holiday_id]
+                i += 1
+        ranked = heapq.nsmallest(
+            limit,
+            matches.items(),
+            key=lambda item: (
+                not item[1].normalized.startswith(prefix),
+                -item[1].votes,
+                item[1].name,
+            ),
+        )
+        return [Suggestion(holiday_id, h.name) for holiday_id, h in ranked]
+
+
+autocomplete_index = HolidayAutocompleteIndex()
+
+
+def _bump_version() -> Optional[int]:
+    cache.add(VERSION_CACHE_KEY, 0, None)
+    try:
+        return cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # Evicted in between, other processes rebuild on the missing key anyway
+        return None
+
+
+def _holiday_changed(holiday_id: int, holiday: Optional[Holiday] = None) -> None:
+    autocomplete_index.update(holiday_id, holiday, _bump_version())
+
+
+# Connected in ApiConfig.ready(). Votes alone don't change suggestions, so only
+# name and visibility changes are applied.
+@receiver(post_save, sender=Holiday)
+def holiday_saved(sender, instance, **kwargs):
+    if instance.changed_since_load("name", "visible"):
+        transaction.on_commit(lambda: _holiday_changed(instance.id, instance))
+
+
+@receiver(post_delete, sender=Holiday)
+def holiday_removed(sender, instance, **kwargs):
+    # The pk is cleared once the delete finishes
+    holiday_id = instance.id
+    transaction.on_commit(lambda: _holiday_changed(holiday_id))
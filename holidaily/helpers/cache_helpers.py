@@ -0,0 +1,326 @@
+import time
+from typing import Any, Callable, List, Optional, Set, TypeVar
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api.constants import (
+    UPVOTE_ONLY,
+    CELEBRATING_CACHE_SECONDS,
+    FEED_CACHE_SECONDS,
+    HOLIDAY_CACHE_SECONDS,
+    SINGLE_FLIGHT_LOCK_SECONDS,
+    SINGLE_FLIGHT_STALE_SECONDS,
+    SINGLE_FLIGHT_WAIT_SECONDS,
+    SINGLE_FLIGHT_POLL_SECONDS,
+)
+from api.models import UserHolidayVotes, Holiday, Post, Comment
+from api.serializers import HolidaySerializer, PostSerializer
+from holidaily.helpers.context_helpers import build_serializer_context
+from holidaily.helpers.counter_helpers import counters_flushed
+
+T = TypeVar("T")
+
+FEED_VERSION_CACHE_KEY = "holiday_feed_version"
+# Votes are written by flush_counters, see votes_flushed
+FEED_HOLIDAY_FIELDS = [
+    f.attname for f in Holiday._meta.concrete_fields if f.name != "votes"
+]
+
+
+def _celebrating_cache_key(username: str) -> str:
+    return f"celebrating_{username}"
+
+
+def get_celebrated_holiday_ids(username: Optional[str]) -> Set[int]:
+    """
+    Ids of every holiday a user is celebrating (upvoted), cached per user
+    :param username: requesting user, may be None for anonymous requests
+    :return: set of holiday ids
+    """
+    if not username:
+        return set()
+    cache_key = _celebrating_cache_key(username)
+    holiday_ids = cache.get(cache_key)
+    if holiday_ids is None:
+        holiday_ids = set(
+            UserHolidayVotes.objects.filter(
+                user__username=username, choice__in=UPVOTE_ONLY
+            ).values_list("holiday_id", flat=True)
+        )
+        cache.set(cache_key, holiday_ids, CELEBRATING_CACHE_SECONDS)
+    return holiday_ids
+
+
+def invalidate_celebrated_holidays(username: str) -> None:
+    """ Call after a user's holiday votes change """
+    cache.delete(_celebrating_cache_key(username))
+
+
+def _get_version(version_key: str) -> int:
+    version = cache.get(version_key)
+    if version is None:
+        # Seeded from the clock so an evicted version never reuses old keys
+        cache.add(version_key, int(time.time()), None)
+        version = cache.get(version_key, int(time.time()))
+    return version
+
+
+def _bump_version(version_key: str) -> None:
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        _get_version(version_key)
+
+
+def _holiday_posts_version_key(holiday_id: int) -> str:
+    return f"holiday_posts_version_{holiday_id}"
+
+
+def _holiday_version_key(holiday_id: int) -> str:
+    return f"holiday_version_{holiday_id}"
+
+
+def _holiday_version(holiday_id: int) -> tuple:
+    return (
+        _get_version(FEED_VERSION_CACHE_KEY),
+        _get_version(_holiday_version_key(holiday_id)),
+    )
+
+
+def invalidate_feeds() -> None:
+    """ Outdate every cached feed page and holiday, call after holidays or their posts change """
+    _bump_version(FEED_VERSION_CACHE_KEY)
+
+
+def invalidate_holiday_posts(holiday_id: int) -> None:
+    """ Outdate a holiday's cached posts, call after its posts or comments change """
+    _bump_version(_holiday_posts_version_key(holiday_id))
+
+
+def _store(cache_key: str, value: Any, timeout: int, version: Any) -> None:
+    envelope = {
+        "value": value,
+        "version": version,
+        "fresh_until": time.time() + timeout,
+    }
+    # Kept past its timeout to serve while a single caller rebuilds it
+    cache.set(cache_key, envelope, timeout + SINGLE_FLIGHT_STALE_SECONDS)
+
+
+def single_flight(
+    cache_key: str, build: Callable[[], T], timeout: int, version: Any = None
+) -> T:
+    """
+    Cached value of build(), rebuilt by one caller at a time. While a value is
+    rebuilt after expiring or being outdated the other callers get the stale
+    copy, or wait for the new one if there is none.
+    :param cache_key: where the value is cached
+    :param build: computes the value
+    :param timeout: seconds the value is fresh for
+    :param version: values cached under any other version are outdated
+    :return: the cached or built value
+    """
+    envelope = cache.get(cache_key)
+    if (
+        envelope is not None
+        and envelope["version"] == version
+        and envelope["fresh_until"] > time.time()
+    ):
+        return envelope["value"]
+
+    lock_key = f"{cache_key}_lock"
+    locked = cache.add(lock_key, 1, SINGLE_FLIGHT_LOCK_SECONDS)
+    if not locked:
+        if envelope is not None:
+            return envelope["value"]
+        deadline = time.monotonic() + SINGLE_FLIGHT_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+            envelope = cache.get(cache_key)
+            if envelope is not None:
+                return envelope["value"]
+        # Whoever holds the lock is taking too long, build it ourselves
+    try:
+        value = build()
+        _store(cache_key, value, timeout, version)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+def get_cached_feed(feed: str, position: str, build: Callable[[], dict]) -> dict:
+    """
+    A holiday feed page as served to anonymous users, cached until feeds are
+    invalidated, the date rolls over or FEED_CACHE_SECONDS pass
+    :param feed: name of the feed
+    :param position: page or cursor within the feed
+    :param build: builds the response when it isn't cached
+    :return: response body, with celebrating False everywhere
+    """
+    cache_key = f"holiday_feed_{feed}_{position}_{timezone.now().date()}"
+    return single_flight(
+        cache_key, build, FEED_CACHE_SECONDS, _get_version(FEED_VERSION_CACHE_KEY)
+    )
+
+
+def _build_holiday(holiday_id: int) -> Optional[dict]:
+    holiday = Holiday.objects.with_num_comments().filter(pk=holiday_id).first()
+    if holiday is None:
+        return None
+    return HolidaySerializer(holiday).data
+
+
+def _build_holiday_posts(holiday_id: int) -> Optional[List[dict]]:
+    if not Holiday.objects.filter(pk=holiday_id).exists():
+        return None
+    posts = list(
+        Post.objects.filter(holiday_id=holiday_id, deleted=False)
+        .select_related("user", "holiday")
+        .order_by("-id")
+    )
+    return PostSerializer(
+        posts, many=True, context=build_serializer_context(None, posts=posts)
+    ).data
+
+
+def _holiday_cache_key(holiday_id: int) -> str:
+    # Dated for the "Today" label
+    return f"holiday_{holiday_id}_{timezone.now().date()}"
+
+
+def _holiday_posts_cache_key(holiday_id: int) -> str:
+    return f"holiday_posts_{holiday_id}"
+
+
+def get_cached_holiday(holiday_id: int) -> Optional[dict]:
+    """
+    A holiday as served to anonymous users, shares invalidation with the feeds
+    and is also outdated on its own when its votes are flushed
+    :param holiday_id: holiday to load
+    :return: serialized holiday, None if it doesn't exist
+    """
+    return single_flight(
+        _holiday_cache_key(holiday_id),
+        lambda: _build_holiday(holiday_id),
+        HOLIDAY_CACHE_SECONDS,
+        _holiday_version(holiday_id),
+    )
+
+
+def get_cached_holiday_posts(holiday_id: int) -> Optional[List[dict]]:
+    """
+    Undeleted posts on a holiday as served to anonymous users, newest first.
+    See personalize_posts() for everyone else.
+    :param holiday_id: holiday the posts are on
+    :return: serialized posts, None if the holiday doesn't exist
+    """
+    return single_flight(
+        _holiday_posts_cache_key(holiday_id),
+        lambda: _build_holiday_posts(holiday_id),
+        HOLIDAY_CACHE_SECONDS,
+        _get_version(_holiday_posts_version_key(holiday_id)),
+    )
+
+
+def warm_holiday_caches(holiday_id: int) -> None:
+    """ Rebuild a holiday's cached detail and posts ahead of traffic, e.g. a push """
+    _store(
+        _holiday_cache_key(holiday_id),
+        _build_holiday(holiday_id),
+        HOLIDAY_CACHE_SECONDS,
+        _holiday_version(holiday_id),
+    )
+    _store(
+        _holiday_posts_cache_key(holiday_id),
+        _build_holiday_posts(holiday_id),
+        HOLIDAY_CACHE_SECONDS,
+        _get_version(_holiday_posts_version_key(holiday_id)),
+    )
+
+
+def with_celebrating(results: dict, username: Optional[str]) -> dict:
+    """ Fill in a user's celebrating flags on a cached feed page """
+    celebrating = get_celebrated_holiday_ids(username)
+    return {
+        **results,
+        "results": [
+            {**h, "celebrating": h["id"] in celebrating} for h in results["results"]
+        ],
+    }
+
+
+# Connected in ApiConfig.ready(). Invalidated after commit so a request racing
+# the save can't cache the old rows under the new version.
+@receiver(post_save, sender=Holiday)
+def holiday_saved(sender, instance, **kwargs):
+    if instance.changed_since_load(*FEED_HOLIDAY_FIELDS):
+        transaction.on_commit(invalidate_feeds)
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, **kwargs):
+    # Feeds show each holiday's number of undeleted posts
+    if created or instance.changed_since_load("deleted"):
+        transaction.on_commit(invalidate_feeds)
+    transaction.on_commit(lambda: invalidate_holiday_posts(instance.holiday_id))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_holiday_posts(instance.holiday_id))
+
+
+@receiver(post_delete, sender=Holiday)
+def holiday_deleted(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_feeds)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_feeds)
+    transaction.on_commit(lambda: invalidate_holiday_posts(instance.holiday_id))
+
+
+def _invalidate_posts_on(holiday_ids: Set[int]) -> None:
+    for holiday_id in holiday_ids:
+        invalidate_holiday_posts(holiday_id)
+
+
+# Like counts are cached with the posts, the viewer's liked flags are not
+@receiver(m2m_changed, sender=Post.user_likes.through)
+@receiver(m2m_changed, sender=Comment.user_likes.through)
+def likes_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove"):
+        return
+    if reverse:
+        # i.e. user.liked_comments.add(), instance is the user
+        holiday_ids = set(
+            model.objects.filter(pk__in=pk_set).values_list("holiday_id", flat=True)
+        )
+    else:
+        holiday_ids = {instance.holiday_id}
+    transaction.on_commit(lambda: _invalidate_posts_on(holiday_ids))
+
+
+# Readers add the deltas still pending to cached counts, once flushed those
+# are in the database and the cached copies are short until rebuilt. Only the
+# flushed holidays are rebuilt, feed pages catch up when they expire.
+@receiver(counters_flushed, sender=Holiday)
+def votes_flushed(sender, pks, **kwargs):
+    for pk in pks:
+        _bump_version(_holiday_version_key(pk))
+
+
+@receiver(counters_flushed, sender=Post)
+@receiver(counters_flushed, sender=Comment)
+def counts_flushed(sender, pks, **kwargs):
+    holiday_ids = set(
+        sender.objects.filter(pk__in=pks).values_list("holiday_id", flat=True)
+    )
+    _invalidate_posts_on(holiday_ids)
@@ -0,0 +1,132 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+
+from api.constants import MAX_COMMENT_DEPTH, REPLY_DEPTH
+from api.models import Comment
+
+# Padding of a thread's top level comment, replies are indented from here
+THREAD_ROOT_DEPTH = 10
+
+
+def _sort_key(comment: Comment) -> Tuple[int, int]:
+    # Same ordering as order_by("-votes", "-id")
+    return -comment.votes, -comment.id
+
+
+def _flatten_thread(root: Comment, children: Dict[int, List[Comment]]) -> List[Comment]:
+    """ Depth first walk of a reply tree, replies ordered by votes then newest """
+    thread = []
+    stack = [root]
+    while stack:
+        comment = stack.pop()
+        thread.append(comment)
+        # Reversed so the highest ranked reply is popped first
+        stack.extend(reversed(children.get(comment.id, [])))
+    return thread
+
+
+def load_reply_children(comments: Iterable[Comment]) -> Dict[int, List[Comment]]:
+    """
+    Load every reply below a page of comments in one query, like
+    load_comment_threads replies are looked up by the holiday they were posted on
+    :param comments: comments being serialized
+    :return: comment id -> its undeleted replies ordered by votes then newest,
+    with an entry for each comment and each loaded reply
+    """
+    comments = list(comments)
+    children = {c.id: [] for c in comments}
+    if not comments:
+        return children
+    replies = Comment.objects.filter(
+        holiday_id__in={c.holiday_id for c in comments},
+        parent__isnull=False,
+        deleted=False,
+    ).select_related("user")
+    by_parent = defaultdict(list)
+    for reply in replies:
+        by_parent[reply.parent_id].append(reply)
+
+    # Only what hangs off the page, other threads on the holiday are dropped
+    stack = list(comments)
+    while stack:
+        comment = stack.pop()
+        replies = sorted(by_parent.get(comment.id, []), key=_sort_key)
+        children[comment.id] = replies
+        stack.extend(r for r in replies if r.id not in children)
+    return children
+
+
+def flatten_replies(
+    comment: Comment, children: Dict[int, List[Comment]]
+) -> List[Comment]:
+    """ A comment's replies and theirs, in display order, see load_reply_children """
+    return _flatten_thread(comment, children)[1:]
+
+
+def _thread_depths(thread: List[Comment]) -> List[Tuple[Comment, int]]:
+    """
+    Calculate the padding of each comment in a flattened thread. Replies are
+    indented REPLY_DEPTH further than their parent, up to MAX_COMMENT_DEPTH.
+    """
+    depth = THREAD_ROOT_DEPTH
+    padding_dict = {}
+    thread_depths = []
+    for c in thread:
+        if c.parent_id is not None:
+            # If parent is in dict, inherit its padding
+            if c.parent_id in padding_dict:
+                depth = padding_dict[c.parent_id]
+            else:
+                # Otherwise add new parent to dict
+                if depth <= MAX_COMMENT_DEPTH:
+                    depth += REPLY_DEPTH
+                padding_dict[c.parent_id] = depth
+        thread_depths.append((c, depth))
+    return thread_depths
+
+
+def load_comment_threads(holiday_id: int, page: int) -> List[List[Tuple[Comment, int]]]:
+    """
+    Load a page of comment threads for a holiday. The top level comments for the
+    page and every reply on the holiday are fetched in one query each, and the
+    reply trees are built in memory.
+    :param holiday_id: holiday the comments belong to
+    :param page: page of top level comments, COMMENT_PAGE_SIZE threads per page
+    :return: threads of (comment, depth) pairs, each thread in display order
+    """
+    chunk = page * settings.COMMENT_PAGE_SIZE
+    roots = list(
+        Comment.objects.filter(holiday_id=holiday_id, parent__isnull=True)
+        .select_related("user")
+        .order_by("-votes", "-id")[chunk : chunk + settings.COMMENT_PAGE_SIZE]
+    )
+    if not roots:
+        return []
+
+    replies = list(
+        Comment.objects.filter(
+            holiday_id=holiday_id, parent__isnull=False
+        ).select_related("user")
+    )
+    children = defaultdict(list)
+    for reply in replies:
+        children[reply.parent_id].append(reply)
+    for siblings in children.values():
+        siblings.sort(key=_sort_key)
+
+    threads = []
+    thread_comments = []
+    for root in roots:
+        thread = _flatten_thread(root, children)
+        # Skip deleted top level comments with no replies
+        if len(thread) == 1 and root.deleted:
+            continue
+        threads.append(_thread_depths(thread))
+        thread_comments.extend(thread)
+
+    # Serialized with model_to_dict, which reads user_likes
+    prefetch_related_objects(thread_comments, "user_likes")
+    return threads
@@ -0,0 +1,391 @@
+from collections import defaultdict
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+from django.db.models import prefetch_related_objects
+
+from api.constants import (
+    UPVOTE,
+    DOWNVOTE,
+    UPVOTE_ONLY,
+    DOWNVOTE_ONLY,
+    CLOUDFRONT_DOMAIN,
+    COMMENT_NOTIFICATION,
+    POST_NOTIFICATION,
+    LIKE_NOTIFICATION,
+    LIKE_COMMENT_NOTIFICATION,
+    HOLIDAY_NOTIFICATION,
+)
+from holidaily.helpers.comment_helpers import load_reply_children
+from holidaily.helpers.counter_helpers import add_pending_counts
+from api.models import (
+    Comment,
+    Holiday,
+    Post,
+    UserCommentVotes,
+    UserProfile,
+    UserNotifications,
+)
+
+
+def get_avatar_url(
+    profile: Optional[UserProfile], requesting_user: Optional[str] = None
+) -> Optional[str]:
+    """
+    Avatar link for a profile. Avatars are hidden until approved, but users
+    can always see their own.
+    :param profile: profile of the avatar's owner
+    :param requesting_user: username of the user viewing the avatar
+    :return: CloudFront link, or None if there is nothing to show
+    """
+    if not profile or not profile.profile_image:
+        return None
+    # Don't censor user's own avatar
+    if profile.avatar_approved or (
+        requesting_user and requesting_user.lower() == profile.user.username.lower()
+    ):
+        return f"{CLOUDFRONT_DOMAIN}/{profile.profile_image}"
+    return None
+
+
+class ProfileResolver:
+    """
+    Request scoped UserProfile lookup. Profiles for a page of users are loaded
+    in one query, anything asked for later is loaded and remembered on demand.
+    """
+
+    def __init__(self, user_ids: Iterable[int] = ()):
+        self._profiles = {}
+        self.load(user_ids)
+
+    def load(self, user_ids: Iterable[int]) -> None:
+        missing = set(user_ids) - set(self._profiles)
+        if not missing:
+            return
+        for user_id in missing:
+            self._profiles[user_id] = None
+        profiles = (
+            UserProfile.objects.filter(user_id__in=missing)
+            .select_related("user")
+            .order_by("-id")
+        )
+        # Descending, so the oldest profile wins like .first() would
+        for profile in profiles:
+            self._profiles[profile.user_id] = profile
+
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        self.load([user_id])
+        return self._profiles[user_id]
+
+    def avatar(self, user_id: int, requesting_user: Optional[str] = None):
+        return get_avatar_url(self.get(user_id), requesting_user)
+
+
+def get_profile_resolver(context: dict) -> ProfileResolver:
+    """ The serializer context's ProfileResolver, added if the caller didn't build one """
+    if "profiles" not in context:
+        context["profiles"] = ProfileResolver()
+    return context["profiles"]
+
+
+def get_comment_vote_statuses(
+    username: str, comment_ids: Iterable[int]
+) -> Dict[int, str]:
+    """
+    Resolve a user's vote on each comment in one query
+    :param username: user viewing the comments
+    :param comment_ids: comments being serialized
+    :return: comment id -> UPVOTE/DOWNVOTE, comments without a vote are left out
+    """
+    comment_ids = set(comment_ids)
+    if not username or not comment_ids:
+        return {}
+    votes = UserCommentVotes.objects.filter(
+        user__username=username, comment_id__in=comment_ids
+    ).values_list("comment_id", "choice")
+    vote_statuses = {}
+    for comment_id, choice in votes:
+        if choice in UPVOTE_ONLY:
+            vote_statuses[comment_id] = UPVOTE
+        elif choice in DOWNVOTE_ONLY:
+            # An upvote wins if there is somehow more than one vote
+            vote_statuses.setdefault(comment_id, DOWNVOTE)
+    return vote_statuses
+
+
+def get_liked_ids(
+    username: str, model: Type[Union[Comment, Post]], ids: Iterable[int]
+) -> Set[int]:
+    """
+    Resolve which of the given comments or posts a user has liked in one query
+    :param username: user viewing the entities
+    :param model: Comment or Post, anything with a user_likes relation
+    :param ids: entities being serialized
+    :return: ids of the liked entities
+    """
+    ids = set(ids)
+    if not username or not ids:
+        return set()
+    through = model.user_likes.through
+    entity_field = f"{model._meta.model_name}_id"
+    return set(
+        through.objects.filter(
+            user__username=username, **{f"{entity_field}__in": ids}
+        ).values_list(entity_field, flat=True)
+    )
+
+
+def get_hidden_comment_sources(username: Optional[str]) -> Tuple[Set[int], Set[int]]:
+    """
+    Who and what a user doesn't want to see comments from
+    :param username: requesting user, may be None for anonymous requests
+    :return: ids of the users they blocked and of the comments they reported
+    """
+    profile = (
+        UserProfile.objects.filter(user__username=username).first()
+        if username
+        else None
+    )
+    if profile is None:
+        return set(), set()
+    return (
+        set(profile.blocked_users.values_list("id", flat=True)),
+        set(profile.reported_comments.values_list("id", flat=True)),
+    )
+
+
+def load_post_comments(
+    posts: Iterable[Post], username: Optional[str]
+) -> Dict[int, List[Comment]]:
+    """
+    Undeleted comments on a page of posts in one query, leaving out what the
+    user blocked or reported
+    :param posts: posts being serialized
+    :param username: requesting user, may be None for anonymous requests
+    :return: post id -> its comments, newest first
+    """
+    post_comments = {p.id: [] for p in posts}
+    if not post_comments:
+        return post_comments
+    blocked_users, reported_comments = get_hidden_comment_sources(username)
+    comments = (
+        Comment.objects.filter(parent_post_id__in=post_comments, deleted=False)
+        .exclude(user_id__in=blocked_users)
+        .exclude(id__in=reported_comments)
+        .select_related("user")
+        .order_by("-id")
+    )
+    for comment in comments:
+        post_comments[comment.parent_post_id].append(comment)
+    return post_comments
+
+
+def build_serializer_context(
+    username: Optional[str],
+    comments: Iterable[Comment] = (),
+    posts: Iterable[Post] = (),
+) -> dict:
+    """
+    Serializer context with the requesting user's state for a page of comments
+    and posts, resolved up front so serializers don't query per row. Comments
+    on the posts and replies of the comments are loaded and resolved along
+    with them.
+    :param username: requesting user, may be None for anonymous requests
+    :param comments: comments on the page
+    :param posts: posts on the page
+    :return: context for CommentSerializer/PostSerializer
+    """
+    comments, posts = list(comments), list(posts)
+    # Serialized with the posts
+    prefetch_related_objects(posts, "user_likes")
+    post_comments = load_post_comments(posts, username)
+    comments += [c for on_post in post_comments.values() for c in on_post]
+    reply_children = load_reply_children(comments)
+    comments += [r for replies in reply_children.values() for r in replies]
+    comment_ids = [c.id for c in comments]
+    post_ids = [p.id for p in posts]
+    return {
+        "username": username,
+        "post_comments": post_comments,
+        "reply_children": reply_children,
+        "vote_statuses": get_comment_vote_statuses(username, comment_ids),
+        "liked_comments": get_liked_ids(username, Comment, comment_ids),
+        "liked_posts": get_liked_ids(username, Post, post_ids),
+        "profiles": ProfileResolver(obj.user_id for obj in comments + posts),
+    }
+
+
+class NotificationEntity(NamedTuple):
+    holiday_id: Optional[int]
+    # Only set for notifications showing their author's avatar
+    author_id: Optional[int]
+
+
+# Model behind each notification type, and whether its author is the icon
+NOTIFICATION_ENTITIES = {
+    COMMENT_NOTIFICATION: (Comment, True),
+    POST_NOTIFICATION: (Post, True),
+    LIKE_NOTIFICATION: (Post, False),
+    LIKE_COMMENT_NOTIFICATION: (Comment, False),
+    HOLIDAY_NOTIFICATION: (Holiday, False),
+}
+
+
+def resolve_notification_entities(
+    notifications: Iterable[UserNotifications],
+) -> Dict[Tuple[int, int], NotificationEntity]:
+    """
+    Look up the comment, post or holiday behind each notification, one query per model
+    :param notifications: notifications being serialized
+    :return: (notification_type, notification_id) -> NotificationEntity, missing
+    entities and types without one (news) are left out
+    """
+    entity_ids = defaultdict(set)
+    for n in notifications:
+        if n.notification_type in NOTIFICATION_ENTITIES:
+            model = NOTIFICATION_ENTITIES[n.notification_type][0]
+            entity_ids[model].add(n.notification_id)
+
+    found = {}
+    for model, ids in entity_ids.items():
+        if model is Holiday:
+            holiday_ids = model.objects.filter(id__in=ids).values_list("id", flat=True)
+            found[model] = {
+                holiday_id: (holiday_id, None) for holiday_id in holiday_ids
+            }
+        else:
+            rows = model.objects.filter(id__in=ids).values_list(
+                "id", "holiday_id", "user_id"
+            )
+            found[model] = {entity_id: (h_id, u_id) for entity_id, h_id, u_id in rows}
+
+    entities = {}
+    for n in notifications:
+        if n.notification_type not in NOTIFICATION_ENTITIES:
+            continue
+        model, author_is_icon = NOTIFICATION_ENTITIES[n.notification_type]
+        row = found[model].get(n.notification_id)
+        if row is not None:
+            holiday_id, author_id = row
+            entities[(n.notification_type, n.notification_id)] = NotificationEntity(
+                holiday_id, author_id if author_is_icon else None
+            )
+    return entities
+
+
+def build_notification_context(notifications: Iterable[UserNotifications]) -> dict:
+    """
+    Serializer context with the entity behind each of a page of notifications
+    and their authors' profiles, resolved up front for the holiday links and icons.
+    :param notifications: notifications on the page
+    :return: context for UserNotificationsSerializer
+    """
+    notifications = list(notifications)
+    entities = resolve_notification_entities(notifications)
+    return {
+        "notification_entities": entities,
+        "profiles": ProfileResolver(
+            e.author_id for e in entities.values() if e.author_id is not None
+        ),
+    }
+
+
+def _walk_comments(comments: List[dict]) -> Iterator[dict]:
+    for c in comments:
+        yield c
+        yield from _walk_comments(c["replies"])
+
+
+def _comment_ids(comments: List[dict]) -> Iterator[int]:
+    return (c["id"] for c in _walk_comments(comments))
+
+
+def add_pending_comment_counts(comments: List[dict]) -> List[dict]:
+    """
+    Add votes and likes not yet flushed to serialized comments and their
+    replies, see incr_counter
+    :param comments: comments from CommentSerializer, changed in place
+    :return: the same comments
+    """
+    add_pending_counts(Comment, _walk_comments(comments))
+    return comments
+
+
+def add_pending_post_counts(posts: List[dict]) -> List[dict]:
+    """ add_pending_comment_counts for serialized posts, their likes included """
+    add_pending_counts(Post, posts)
+    add_pending_comment_counts([c for p in posts for c in p["comments"]])
+    return posts
+
+
+def personalize_posts(posts: List[dict], username: str) -> List[dict]:
+    """
+    Turn posts serialized for anonymous users into what PostSerializer gives
+    the user: blocked and reported posts and comments left out, likes, votes
+    and the user's own unapproved avatar filled in.
+    :param posts: posts serialized without a username
+    :param username: requesting user
+    :return: new serialized posts, the originals are left untouched
+    """
+    profile = UserProfile.objects.select_related("user").get(user__username=username)
+    blocked = set(profile.blocked_users.values_list("username", flat=True))
+    reported_posts = set(profile.reported_posts.values_list("id", flat=True))
+    reported_comments = set(profile.reported_comments.values_list("id", flat=True))
+
+    # Only top level comments are filtered, like PostSerializer.get_comments
+    posts = [
+        {
+            **p,
+            "comments": [
+                c
+                for c in p["comments"]
+                if c["user"] not in blocked and c["id"] not in reported_comments
+            ],
+        }
+        for p in posts
+        if p["user"] not in blocked and p["id"] not in reported_posts
+    ]
+    comment_ids = [i for p in posts for i in _comment_ids(p["comments"])]
+    liked_posts = get_liked_ids(username, Post, [p["id"] for p in posts])
+    liked_comments = get_liked_ids(username, Comment, comment_ids)
+    vote_statuses = get_comment_vote_statuses(username, comment_ids)
+    own_avatar = get_avatar_url(profile, username)
+
+    def personalize(entity: dict) -> dict:
+        if entity["user"].lower() == profile.user.username.lower():
+            entity["avatar"] = own_avatar
+        return entity
+
+    def personalize_comments(comments: List[dict]) -> List[dict]:
+        return [
+            personalize(
+                {
+                    **c,
+                    "vote_status": vote_statuses.get(c["id"], None),
+                    "liked": c["id"] in liked_comments,
+                    "replies": personalize_comments(c["replies"]),
+                }
+            )
+            for c in comments
+        ]
+
+    return [
+        personalize(
+            {
+                **p,
+                "liked": p["id"] in liked_posts,
+                "comments": personalize_comments(p["comments"]),
+            }
+        )
+        for p in posts
+    ]
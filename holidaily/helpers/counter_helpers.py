@@ -0,0 +1,320 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple, Type
+
+import redis
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+from api.models import Comment, Holiday, Post, UserProfile
+from holidaily.helpers.leaderboard_helpers import add_to_leaderboard
+import logging
+
+logger = logging.getLogger("holidaily")
+
+# Counters bumped on every vote and like, written to the database by flush_counters
+COUNTED_FIELDS = {
+    Holiday: ("votes",),
+    Comment: ("votes", "likes"),
+    Post: ("likes",),
+    UserProfile: ("confetti",),
+}
+# Rows updated per statement when flushing
+FLUSH_BATCH_SIZE = 500
+# Longest a flush can hold the flush lock, in case it dies holding it
+FLUSH_LOCK_SECONDS = 60
+
+# Sent by flush_counters once per model with the pks it wrote, for caches of
+# the counted rows
+counters_flushed = Signal()
+
+
+class CounterUnavailable(Exception):
+    """ Raised when a backend can't take or report deltas, callers write to the database instead """
+
+
+def _key(model: Type[models.Model], pk: int, field: str) -> str:
+    return f"{model._meta.label_lower}:{pk}:{field}"
+
+
+def _parse_key(key: str) -> Tuple[Type[models.Model], int, str]:
+    label, pk, field = key.split(":")
+    return apps.get_model(label), int(pk), field
+
+
+class CounterBackend:
+    """
+    Holds counter deltas not yet written to the database. A flush takes the
+    flush lock, claims everything pending, writes it and then releases it,
+    deltas added meanwhile wait for the next flush.
+    """
+
+    def lock(self, timeout: int):
+        """
+        :param timeout: seconds until the lock expires on its own
+        :return: the flush lock, to release() once done, or None if another
+        flush holds it
+        """
+        raise NotImplementedError
+
+    def incr(self, key: str, delta: int) -> None:
+        raise NotImplementedError
+
+    def pending(self, keys: List[str]) -> Dict[str, int]:
+        """
+        :param keys: counters to look up
+        :return: key -> delta not yet in the database, claimed ones included
+        """
+        raise NotImplementedError
+
+    def claim(self) -> Dict[str, int]:
+        """
+        :return: key -> delta to flush. A claim that was never released, i.e.
+        the last flush died, is returned again instead.
+        """
+        raise NotImplementedError
+
+    def release(self) -> None:
+        """ Forget the claimed deltas, once they are in the database """
+        raise NotImplementedError
+
+
+class RedisCounterBackend(CounterBackend):
+    """ Deltas in a Redis hash, bumped with HINCRBY so concurrent requests never lose one """
+
+    PENDING_KEY = "counters_pending"
+    CLAIMED_KEY = "counters_claimed"
+    LOCK_KEY = "counters_flush_lock"
+
+    def __init__(self):
+        self.client = redis.Redis.from_url(
+            settings.COUNTER_REDIS_URL, socket_timeout=1, socket_connect_timeout=1
+        )
+
+    def lock(self, timeout):
+        # SET NX EX, released only by the flush that took it
+        lock = self.client.lock(self.LOCK_KEY, timeout=timeout)
+        try:
+            return lock if lock.acquire(blocking=False) else None
+        except redis.RedisError as e:
+            raise CounterUnavailable(e)
+
+    def incr(self, key, delta):
+        try:
+            self.client.hincrby(self.PENDING_KEY, key, delta)
+        except redis.RedisError as e:
+            raise CounterUnavailable(e)
+
+    def pending(self, keys):
+        if not keys:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hmget(self.PENDING_KEY, keys)
+        pipe.hmget(self.CLAIMED_KEY, keys)
+        try:
+            pending, claimed = pipe.execute()
+        except redis.RedisError as e:
+            raise CounterUnavailable(e)
+        deltas = {}
+        for key, delta, claimed_delta in zip(keys, pending, claimed):
+            total = int(delta or 0) + int(claimed_delta or 0)
+            if total:
+                deltas[key] = total
+        return deltas
+
+    def claim(self):
+        try:
+            if not self.client.exists(self.CLAIMED_KEY):
+                try:
+                    # Atomic, increments from here on start a new pending hash
+                    self.client.rename(self.PENDING_KEY, self.CLAIMED_KEY)
+                except redis.ResponseError:
+                    # Nothing pending
+                    return {}
+            claimed = self.client.hgetall(self.CLAIMED_KEY)
+        except redis.RedisError as e:
+            raise CounterUnavailable(e)
+        return {key.decode(): int(delta) for key, delta in claimed.items()}
+
+    def release(self):
+        try:
+            self.client.delete(self.CLAIMED_KEY)
+        except redis.RedisError as e:
+            raise CounterUnavailable(e)
+
+
+class LocalCounterBackend(CounterBackend):
+    """
+    Deltas kept in process memory, for tests and running without Redis. Only
+    flushes in the same process see them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self._pending = defaultdict(int)
+        self._claimed = {}
+
+    def lock(self, timeout):
+        return self._flush_lock if self._flush_lock.acquire(blocking=False) else None
+
+    def incr(self, key, delta):
+        with self._lock:
+            self._pending[key] += delta
+
+    def pending(self, keys):
+        with self._lock:
+            deltas = {
+                key: self._pending.get(key, 0) + self._claimed.get(key, 0)
+                for key in keys
+            }
+        return {key: delta for key, delta in deltas.items() if delta}
+
+    def claim(self):
+        with self._lock:
+            if not self._claimed:
+                self._claimed, self._pending = dict(self._pending), defaultdict(int)
+            return dict(self._claimed)
+
+    def release(self):
+        with self._lock:
+            self._claimed = {}
+
+
+_backends = {}
+
+
+def get_counter_backend() -> CounterBackend:
+    """ The COUNTER_BACKEND instance for this process """
+    path = settings.COUNTER_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def incr_counter(model: Type[models.Model], pk: int, field: str, delta: int) -> None:
+    """
+    Add to a vote, like or confetti counter without touching its row. The
+    database catches up on the next flush_counters, or right away if the
+    backend is down.
+    :param model: model with the counter, see COUNTED_FIELDS
+    :param pk: row to add to
+    :param field: counter field
+    :param delta: amount to add, negative to subtract
+    """
+    if field not in COUNTED_FIELDS.get(model, ()):
+        raise ValueError(f"{model.__name__}.{field} is not a buffered counter")
+    if not delta or pk is None:
+        return
+    try:
+        get_counter_backend().incr(_key(model, pk, field), delta)
+    except CounterUnavailable as e:
+        logger.warning(f"Counter backend unavailable, writing through: {e}")
+        model.objects.filter(pk=pk).update(**{field: F(field) + delta})
+    if model is UserProfile:
+        add_to_leaderboard(pk, delta)
+
+
+def get_pending_deltas(
+    model: Type[models.Model], field: str, pks: Iterable[int]
+) -> Dict[int, int]:
+    """
+    Deltas of a counter not yet flushed to the database, in one round trip
+    :param model: model with the counter
+    :param field: counter field
+    :param pks: rows to look up
+    :return: pk -> delta, rows without one are left out
+    """
+    keys = {_key(model, pk, field): pk for pk in pks}
+    try:
+        pending = get_counter_backend().pending(list(keys))
+    except CounterUnavailable as e:
+        # Writes are going straight to the database meanwhile
+        logger.warning(f"Counter backend unavailable, reading database values: {e}")
+        return {}
+    return {keys[key]: delta for key, delta in pending.items()}
+
+
+def add_pending_counts(
+    model: Type[models.Model], rows: Iterable[dict], *fields: str
+) -> None:
+    """
+    Add the deltas not yet flushed to serialized rows' counters, in one round
+    trip. Cached rows hold database values, so this is applied on every read.
+    :param model: model the rows were serialized from
+    :param rows: dicts with an "id" and the counter fields, changed in place
+    :param fields: counters to add to, all of the model's COUNTED_FIELDS by default
+    """
+    keys = {
+        _key(model, row["id"], field): (row, field)
+        for row in rows
+        for field in fields or COUNTED_FIELDS[model]
+    }
+    try:
+        pending = get_counter_backend().pending(list(keys))
+    except CounterUnavailable as e:
+        logger.warning(f"Counter backend unavailable, reading database values: {e}")
+        return
+    for key, delta in pending.items():
+        row, field = keys[key]
+        row[field] += delta
+
+
+def get_counter(obj: models.Model, field: str) -> int:
+    """ A loaded object's counter, including increments not yet flushed """
+    return getattr(obj, field) + get_pending_deltas(type(obj), field, [obj.pk]).get(
+        obj.pk, 0
+    )
+
+
+def flush_counters() -> int:
+    """
+    Write pending counter deltas to the database, one UPDATE per counter field
+    and delta for up to FLUSH_BATCH_SIZE rows, in a single transaction. Does
+    nothing while another flush is running, it would write the same claim.
+    :return: number of counters written
+    """
+    backend = get_counter_backend()
+    lock = backend.lock(FLUSH_LOCK_SECONDS)
+    if lock is None:
+        return 0
+    try:
+        claimed = _flush_claim(backend)
+    finally:
+        try:
+            lock.release()
+        except redis.RedisError as e:
+            # i.e. LockNotOwnedError, another flush may have written this claim too
+            logger.error(f"Could not release the counter flush lock: {e}")
+    return claimed
+
+
+def _flush_claim(backend: CounterBackend) -> int:
+    claimed = backend.claim()
+    rows_by_delta = defaultdict(list)
+    flushed_pks = defaultdict(set)
+    for key, delta in claimed.items():
+        if delta:
+            model, pk, field = _parse_key(key)
+            rows_by_delta[(model, field, delta)].append(pk)
+            flushed_pks[model].add(pk)
+
+    with transaction.atomic():
+        for (model, field, delta), pks in rows_by_delta.items():
+            for i in range(0, len(pks), FLUSH_BATCH_SIZE):
+                model.objects.filter(pk__in=pks[i : i + FLUSH_BATCH_SIZE]).update(
+                    **{field: F(field) + delta}
+                )
+    # If this fails the claim is flushed again next time, counting it twice,
+    # rather than dropping it
+    backend.release()
+    for model, pks in flushed_pks.items():
+        counters_flushed.send(sender=model, pks=pks)
+    return len(claimed)
@@ -0,0 +1,434 @@
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import redis
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from api.models import UserProfile
+import logging
+
+logger = logging.getLogger("holidaily")
+
+# Profiles written per round trip when rebuilding
+REBUILD_BATCH_SIZE = 1000
+# Increments stop being recorded for replay if a rebuild dies
+REBUILD_TIMEOUT_SECONDS = 60 * 60
+
+
+class LeaderboardUnavailable(Exception):
+    """ Raised when a backend can't answer, callers should fall back to the database """
+
+
+class LeaderboardEntry(NamedTuple):
+    profile_id: int
+    # 1 for the most confetti
+    rank: int
+    confetti: int
+
+
+class ConfettiLeaderboard:
+    """
+    Every non-staff profile ranked by confetti, pending counter deltas
+    included. Kept up to date by incr_counter and profile and user saves, see
+    rebuild_leaderboard for anything else.
+    """
+
+    def incr(self, profile_id: int, delta: int) -> None:
+        """ Add to a profile's score, putting it on the board unless it's staff """
+        raise NotImplementedError
+
+    def set(self, profile_id: int, confetti: int) -> None:
+        raise NotImplementedError
+
+    def exclude(self, profile_id: int) -> None:
+        """ Take a staff profile off the board, increments leave it off """
+        raise NotImplementedError
+
+    def remove(self, profile_id: int) -> None:
+        raise NotImplementedError
+
+    def top(self, limit: int) -> List[LeaderboardEntry]:
+        """ The profiles with the most confetti, leaving out those without any """
+        raise NotImplementedError
+
+    def around(self, profile_id: int, neighbors: int) -> List[LeaderboardEntry]:
+        """
+        :param profile_id: profile to look up
+        :param neighbors: entries to include on each side
+        :return: the profile's entry and its neighbors, empty if it isn't on the board
+        """
+        raise NotImplementedError
+
+    def rebuild(
+        self, batches: Iterable[List[Tuple[int, int]]], staff_ids: Iterable[int]
+    ) -> None:
+        """
+        Replace the board. Increments to profiles in a batch made after it was
+        read are replayed onto the new board.
+        :param batches: (profile id, confetti) of every profile on the board,
+        in id order and read from the database as each batch is taken
+        :param staff_ids: profiles to exclude
+        """
+        raise NotImplementedError
+
+
+# ZINCRBY leaving staff off, also kept for replay if a running rebuild has
+# already read the profile
+INCR_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return
+end
+redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+local rebuilt_up_to = redis.call('GET', KEYS[3])
+if rebuilt_up_to and tonumber(ARGV[1]) <= tonumber(rebuilt_up_to) then
+    redis.call('ZINCRBY', KEYS[4], ARGV[2], ARGV[1])
+end
+"""
+
+
+class RedisLeaderboard(ConfettiLeaderboard):
+    """ A Redis sorted set, O(log n) to update, rank or page through """
+
+    KEY = "confetti_leaderboard"
+    STAFF_KEY = "confetti_leaderboard_staff"
+    BUILDING_KEY = "confetti_leaderboard_building"
+    # Last profile id a running rebuild has read, and increments made since
+    REBUILT_UP_TO_KEY = "confetti_leaderboard_rebuilt_up_to"
+    REPLAY_KEY = "confetti_leaderboard_replay"
+
+    def __init__(self):
+        self.client = redis.Redis.from_url(
+            settings.LEADERBOARD_REDIS_URL, socket_timeout=1, socket_connect_timeout=1
+        )
+        self._incr = self.client.register_script(INCR_SCRIPT)
+
+    @staticmethod
+    def _entries(rows: List[Tuple[bytes, float]], first_rank: int):
+        return [
+            LeaderboardEntry(int(member), rank, int(score))
+            for rank, (member, score) in enumerate(rows, first_rank)
+        ]
+
+    def incr(self, profile_id, delta):
+        keys = [self.KEY, self.STAFF_KEY, self.REBUILT_UP_TO_KEY, self.REPLAY_KEY]
+        try:
+            self._incr(keys=keys, args=[profile_id, delta])
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+
+    def set(self, profile_id, confetti):
+        pipe = self.client.pipeline()
+        pipe.srem(self.STAFF_KEY, profile_id)
+        pipe.zadd(self.KEY, {profile_id: confetti})
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+
+    def exclude(self, profile_id):
+        pipe = self.client.pipeline()
+        pipe.sadd(self.STAFF_KEY, profile_id)
+        pipe.zrem(self.KEY, profile_id)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+
+    def remove(self, profile_id):
+        pipe = self.client.pipeline()
+        pipe.srem(self.STAFF_KEY, profile_id)
+        pipe.zrem(self.KEY, profile_id)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+
+    def top(self, limit):
+        try:
+            rows = self.client.zrevrangebyscore(
+                self.KEY, "+inf", "(0", start=0, num=limit, withscores=True
+            )
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+        return self._entries(rows, 1)
+
+    def around(self, profile_id, neighbors):
+        try:
+            rank = self.client.zrevrank(self.KEY, profile_id)
+            if rank is None:
+                return []
+            start = max(rank - neighbors, 0)
+            rows = self.client.zrevrange(
+                self.KEY, start, rank + neighbors, withscores=True
+            )
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+        return self._entries(rows, start + 1)
+
+    def rebuild(self, batches, staff_ids):
+        staff_ids = list(staff_ids)
+        try:
+            self.client.delete(self.BUILDING_KEY, self.REPLAY_KEY)
+            self.client.set(self.REBUILT_UP_TO_KEY, 0, ex=REBUILD_TIMEOUT_SECONDS)
+            for batch in batches:
+                if not batch:
+                    continue
+                # Straight after reading, increments from here on are replayed
+                self.client.set(
+                    self.REBUILT_UP_TO_KEY, batch[-1][0], ex=REBUILD_TIMEOUT_SECONDS
+                )
+                self.client.zadd(self.BUILDING_KEY, dict(batch))
+            # In one MULTI, so no increment lands between the replay and the
+            # swap and readers never see a partial board
+            pipe = self.client.pipeline()
+            pipe.zunionstore(self.KEY, [self.BUILDING_KEY, self.REPLAY_KEY])
+            pipe.delete(self.STAFF_KEY)
+            if staff_ids:
+                pipe.sadd(self.STAFF_KEY, *staff_ids)
+            pipe.delete(self.BUILDING_KEY, self.REPLAY_KEY, self.REBUILT_UP_TO_KEY)
+            pipe.execute()
+        except redis.RedisError as e:
+            raise LeaderboardUnavailable(e)
+
+
+class LocalLeaderboard(ConfettiLeaderboard):
+    """
+    A sorted list kept in process memory, for tests and running without
+    Redis. Only changes made in this process are seen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self._scores: Dict[int, int] = {}
+        # (-confetti, profile id), best first
+        self._ranking: List[Tuple[int, int]] = []
+        self._staff = set()
+        # Set while rebuilding, like RedisLeaderboard.REBUILT_UP_TO_KEY
+        self._rebuilt_up_to: Optional[int] = None
+        self._replay = defaultdict(int)
+
+    def _set(self, profile_id: int, confetti: int) -> None:
+        if profile_id in self._scores:
+            old = (-self._scores[profile_id], profile_id)
+            del self._ranking[bisect_left(self._ranking, old)]
+        self._scores[profile_id] = confetti
+        insort(self._ranking, (-confetti, profile_id))
+
+    def _remove(self, profile_id: int) -> None:
+        if profile_id in self._scores:
+            confetti = self._scores.pop(profile_id)
+            del self._ranking[bisect_left(self._ranking, (-confetti, profile_id))]
+
+    def _entries(self, start: int, end: int) -> List[LeaderboardEntry]:
+        return [
+            LeaderboardEntry(profile_id, rank, -score)
+            for rank, (score, profile_id) in enumerate(
+                self._ranking[start:end], start + 1
+            )
+        ]
+
+    def incr(self, profile_id, delta):
+        with self._lock:
+            if profile_id in self._staff:
+                return
+            self._set(profile_id, self._scores.get(profile_id, 0) + delta)
+            if self._rebuilt_up_to is not None and profile_id <= self._rebuilt_up_to:
+                self._replay[profile_id] += delta
+
+    def set(self, profile_id, confetti):
+        with self._lock:
+            self._staff.discard(profile_id)
+            self._set(profile_id, confetti)
+
+    def exclude(self, profile_id):
+        with self._lock:
+            self._staff.add(profile_id)
+            self._remove(profile_id)
+
+    def remove(self, profile_id):
+        with self._lock:
+            self._staff.discard(profile_id)
+            self._remove(profile_id)
+
+    def top(self, limit):
+        with self._lock:
+            end = bisect_left(self._ranking, (0,))
+            return self._entries(0, min(limit, end))
+
+    def around(self, profile_id, neighbors):
+        with self._lock:
+            if profile_id not in self._scores:
+                return []
+            rank = bisect_left(self._ranking, (-self._scores[profile_id], profile_id))
+            start = max(rank - neighbors, 0)
+            return self._entries(start, rank + neighbors + 1)
+
+    def rebuild(self, batches, staff_ids):
+        with self._lock:
+            self._rebuilt_up_to = 0
+            self._replay = defaultdict(int)
+        building = {}
+        for batch in batches:
+            if batch:
+                with self._lock:
+                    self._rebuilt_up_to = batch[-1][0]
+                building.update(batch)
+        with self._lock:
+            replay = self._replay
+            self.reset()
+            self._staff = set(staff_ids)
+            for profile_id in building.keys() | replay.keys():
+                self._set(
+                    profile_id, building.get(profile_id, 0) + replay.get(profile_id, 0)
+                )
+
+
+_backends = {}
+
+
+def get_leaderboard() -> ConfettiLeaderboard:
+    """ The LEADERBOARD_BACKEND instance for this process """
+    path = settings.LEADERBOARD_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def add_to_leaderboard(profile_id: int, delta: int) -> None:
+    """ Apply a confetti change, see incr_counter """
+    try:
+        get_leaderboard().incr(profile_id, delta)
+    except LeaderboardUnavailable as e:
+        # The board catches up on the next rebuild_leaderboard
+        logger.error(f"Could not update leaderboard for profile {profile_id}: {e}")
+
+
+def rebuild_leaderboard() -> int:
+    """
+    Reload the leaderboard from UserProfile, plus confetti not yet flushed
+    :return: number of profiles on the board
+    """
+    # Imported here, counter_helpers updates the board on every increment
+    from holidaily.helpers.counter_helpers import get_pending_deltas
+
+    on_board = 0
+
+    def score_batches() -> Iterator[List[Tuple[int, int]]]:
+        nonlocal on_board
+        last_id = 0
+        while True:
+            batch = list(
+                UserProfile.objects.filter(user__is_staff=False, id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "confetti")[:REBUILD_BATCH_SIZE]
+            )
+            if not batch:
+                return
+            pending = get_pending_deltas(
+                UserProfile, "confetti", [profile_id for profile_id, _ in batch]
+            )
+            on_board += len(batch)
+            last_id = batch[-1][0]
+            yield [
+                (profile_id, confetti + pending.get(profile_id, 0))
+                for profile_id, confetti in batch
+            ]
+
+    staff_ids = UserProfile.objects.filter(user__is_staff=True).values_list(
+        "id", flat=True
+    )
+    get_leaderboard().rebuild(score_batches(), staff_ids)
+    return on_board
+
+
+def get_leaderboard_entries(
+    limit: int, profile_id: Optional[int] = None, neighbors: int = 0
+) -> Tuple[List[LeaderboardEntry], Optional[List[LeaderboardEntry]]]:
+    """
+    Top of the leaderboard, falling back to the database if it's unavailable
+    :param limit: entries from the top
+    :param profile_id: profile to also look up the rank of
+    :param neighbors: entries on each side of profile_id
+    :return: top entries, and profile_id's entry with its neighbors or None if
+    not asked for or unavailable
+    """
+    try:
+        leaderboard = get_leaderboard()
+        top = leaderboard.top(limit)
+        around = None
+        if profile_id is not None:
+            around = leaderboard.around(profile_id, neighbors)
+        return top, around
+    except LeaderboardUnavailable as e:
+        logger.error(f"Leaderboard unavailable, ranking from the database: {e}")
+    rows = (
+        UserProfile.objects.filter(confetti__gt=0, user__is_staff=False)
+        .order_by("-confetti")
+        .values_list("id", "confetti")[:limit]
+    )
+    top = [
+        LeaderboardEntry(row_id, rank, confetti)
+        for rank, (row_id, confetti) in enumerate(rows, 1)
+    ]
+    return top, None
+
+
+def _sync_profile(profile: UserProfile) -> None:
+    from holidaily.helpers.counter_helpers import get_counter
+
+    try:
+        if profile.user.is_staff:
+            get_leaderboard().exclude(profile.id)
+        else:
+            get_leaderboard().set(profile.id, get_counter(profile, "confetti"))
+    except LeaderboardUnavailable as e:
+        logger.error(f"Could not update leaderboard for profile {profile.id}: {e}")
+
+
+# Connected in ApiConfig.ready(). Increments go through incr_counter, this
+# catches new profiles and confetti set outright, i.e. in the admin.
+@receiver(post_save, sender=UserProfile)
+def profile_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and "confetti" not in update_fields:
+        return
+    if created or instance.changed_since_load("confetti"):
+        transaction.on_commit(lambda: _sync_profile(instance))
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Staff are kept off the board, even when their confetti goes up
+    if update_fields is not None and "is_staff" not in update_fields:
+        return
+    user_id = instance.id
+
+    def sync():
+        for profile in UserProfile.objects.filter(user_id=user_id).select_related(
+            "user"
+        ):
+            _sync_profile(profile)
+
+    transaction.on_commit(sync)
+
+
+@receiver(post_delete, sender=UserProfile)
+def profile_removed(sender, instance, **kwargs):
+    profile_id = instance.id
+
+    def remove():
+        try:
+            get_leaderboard().remove(profile_id)
+        except LeaderboardUnavailable as e:
+            logger.error(f"Could not update leaderboard for profile {profile_id}: {e}")
+
+    transaction.on_commit(remove)
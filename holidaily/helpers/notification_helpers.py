@@ -1,15 +1,16 @@
 import re
-from typing import Union, Optional
+from datetime import timedelta
+from typing import Iterable, List, Union, Optional
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives
+from django.db import IntegrityError, transaction
+from django.db.models import F, Min
 from django.template.loader import render_to_string
-from push_notifications.apns import APNSServerError
-from push_notifications.models import APNSDevice, GCMDevice
+from django.utils import timezone
 
 from api.constants import (
-    IOS,
     DEFAULT_SLACK_CHANNEL,
     HOLIDAY_SUBMISSION_REWARD,
     COMMENT_NOTIFICATION,
@@ -18,7 +19,16 @@ from api.constants import (
     HOLIDAY_NOTIFICATION,
     LIKE_COMMENT_NOTIFICATION,
 )
-from api.models import UserProfile, Comment, UserNotifications, Holiday, Post
+from api.models import (
+    UserProfile,
+    Comment,
+    UserNotifications,
+    Holiday,
+    Post,
+    PendingLike,
+)
+from holidaily.helpers.counter_helpers import incr_counter
+from holidaily.helpers.push_helpers import PushIntent, deliver_pushes
 from holidaily.settings import SLACK_CLIENT
 import logging
 
@@ -35,20 +45,99 @@ def add_notification(
     :param user: user to receive notification
     :param content: body of notification
     :param title: title of notification
-    :return: the new notification
+    :return: the new notification, None if the user already had it
     """
-    if UserNotifications.objects.filter(
-        notification_id=n_id, notification_type=n_type, user=user
-    ).exists():
-        return
-    new_notification = UserNotifications.objects.create(
-        notification_id=n_id,
-        notification_type=n_type,
-        user=user,
-        content=content,
-        title=title,
+    try:
+        # In a savepoint so a caller's transaction survives the conflict
+        with transaction.atomic():
+            return UserNotifications.objects.create(
+                notification_id=n_id,
+                notification_type=n_type,
+                user=user,
+                content=content,
+                title=title,
+            )
+    except IntegrityError:
+        # unique_user_notification, already notified
+        return None
+
+
+def add_notifications(
+    n_id: int, n_type: int, user_ids: Iterable[int], content: str, title: str
+) -> List[int]:
+    """
+    Add the same notification for many users in one INSERT, skipping users
+    that already have it
+    :param n_id: notification id, pk
+    :param n_type: notification type
+    :param user_ids: users to receive notification
+    :param content: body of notification
+    :param title: title of notification
+    :return: ids of the users newly notified
+    """
+    user_ids = set(user_ids)
+    user_ids -= set(
+        UserNotifications.objects.filter(
+            notification_id=n_id, notification_type=n_type, user_id__in=user_ids
+        ).values_list("user_id", flat=True)
     )
-    return new_notification
+    if not user_ids:
+        return []
+    try:
+        with transaction.atomic():
+            UserNotifications.objects.bulk_create(
+                UserNotifications(
+                    notification_id=n_id,
+                    notification_type=n_type,
+                    user_id=user_id,
+                    content=content,
+                    title=title,
+                )
+                for user_id in user_ids
+            )
+            # bulk_create skips save(), which counts single notifications
+            UserProfile.objects.filter(user_id__in=user_ids).update(
+                unread_notifications=F("unread_notifications") + 1
+            )
+    except IntegrityError:
+        # Some were notified concurrently, add and count the rest one by one
+        user_ids = {
+            user.id
+            for user in User.objects.filter(id__in=user_ids)
+            if add_notification(n_id, n_type, user, content, title)
+        }
+    return sorted(user_ids)
+
+
+def get_unread_count(user_id: Optional[int]) -> int:
+    """ A user's unread notifications, from the counter on their profile """
+    unread = (
+        UserProfile.objects.filter(user_id=user_id)
+        .order_by("id")
+        .values_list("unread_notifications", flat=True)
+        .first()
+    )
+    # Only ever off until the next sync_counters
+    return max(unread or 0, 0)
+
+
+def mark_notifications_read(user_id: Optional[int], *conditions, **filters) -> int:
+    """
+    Mark a user's unread notifications read, in one UPDATE, and take them off
+    their counter
+    :param user_id: owner of the notifications
+    :param conditions: Q objects narrowing down which of their notifications
+    :param filters: same as conditions, all of them if neither is given
+    :return: how many were marked read
+    """
+    if user_id is None:
+        return 0
+    with transaction.atomic():
+        marked = UserNotifications.objects.filter(
+            *conditions, user_id=user_id, read=False, **filters
+        ).update(read=True)
+        UserProfile.adjust_counters(user_id, unread_notifications=-marked)
+    return marked
 
 
 def send_email_to_user(
@@ -120,17 +209,11 @@ def send_email_to_user(
     return True
 
 
-def send_push_to_user(
+def build_push_intent(
     user: User, title: str, body: str, notif_obj: Union[Comment, Holiday, str], **kwargs
-) -> bool:
-    """ Send push notification to a user. Returns True if success, False otherwise. """
+) -> Optional[PushIntent]:
+    """ The push to send a user about notif_obj, None if it isn't something we push """
     extra_data = {}
-    profile = UserProfile.objects.filter(user=user, logged_out=False).first()
-    if not profile:
-        return False
-    platform = profile.platform
-    unread = UserNotifications.objects.filter(user=user, read=False).count()
-    extra_data["unread"] = unread
     if isinstance(notif_obj, (Comment, Post)):
         # This is type "comment" but can technically also be a post.
         # It's handled as a "comment" in app to redirect.
@@ -169,56 +252,40 @@ def send_push_to_user(
                 # todo this will be none if it's a comment like
                 extra_data["post_id"] = entity_id
         else:
-            return False
+            return None
     else:
-        return False
-
-    device_class = APNSDevice if platform == IOS else GCMDevice
-    device = device_class.objects.filter(user=user).last()
-    if not device:
-        profile.device_active = False
-        profile.save()
-        return False
+        return None
+    return PushIntent(user.id, title, body, extra_data)
 
-    unread = UserNotifications.objects.filter(user=user, read=False).count()
 
-    if platform == IOS:
-        try:
-            device.send_message(
-                message={"title": title, "body": body}, extra=extra_data, badge=unread,
-            )
-        except APNSServerError as e:
-            logger.error(msg=f"Could not send push to iOS user {user.username}: {e}")
-            device.delete()
-            profile.device_active = False
-            profile.save()
-            return False
-    else:
-        push_sent = device.send_message(
-            body, title=title, badge=unread, extra=extra_data
-        )
-        if not push_sent.get("success"):
-            logger.error(
-                msg=f"Could not send push to Android user {user.username}: {push_sent.get('results')}"
-            )
-            device.delete()
-            profile.device_active = False
-            profile.save()
-            return False
-    return True
+def send_push_to_user(
+    user: User, title: str, body: str, notif_obj: Union[Comment, Holiday, str], **kwargs
+) -> bool:
+    """ Send push notification to a user. Returns True if success, False otherwise. """
+    intent = build_push_intent(user, title, body, notif_obj, **kwargs)
+    if intent is None:
+        return False
+    return deliver_pushes([intent])[user.id]
 
 
 def send_slack(message: str, channel: str = DEFAULT_SLACK_CHANNEL):
     SLACK_CLIENT.chat_postMessage(channel=f"#{channel}", text=message)
 
 
-def award_and_notify_user_for_holiday(holiday: Holiday) -> bool:
+def award_user_for_holiday(holiday: Holiday) -> Optional[PushIntent]:
+    """
+    Award the creator of an approved holiday and add their notification
+    :param holiday: the approved holiday
+    :return: the push to queue for them, see the send_pushes task, None if
+    they have no profile
+    """
     creator = holiday.creator
     user_profile = UserProfile.objects.filter(user=creator).first()
     if not user_profile:
-        return False
-    user_profile.confetti += HOLIDAY_SUBMISSION_REWARD
-    user_profile.save()
+        return None
+    incr_counter(UserProfile, user_profile.id, "confetti", HOLIDAY_SUBMISSION_REWARD)
+    holiday.creator_awarded = True
+    holiday.save(update_fields=["creator_awarded"])
 
     push_title = "Holiday Approved"
     push_body = f"{holiday.name} was approved and you have been awarded {HOLIDAY_SUBMISSION_REWARD} confetti!"
@@ -231,81 +298,184 @@ def award_and_notify_user_for_holiday(holiday: Holiday) -> bool:
         "Holiday Approved",
     )
 
-    push_sent = send_push_to_user(creator, push_title, push_body, holiday)
-    if push_sent:
-        holiday.creator_awarded = True
-        holiday.save()
-        return True
-    else:
-        email_sent = send_email_to_user(creator, holiday, approval=True)
-        if email_sent:
-            holiday.creator_awarded = True
-            holiday.save()
-            return True
-    return False
-
+    return build_push_intent(creator, push_title, push_body, holiday)
 
-def notify_mentioned_users(notification: Union[Comment, Post]) -> None:
 
+def notify_mentioned_users(notification: Union[Comment, Post]) -> List[int]:
+    """
+    Add a notification for every user @mentioned in a comment or post. Pushes
+    are left to the caller, see the notify_mentions task.
+    :param notification: the comment or post
+    :return: ids of the users newly notified
+    """
     content = notification.content
     username = notification.user.username
     holiday = notification.holiday
-    notification_type = None
     if isinstance(notification, Comment):
         notification_type = COMMENT_NOTIFICATION
     elif isinstance(notification, Post):
         notification_type = POST_NOTIFICATION
     else:
-        raise (f"Not a valid notification type: {type(notification_type)}")
-
-    mentions = list(set(re.findall(r"@([^\s.,\?\"\'\;]+)", content)))
-    for user_mention in mentions:
-        if user_mention == username:
-            continue
-        # Get user profiles, exclude self if user mentions themself for some reason
-        user_to_notify = User.objects.filter(username=user_mention).first()
-        if user_to_notify:
-            n = add_notification(
-                notification.pk,
-                notification_type,
-                user_to_notify,
-                content,
-                f"{username} on {holiday.name}",
-            )
-            push_sent = send_push_to_user(
-                user_to_notify,
-                f"{username} mentioned you on {holiday.name}",
-                f"{content[:100]}{'...' if len(content) > 100 else ''}",
-                notification,
-            )
-            if not push_sent and settings.EMAIL_NOTIFICATIONS_ENABLED:
-                send_email_to_user(user_to_notify, n)
+        raise ValueError(f"Not a valid notification type: {type(notification)}")
+
+    # Exclude self if user mentions themself for some reason
+    mentions = set(re.findall(r"@([^\s.,\?\"\'\;]+)", content)) - {username}
+    if not mentions:
+        return []
+    user_ids = (
+        User.objects.filter(username__in=mentions)
+        .exclude(id=notification.user_id)
+        .values_list("id", flat=True)
+    )
+    return add_notifications(
+        notification.pk,
+        notification_type,
+        user_ids,
+        content,
+        f"{username} on {holiday.name}",
+    )
 
 
-def notify_liked_user(obj: Union[Post, Comment], user: User) -> bool:
+def mention_push_intent(user: User, notification: Union[Comment, Post]) -> PushIntent:
+    """
+    The push telling a user they were mentioned
+    :param user: mentioned user
+    :param notification: comment or post they were mentioned in
     """
-    This should accept any entity that can be liked
+    content = notification.content
+    username = notification.user.username
+    holiday_name = notification.holiday.name
+    return build_push_intent(
+        user,
+        f"{username} mentioned you on {holiday_name}",
+        f"{content[:100]}{'...' if len(content) > 100 else ''}",
+        notification,
+    )
+
+
+def email_mention(user: User, notification: Union[Comment, Post]) -> bool:
+    """
+    Email a mention to a user the push couldn't reach
+    :param user: mentioned user
+    :param notification: comment or post they were mentioned in
+    :return: True if the email was sent
+    """
+    if not settings.EMAIL_NOTIFICATIONS_ENABLED:
+        return False
+    n = UserNotifications.objects.filter(
+        user=user,
+        notification_id=notification.pk,
+        notification_type=COMMENT_NOTIFICATION
+        if isinstance(notification, Comment)
+        else POST_NOTIFICATION,
+    ).first()
+    return bool(n) and send_email_to_user(user, n)
+
+
+def _like_notification_type(obj: Union[Post, Comment]) -> int:
+    return LIKE_NOTIFICATION if isinstance(obj, Post) else LIKE_COMMENT_NOTIFICATION
+
+
+def queue_like_notification(obj: Union[Post, Comment], user: User) -> None:
+    """
+    Buffer a like for flush_like_notifications, liking again before it's
+    flushed doesn't count twice
     :param obj: The entity being liked
     :param user: The user that liked the entity
-    :return: True/False depending on success
     """
-    entity = obj.__class__.__name__.lower()
-    notif_type = LIKE_NOTIFICATION if entity == "post" else LIKE_COMMENT_NOTIFICATION
-    add_notification(
-        obj.pk,
-        notif_type,
-        obj.user,
-        f"{user.username} liked your {entity} on {obj.holiday.name}",
-        f"{user.username}",
+    PendingLike.objects.bulk_create(
+        [
+            PendingLike(
+                notification_type=_like_notification_type(obj),
+                entity_id=obj.pk,
+                liker=user,
+            )
+        ],
+        ignore_conflicts=True,
     )
-    push_sent = send_push_to_user(
+
+
+def cancel_like_notification(obj: Union[Post, Comment], user: User) -> None:
+    """ Drop a buffered like that was taken back before being notified """
+    PendingLike.objects.filter(
+        notification_type=_like_notification_type(obj), entity_id=obj.pk, liker=user
+    ).delete()
+
+
+def _notify_likes(
+    n_type: int, entity_id: int, likers: List[str]
+) -> Optional[PushIntent]:
+    """
+    Replace the author's notification for an entity with one for its latest
+    likes, counting everyone who has liked it so far
+    :param n_type: LIKE_NOTIFICATION or LIKE_COMMENT_NOTIFICATION
+    :param entity_id: liked post or comment
+    :param likers: usernames of the likes being flushed, most recent first
+    :return: the push for the author, None if the entity is gone
+    """
+    model = Post if n_type == LIKE_NOTIFICATION else Comment
+    obj = model.objects.select_related("user", "holiday").filter(id=entity_id).first()
+    if obj is None:
+        return None
+    entity = model.__name__.lower()
+    # Earlier windows' likers too, the author's own like never notifies
+    liked_by = obj.user_likes.exclude(id=obj.user_id).count()
+    others = max(liked_by, len(likers)) - 1
+    if others:
+        who = f"{likers[0]} and {others} other{'s' if others > 1 else ''}"
+    else:
+        who = likers[0]
+    content = f"{who} liked your {entity} on {obj.holiday.name}"
+
+    with transaction.atomic():
+        # Replaced rather than updated, so it comes back to the top of the inbox
+        UserNotifications.objects.filter(
+            user=obj.user, notification_type=n_type, notification_id=entity_id
+        ).delete()
+        add_notification(entity_id, n_type, obj.user, content, likers[0])
+    return build_push_intent(
         obj.user,
-        f"{user.username}",
-        f"{user.username} liked your {entity} on {obj.holiday.name}",
+        likers[0],
+        content,
         "like",
         holiday_id=obj.holiday.id,
         holiday_name=obj.holiday.name,
         entity_id=obj.id,
         entity_type=entity,
     )
-    return push_sent
+
+
+def flush_like_notifications(window_seconds: int) -> List[PushIntent]:
+    """
+    Merge buffered likes into one notification per post or comment, i.e.
+    "alice and 12 others liked your post on ...". Entities are flushed once
+    their first buffered like is window_seconds old.
+    :param window_seconds: how long to wait for more likes
+    :return: a push per notification, for the caller to send
+    """
+    cutoff = timezone.now() - timedelta(seconds=window_seconds)
+    due = (
+        PendingLike.objects.values_list("notification_type", "entity_id")
+        .annotate(first_like=Min("created"))
+        .filter(first_like__lte=cutoff)
+        .order_by()
+    )
+    intents = []
+    for n_type, entity_id, _ in due:
+        likes = list(
+            PendingLike.objects.filter(notification_type=n_type, entity_id=entity_id)
+            .order_by("-created", "-id")
+            .values_list("id", "liker__username")
+        )
+        with transaction.atomic():
+            intent = _notify_likes(
+                n_type, entity_id, [username for _, username in likes]
+            )
+            # Only what was read, likes arriving meanwhile wait for the next
+            # flush. Kept for the next flush if notifying fails.
+            PendingLike.objects.filter(
+                id__in=[like_id for like_id, _ in likes]
+            ).delete()
+        if intent is not None:
+            intents.append(intent)
+    return intents
@@ -0,0 +1,511 @@
+import json
+import time
+from collections import defaultdict
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from push_notifications.models import APNSDevice, GCMDevice
+
+from api.constants import IOS, ANDROID
+from api.models import Holiday, PushRun, UserProfile
+import logging
+
+logger = logging.getLogger("holidaily")
+
+DEVICE_MODELS = {IOS: APNSDevice, ANDROID: GCMDevice}
+# APNs reasons that mean the token will never work again
+APNS_PERMANENT_FAILURES = ("Unregistered", "BadDeviceToken")
+
+
+class TokenBucket:
+    """
+    Rate limit shared between workers through the cache. Tokens refill at rate
+    per second up to capacity, taking more than are available puts the bucket
+    in debt and returns how long to wait before using them.
+    """
+
+    LOCK_SECONDS = 5
+
+    def __init__(self, key: str, rate: float, capacity: float):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def take(self, tokens: float) -> float:
+        """
+        Reserve tokens
+        :param tokens: how many to take
+        :return: seconds to wait before spending them
+        """
+        lock_key = f"{self.key}_lock"
+        while not cache.add(lock_key, 1, self.LOCK_SECONDS):
+            time.sleep(0.01)
+        try:
+            now = time.time()
+            state = cache.get(self.key) or {"tokens": self.capacity, "updated": now}
+            available = min(
+                self.capacity, state["tokens"] + (now - state["updated"]) * self.rate
+            )
+            available -= tokens
+            # Kept until the debt and refill could matter again
+            timeout = int((self.capacity - available) / self.rate) + 60
+            cache.set(self.key, {"tokens": available, "updated": now}, timeout)
+        finally:
+            cache.delete(lock_key)
+        return max(0.0, -available / self.rate)
+
+
+def get_push_bucket(run: PushRun) -> TokenBucket:
+    """ Both platforms of a day's push share one bucket, the load is on our API either way """
+    return TokenBucket(f"daily_push_bucket_{run.date}", run.rate, run.chunk_size)
+
+
+def start_push_runs(holiday: Holiday, window: int, chunk_size: int) -> List[PushRun]:
+    """
+    Create today's staggered push runs, or return the existing ones to resume
+    :param holiday: holiday being pushed
+    :param window: seconds to spread sends over
+    :param chunk_size: devices sent to per task
+    :return: a run per platform
+    """
+    today = timezone.now().date()
+    total = sum(
+        model.objects.filter(active=True).count() for model in DEVICE_MODELS.values()
+    )
+    rate = max(total / window, 1.0)
+    return [
+        PushRun.objects.get_or_create(
+            date=today,
+            platform=platform,
+            defaults={"holiday": holiday, "rate": rate, "chunk_size": chunk_size},
+        )[0]
+        for platform in DEVICE_MODELS
+    ]
+
+
+def _next_device_chunk(
+    device_model: Type[Union[APNSDevice, GCMDevice]], after_id: int, chunk_size: int
+) -> Tuple[List[int], Optional[int]]:
+    """
+    The next chunk of active devices in id order, skipping tokens registered
+    more than once so each is only sent to from its first device
+    :param device_model: APNSDevice or GCMDevice
+    :param after_id: last device id of the previous chunk
+    :param chunk_size: devices to look at
+    :return: device ids to send to, and the id to continue after or None at the end
+    """
+    chunk = list(
+        device_model.objects.filter(active=True, id__gt=after_id)
+        .order_by("id")
+        .values_list("id", "registration_id")[:chunk_size]
+    )
+    if not chunk:
+        return [], None
+    first_ids = dict(
+        device_model.objects.filter(
+            active=True, registration_id__in={token for _, token in chunk}
+        )
+        .values_list("registration_id")
+        .annotate(first_id=Min("id"))
+        .order_by()
+    )
+    device_ids = [
+        device_id for device_id, token in chunk if first_ids[token] == device_id
+    ]
+    return device_ids, chunk[-1][0]
+
+
+def iter_device_chunks(
+    device_model: Type[Union[APNSDevice, GCMDevice]], chunk_size: int
+) -> Iterator[List[int]]:
+    """ Every active device to push to, chunk_size devices at a time """
+    after_id = 0
+    while after_id is not None:
+        device_ids, after_id = _next_device_chunk(device_model, after_id, chunk_size)
+        if device_ids:
+            yield device_ids
+
+
+def claim_push_chunk(run_id: int) -> Optional[List[int]]:
+    """
+    Claim the next chunk of a run's devices. The checkpoint is committed before
+    anything is sent.
+    :param run_id: PushRun to advance
+    :return: device ids to send to, None once the run is finished
+    """
+    with transaction.atomic():
+        run = PushRun.objects.select_for_update().get(id=run_id)
+        if run.finished:
+            return None
+        device_ids, last_device_id = _next_device_chunk(
+            DEVICE_MODELS[run.platform], run.last_device_id, run.chunk_size
+        )
+        if last_device_id is None:
+            run.finished = timezone.now()
+            run.save(update_fields=["finished"])
+            return None
+        run.last_device_id = last_device_id
+        run.sent += len(device_ids)
+        run.save(update_fields=["last_device_id", "sent"])
+    return device_ids
+
+
+def record_rejected_devices(run_id: int, device_ids: Set[int]) -> None:
+    """
+    Keep the devices a run's chunk was rejected for, deleted once it finishes
+    :param run_id: PushRun the chunk belongs to
+    :param device_ids: devices marked inactive while sending the chunk
+    """
+    if not device_ids:
+        return
+    with transaction.atomic():
+        run = PushRun.objects.select_for_update().get(id=run_id)
+        run.rejected_device_ids = sorted(set(run.rejected_device_ids) | device_ids)
+        run.save(update_fields=["rejected_device_ids"])
+
+
+def get_unread_counts(user_ids: Iterable[int]) -> Dict[int, int]:
+    """
+    Unread notifications of each user, from their profile counters in one query
+    :param user_ids: users to count for
+    :return: user id -> unread count, users without a profile are left out
+    """
+    # Descending, so the oldest profile wins like get_unread_count
+    return dict(
+        UserProfile.objects.filter(user_id__in=set(user_ids))
+        .order_by("-id")
+        .values_list("user_id", "unread_notifications")
+    )
+
+
+def send_daily_push_with_badges(
+    device_model: Type[Union[APNSDevice, GCMDevice]],
+    device_ids: List[int],
+    holiday: Holiday,
+) -> Set[int]:
+    """
+    Send a holiday's daily push to a chunk of devices, badged with each owner's
+    unread notifications. Devices are sent to in one batch per badge value.
+    :param device_model: APNSDevice or GCMDevice
+    :param device_ids: devices to send to
+    :param holiday: holiday being pushed
+    :return: ids of the devices the push wasn't delivered to
+    """
+    devices = list(
+        device_model.objects.filter(id__in=device_ids).values_list("id", "user_id")
+    )
+    unread = get_unread_counts(user_id for _, user_id in devices if user_id)
+    by_badge = defaultdict(list)
+    for device_id, user_id in devices:
+        # Counting the holiday itself, which isn't a notification
+        by_badge[max(unread.get(user_id, 0), 1)].append(device_id)
+    failed = set()
+    for badge, badge_device_ids in by_badge.items():
+        failed |= send_daily_push(device_model, badge_device_ids, holiday, badge=badge)
+    return failed
+
+
+def send_daily_push(
+    device_model: Type[Union[APNSDevice, GCMDevice]],
+    device_ids: List[int],
+    holiday: Holiday,
+    badge: int = 1,
+) -> Set[int]:
+    """
+    Send a holiday's daily push to devices of one platform
+    :param device_model: APNSDevice or GCMDevice
+    :param device_ids: devices to send to
+    :param holiday: holiday being pushed
+    :param badge: app icon badge
+    :return: ids of the devices the push wasn't delivered to
+    """
+    push = holiday.push if holiday.push else "Check out today's holidays!"
+    extra = {
+        "holiday_id": holiday.id,
+        "holiday_name": holiday.name,
+        "push_type": "holiday",
+    }
+    return get_push_backend().send(
+        device_model, device_ids, holiday.name, push, badge, extra
+    )
+
+
+def find_rejected(
+    device_model: Type[Union[APNSDevice, GCMDevice]], failed_ids: Iterable[int]
+) -> Set[int]:
+    """
+    The devices a send failed for that it marked inactive. Only active devices
+    are sent to, so these were rejected just now and the rest may go through
+    next time.
+    :param device_model: APNSDevice or GCMDevice
+    :param failed_ids: ids returned by PushBackend.send
+    """
+    return set(
+        device_model.objects.filter(id__in=failed_ids, active=False).values_list(
+            "id", flat=True
+        )
+    )
+
+
+class PushIntent(NamedTuple):
+    """ A push for one user, see deliver_pushes. Plain data, so it can be queued. """
+
+    user_id: int
+    title: str
+    body: str
+    extra: dict
+
+
+class PushBackend:
+    """ Sends one payload to many devices of a platform """
+
+    def send(
+        self,
+        device_model: Type[Union[APNSDevice, GCMDevice]],
+        device_ids: List[int],
+        title: str,
+        body: str,
+        badge: int,
+        extra: dict,
+    ) -> Set[int]:
+        """
+        :return: ids of the devices the push wasn't delivered to. Those whose
+        tokens will never work again are marked inactive, the rest may be
+        retried.
+        """
+        raise NotImplementedError
+
+
+class DjangoPushBackend(PushBackend):
+    """
+    APNs and FCM through django-push-notifications, one FCM multicast or one
+    APNs connection per call
+    """
+
+    def send(self, device_model, device_ids, title, body, badge, extra):
+        devices = device_model.objects.filter(id__in=device_ids, active=True)
+        tokens = dict(devices.values_list("registration_id", "id"))
+        # Copied, the FCM sender adds the message to it
+        extra = dict(extra)
+        if device_model is APNSDevice:
+            failed = self._send_apns(devices, set(tokens), title, body, badge, extra)
+        else:
+            failed = self._send_fcm(devices, set(tokens), title, body, badge, extra)
+        if failed:
+            logger.error(
+                f"Could not push to {len(failed)} of {len(tokens)} "
+                f"{device_model.__name__} devices"
+            )
+        return {tokens[token] for token in failed}
+
+    @staticmethod
+    def _send_apns(devices, tokens, title, body, badge, extra) -> Set[str]:
+        """
+        :return: tokens APNs didn't accept the push for
+        """
+        responses = devices.send_message(
+            message={"title": title, "body": body}, extra=extra, badge=badge
+        )
+        statuses = {}
+        for response in responses:
+            for token, result in response.items():
+                # Unregistered comes with the time it stopped being valid
+                statuses[token] = result[0] if isinstance(result, tuple) else result
+        # The rest, like TooManyRequests or ServiceUnavailable, may go through later
+        APNSDevice.objects.filter(
+            registration_id__in=[
+                token
+                for token, status in statuses.items()
+                if status in APNS_PERMANENT_FAILURES
+            ]
+        ).update(active=False)
+        sent = {token for token, status in statuses.items() if status == "Success"}
+        return tokens - sent
+
+    @staticmethod
+    def _send_fcm(devices, tokens, title, body, badge, extra) -> Set[str]:
+        """
+        :return: tokens FCM didn't accept the push for
+        """
+        # Imported here like push_notifications does
+        from push_notifications.gcm import GCMError
+
+        try:
+            responses = devices.send_message(
+                body, title=title, badge=badge, extra=extra
+            )
+        except GCMError as e:
+            # Raised after the first response with an error other than an
+            # unregistered token, the other responses are lost with it
+            tokens_sent_to = {
+                result["original_registration_id"]
+                for result in e.args[0]["results"]
+                if "error" not in result
+            }
+            return tokens - tokens_sent_to
+        failed = set()
+        for response in responses:
+            # One response per FCM request, a list when split into chunks
+            for chunk in response if isinstance(response, list) else [response]:
+                # Results only name their token when something failed, and the
+                # library has already marked the unregistered ones inactive
+                if chunk.get("failure"):
+                    failed |= {
+                        result["original_registration_id"]
+                        for result in chunk["results"]
+                        if "error" in result
+                    }
+        return failed
+
+
+class FakePushBackend(PushBackend):
+    """
+    Records pushes instead of sending them, for tests and throughput runs.
+    Each call waits latency seconds like a round trip to APNs/FCM would,
+    tokens in reject are treated as unregistered and those in fail as
+    temporarily failing.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        reject: Iterable[str] = (),
+        fail: Iterable[str] = (),
+    ):
+        self.latency = latency
+        self.reject = set(reject)
+        self.fail = set(fail)
+        self.reset()
+
+    def reset(self) -> None:
+        self.batches = 0
+        # (platform, device id, title, badge, extra) of every push
+        self.sent: List[Tuple[str, int, str, int, dict]] = []
+
+    def send(self, device_model, device_ids, title, body, badge, extra):
+        time.sleep(self.latency)
+        self.batches += 1
+        platform = IOS if device_model is APNSDevice else ANDROID
+        self.sent.extend(
+            (platform, device_id, title, badge, extra) for device_id in device_ids
+        )
+        if not self.reject and not self.fail:
+            return set()
+        failed = dict(
+            device_model.objects.filter(
+                id__in=device_ids, registration_id__in=self.reject | self.fail
+            ).values_list("id", "registration_id")
+        )
+        device_model.objects.filter(
+            id__in=failed, registration_id__in=self.reject
+        ).update(active=False)
+        return set(failed)
+
+
+_backends = {}
+
+
+def get_push_backend() -> PushBackend:
+    """ The PUSH_BACKEND instance for this process """
+    path = settings.PUSH_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def deliver_pushes(
+    intents: Iterable[PushIntent], backend: Optional[PushBackend] = None
+) -> Dict[int, bool]:
+    """
+    Send pushes to each user's latest device on their platform. Users sharing a
+    platform and payload are sent to in one batch, badged with their unread
+    notifications. Devices the send marked inactive are deleted and users left
+    without one marked device_active=False, in bulk.
+    :param intents: pushes to send
+    :param backend: PUSH_BACKEND by default
+    :return: user id -> whether their push was sent
+    """
+    intents = list(intents)
+    backend = backend or get_push_backend()
+    delivered = {intent.user_id: False for intent in intents}
+
+    # Descending, so the oldest profile wins like .first() would
+    profiles = dict(
+        (user_id, (platform, unread))
+        for user_id, platform, unread in UserProfile.objects.filter(
+            user_id__in=delivered, logged_out=False
+        )
+        .order_by("-id")
+        .values_list("user_id", "platform", "unread_notifications")
+    )
+    users_by_model = defaultdict(list)
+    for user_id, (platform, _) in profiles.items():
+        users_by_model[APNSDevice if platform == IOS else GCMDevice].append(user_id)
+    latest_devices = {}
+    for device_model, user_ids in users_by_model.items():
+        rows = (
+            device_model.objects.filter(user_id__in=user_ids, active=True)
+            .values_list("user")
+            .annotate(latest=Max("id"))
+            .order_by()
+        )
+        for user_id, device_id in rows:
+            latest_devices[user_id] = (device_model, device_id)
+
+    batches = defaultdict(list)
+    for intent in intents:
+        if intent.user_id not in latest_devices:
+            continue
+        device_model, device_id = latest_devices[intent.user_id]
+        unread = max(profiles[intent.user_id][1], 0)
+        extra = {**intent.extra, "unread": unread}
+        key = (device_model, intent.title, intent.body, unread, json.dumps(extra))
+        batches[key].append((intent.user_id, device_id))
+
+    failed_devices = defaultdict(set)
+    for (device_model, title, body, badge, extra), recipients in batches.items():
+        device_ids = [device_id for _, device_id in recipients]
+        failed = backend.send(
+            device_model, device_ids, title, body, badge, json.loads(extra)
+        )
+        for user_id, device_id in recipients:
+            if device_id in failed:
+                failed_devices[device_model].add(device_id)
+            else:
+                delivered[user_id] = True
+
+    rejected_devices = defaultdict(set)
+    for device_model, device_ids in failed_devices.items():
+        rejected_devices[device_model] = find_rejected(device_model, device_ids)
+        if rejected_devices[device_model]:
+            logger.warning(
+                f"{len(rejected_devices[device_model])} {device_model.__name__} "
+                f"tokens rejected, deleting"
+            )
+            device_model.objects.filter(id__in=rejected_devices[device_model]).delete()
+    without_device = set(profiles) - {
+        user_id
+        for user_id, (device_model, device_id) in latest_devices.items()
+        if device_id not in rejected_devices[device_model]
+    }
+    if without_device:
+        UserProfile.objects.filter(user_id__in=without_device).update(
+            device_active=False
+        )
+    return delivered
@@ -0,0 +1,267 @@
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from elasticsearch import ElasticsearchException
+from elasticsearch.client import IndicesClient
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Q, Search
+
+from api.constants import SEARCH_STOPWORDS
+from api.models import Holiday
+import logging
+
+logger = logging.getLogger("holidaily")
+
+# Relevance of a term found in each field
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+# Relevance of each kind of match, relative to an exact one
+PREFIX_MATCH = 0.6
+FUZZY_MATCH = 0.4
+
+
+class SearchUnavailable(Exception):
+    """ Raised when a backend can't answer, callers should fall back to the database """
+
+
+def tokenize(text: str) -> List[str]:
+    """ Lowercase words of a name or search term, minus words every holiday has """
+    words = re.findall(r"[a-z0-9]+", (text or "").lower().replace("'", ""))
+    return [w for w in words if w not in SEARCH_STOPWORDS]
+
+
+def _max_edits(term: str) -> int:
+    # Same thresholds as Elasticsearch's AUTO fuzziness
+    if len(term) < 3:
+        return 0
+    return 1 if len(term) < 6 else 2
+
+
+def _within_edit_distance(a: str, b: str, max_edits: int) -> bool:
+    """ Levenshtein distance check that gives up once a row exceeds max_edits """
+    if abs(len(a) - len(b)) > max_edits:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        if min(current) > max_edits:
+            return False
+        previous = current
+    return previous[-1] <= max_edits
+
+
+class HolidaySearchBackend:
+    """
+    Full text search over holiday names and descriptions. Backends rank every
+    holiday, visibility is left to the caller.
+    """
+
+    def search(self, term: str, limit: int) -> List[int]:
+        """
+        :param term: user's search term
+        :param limit: max results
+        :return: matching holiday ids, most relevant first
+        """
+        raise NotImplementedError
+
+    def index(self, holiday: Holiday) -> None:
+        raise NotImplementedError
+
+    def remove(self, holiday_id: int) -> None:
+        raise NotImplementedError
+
+    def rebuild(self, holidays: Iterable[Holiday]) -> None:
+        raise NotImplementedError
+
+
+class ElasticsearchHolidayBackend(HolidaySearchBackend):
+    def __init__(self):
+        self.client = settings.ES_CLIENT
+        self.index_name = settings.HOLIDAY_INDEX_NAME
+
+    @staticmethod
+    def _document(holiday: Holiday) -> dict:
+        return {"name": holiday.name, "description": holiday.description}
+
+    def search(self, term: str, limit: int) -> List[int]:
+        term = " ".join(tokenize(term))
+        if not term:
+            return []
+        query = Q(
+            "multi_match",
+            query=term,
+            fields=[f"name^{NAME_WEIGHT:g}", f"description^{DESCRIPTION_WEIGHT:g}"],
+            fuzziness="AUTO",
+        ) | Q("match_phrase_prefix", name={"query": term, "boost": NAME_WEIGHT})
+        s = Search(using=self.client, index=self.index_name).query(query)
+        try:
+            return [int(hit.meta.id) for hit in s.source(False)[:limit].execute()]
+        except ElasticsearchException as e:
+            raise SearchUnavailable(e)
+
+    def index(self, holiday: Holiday) -> None:
+        self.client.index(
+            index=self.index_name, id=holiday.id, body=self._document(holiday)
+        )
+
+    def remove(self, holiday_id: int) -> None:
+        self.client.delete(index=self.index_name, id=holiday_id, ignore=404)
+
+    def rebuild(self, holidays: Iterable[Holiday]) -> None:
+        indices_client = IndicesClient(client=self.client)
+        if indices_client.exists(self.index_name):
+            indices_client.delete(index=self.index_name)
+        indices_client.create(index=self.index_name)
+        bulk(
+            self.client,
+            (
+                {"_index": self.index_name, "_id": h.id, **self._document(h)}
+                for h in holidays
+            ),
+        )
+
+
+class InMemoryHolidayBackend(HolidaySearchBackend):
+    """
+    Inverted index kept in process memory, for tests and running without
+    Elasticsearch. Loaded from the database on first search and kept up to date
+    by saves in this process only.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        # token -> {holiday id: field weight}
+        self._postings: Dict[str, Dict[int, float]] = {}
+        self._holiday_tokens: Dict[int, List[str]] = {}
+        # Sorted, for prefix lookups
+        self._vocabulary: List[str] = []
+
+    def _add(self, holiday: Holiday) -> None:
+        self._remove(holiday.id)
+        weights = defaultdict(float)
+        for token in tokenize(holiday.name):
+            weights[token] = max(weights[token], NAME_WEIGHT)
+        for token in tokenize(holiday.description):
+            weights[token] = max(weights[token], DESCRIPTION_WEIGHT)
+        for token, weight in weights.items():
+            if token not in self._postings:
+                self._postings[token] = {}
+                insort(self._vocabulary, token)
+            self._postings[token][holiday.id] = weight
+        self._holiday_tokens[holiday.id] = list(weights)
+
+    def _remove(self, holiday_id: int) -> None:
+        for token in self._holiday_tokens.pop(holiday_id, []):
+            postings = self._postings[token]
+            postings.pop(holiday_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.rebuild(Holiday.objects.only("id", "name", "description").iterator())
+
+    def _expand(self, term: str) -> Iterator[Tuple[str, float]]:
+        """ Indexed tokens matching a search term, and how good each match is """
+        if term in self._postings:
+            yield term, 1.0
+        i = bisect_left(self._vocabulary, term)
+        while i < len(self._vocabulary) and self._vocabulary[i].startswith(term):
+            if self._vocabulary[i] != term:
+                yield self._vocabulary[i], PREFIX_MATCH
+            i += 1
+        max_edits = _max_edits(term)
+        if max_edits:
+            for token in self._vocabulary:
+                if not token.startswith(term) and _within_edit_distance(
+                    term, token, max_edits
+                ):
+                    yield token, FUZZY_MATCH
+
+    def search(self, term: str, limit: int) -> List[int]:
+        self._ensure_loaded()
+        scores = defaultdict(float)
+        with self._lock:
+            for query_token in tokenize(term):
+                # Only a term's best match counts towards a holiday
+                best = {}
+                for token, quality in self._expand(query_token):
+                    for holiday_id, weight in self._postings[token].items():
+                        best[holiday_id] = max(
+                            best.get(holiday_id, 0), weight * quality
+                        )
+                for holiday_id, score in best.items():
+                    scores[holiday_id] += score
+        ranked = sorted(
+            scores, key=lambda holiday_id: (-scores[holiday_id], holiday_id)
+        )
+        return ranked[:limit]
+
+    def index(self, holiday: Holiday) -> None:
+        with self._lock:
+            if self._loaded:
+                self._add(holiday)
+
+    def remove(self, holiday_id: int) -> None:
+        with self._lock:
+            self._remove(holiday_id)
+
+    def rebuild(self, holidays: Iterable[Holiday]) -> None:
+        with self._lock:
+            self._postings, self._holiday_tokens, self._vocabulary = {}, {}, []
+            for holiday in holidays:
+                self._add(holiday)
+            self._loaded = True
+
+
+_backends = {}
+
+
+def get_search_backend() -> HolidaySearchBackend:
+    """ The HOLIDAY_SEARCH_BACKEND instance for this process """
+    path = settings.HOLIDAY_SEARCH_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def _sync_holiday(holiday_id: int, holiday: Optional[Holiday] = None) -> None:
+    try:
+        if holiday is None:
+            get_search_backend().remove(holiday_id)
+        else:
+            get_search_backend().index(holiday)
+    except ElasticsearchException as e:
+        # The index catches up on the next save or rebuild_search_index
+        logger.error(f"Could not sync holiday {holiday_id} to search: {e}")
+
+
+# Connected in ApiConfig.ready(). Synced after commit so rolled back saves
+# never reach the index.
+@receiver(post_save, sender=Holiday)
+def holiday_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: _sync_holiday(instance.id, instance))
+
+
+@receiver(post_delete, sender=Holiday)
+def holiday_removed(sender, instance, **kwargs):
+    holiday_id = instance.id
+    transaction.on_commit(lambda: _sync_holiday(holiday_id))
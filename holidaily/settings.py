@@ -18,6 +18,7 @@ import slack
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import twitter
 from aws_requests_auth.boto_utils import BotoAWSRequestsAuth
+from celery.schedules import crontab
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 
 from api.constants import TRUTHY_STRS
@@ -176,6 +177,7 @@ HOLIDAY_IMAGE_WIDTH = 338
 HOLIDAY_IMAGE_HEIGHT = 225
 COMMENT_PAGE_SIZE = 10
 HOLIDAY_PAGE_SIZE = 10
+NOTIFICATION_PAGE_SIZE = 20
 ENABLE_NEW_USER_ALERT = False if os.environ["DEBUG"] == "True" else True
 
 PUSH_NOTIFICATIONS_SETTINGS = {
@@ -188,6 +190,11 @@ PUSH_NOTIFICATIONS_SETTINGS = {
     "FCM_API_KEY": os.environ["FCM_API_KEY"],
 }
 
+# Staggered daily push, see daily_push --staggered
+DAILY_PUSH_WINDOW_SECONDS = 30 * 60
+DAILY_PUSH_CHUNK_SIZE = 500
+PUSH_BACKEND = "holidaily.helpers.push_helpers.DjangoPushBackend"
+
 UPDATE_ALERT = False if os.environ.get("UPDATE_ALERT") == "False" else True
 VALIDATE_EMAIL = False if DEBUG else True
 
@@ -215,6 +222,13 @@ ES_CLIENT = Elasticsearch(
 )
 
 TWEET_INDEX_NAME = "tweets"
+HOLIDAY_INDEX_NAME = "holidays"
+# Or holidaily.helpers.search_helpers.InMemoryHolidayBackend to run without ES
+HOLIDAY_SEARCH_BACKEND = "holidaily.helpers.search_helpers.ElasticsearchHolidayBackend"
+# Approximate cap on each process's holiday name autocomplete index
+AUTOCOMPLETE_MEMORY_BUDGET = 16 * 1024 * 1024
+# How often the index checks the cache for holidays changed by other processes
+AUTOCOMPLETE_CHECK_SECONDS = 30
 
 TWITTER_API_KEY = os.environ["TWITTER_API_KEY"]
 TWITTER_API_SECRET = os.environ["TWITTER_API_SECRET"]
@@ -286,6 +300,29 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "America/New_York"
+CELERYBEAT_SCHEDULE = {
+    "flush-like-notifications": {
+        "task": "api.tasks.flush_like_notifications",
+        "schedule": 60.0,
+    },
+    "flush-counters": {"task": "api.tasks.flush_counters", "schedule": 10.0},
+    # Full table scans, run while traffic is low
+    "sync-counters": {
+        "task": "api.tasks.sync_counters",
+        "schedule": crontab(hour=4, minute=0),
+    },
+}
+# Likes on the same post or comment within this long make one notification
+LIKE_COALESCE_SECONDS = 5 * 60
+# Vote, like and confetti increments wait here for the flush-counters task.
+# Or holidaily.helpers.counter_helpers.LocalCounterBackend to run without Redis
+COUNTER_BACKEND = "holidaily.helpers.counter_helpers.RedisCounterBackend"
+COUNTER_REDIS_URL = "redis://localhost:6379/1"
+# Or holidaily.helpers.leaderboard_helpers.LocalLeaderboard to run without Redis
+LEADERBOARD_BACKEND = "holidaily.helpers.leaderboard_helpers.RedisLeaderboard"
+LEADERBOARD_REDIS_URL = COUNTER_REDIS_URL
+# Swaps in the local search, counter and leaderboard backends for tests
+TEST_RUNNER = "holidaily.test_runner.LocalBackendsRunner"
 
 CACHES = {
     "default": {
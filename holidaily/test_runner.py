@@ -0,0 +1,23 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class LocalBackendsRunner(DiscoverRunner):
+    """
+    Runs the suite against the in-process search, counter and leaderboard
+    backends so no test reaches for Elasticsearch or Redis
+    """
+
+    backends = override_settings(
+        HOLIDAY_SEARCH_BACKEND="holidaily.helpers.search_helpers.InMemoryHolidayBackend",
+        COUNTER_BACKEND="holidaily.helpers.counter_helpers.LocalCounterBackend",
+        LEADERBOARD_BACKEND="holidaily.helpers.leaderboard_helpers.LocalLeaderboard",
+    )
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.backends.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.backends.disable()
+        super().teardown_test_environment(**kwargs)
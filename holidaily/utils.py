@@ -1,9 +1,18 @@
+import base64
+import binascii
+import heapq
+from datetime import date as date_type, datetime
+from itertools import islice
+from typing import Iterable, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
 from push_notifications.models import APNSDevice, GCMDevice
 
 from api.constants import (
     IOS,
     ANDROID,
 )
+from api.exceptions import RequestError
 
 
 def normalize_time(time_ago: str, time_type: str, short=False) -> str:
@@ -92,4 +101,71 @@ def sync_devices(registration_id, platform, user=None):
                 profile = UserProfile.objects.filter(user=user).first()
                 if profile:
                     profile.device_active = True
-                    profile.save()
+                    profile.save(update_fields=["device_active"])
+
+
+def encode_date_cursor(date: date_type, pk: int) -> str:
+    """ Opaque cursor pointing at the last (date, id) a client has seen """
+    return base64.urlsafe_b64encode(f"{date.isoformat()}_{pk}".encode()).decode()
+
+
+def decode_date_cursor(cursor: str) -> Tuple[date_type, int]:
+    try:
+        date_str, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("_")
+        return datetime.strptime(date_str, "%Y-%m-%d").date(), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise RequestError("Invalid cursor")
+
+
+def paginate_by_date(
+    queryset: QuerySet, cursor: str, page_size: int, descending: bool = False
+) -> Tuple[List, Optional[str]]:
+    """
+    Keyset pagination over (date, id). Unlike offsets, pages don't shift when
+    rows are added before the cursor and deep pages cost the same as the first.
+    :param queryset: unordered queryset of a model with a date field
+    :param cursor: next_cursor from the previous page, empty for the first page
+    :param page_size: results per page
+    :param descending: newest first
+    :return: the page, and the cursor for the next page or None if this is the last
+    """
+    if cursor:
+        date, pk = decode_date_cursor(cursor)
+        if descending:
+            after_cursor = Q(date__lt=date) | Q(date=date, id__lt=pk)
+        else:
+            after_cursor = Q(date__gt=date) | Q(date=date, id__gt=pk)
+        queryset = queryset.filter(after_cursor)
+    ordering = ("-date", "-id") if descending else ("date", "id")
+    # One extra row tells us if there is another page
+    page = list(queryset.order_by(*ordering)[: page_size + 1])
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, encode_date_cursor(page[-1].date, page[-1].id)
+
+
+def paginate_newest_by_id(
+    querysets: Iterable[QuerySet], cursor: str, page_size: int
+) -> Tuple[List, Optional[str]]:
+    """
+    Keyset pagination over id, newest first, of several querysets merged into
+    one feed. Each is read as its own range scan instead of one OR'd query.
+    :param querysets: unordered querysets of the same model, not overlapping
+    :param cursor: next_cursor from the previous page, empty for the first page
+    :param page_size: results per page
+    :return: the page, and the cursor for the next page or None if this is the last
+    """
+    if cursor:
+        try:
+            last_id = int(cursor)
+        except ValueError:
+            raise RequestError("Invalid cursor")
+        querysets = [qs.filter(id__lt=last_id) for qs in querysets]
+    # One extra row tells us if there is another page
+    pages = [list(qs.order_by("-id")[: page_size + 1]) for qs in querysets]
+    page = list(islice(heapq.merge(*pages, key=lambda obj: -obj.id), page_size + 1))
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, str(page[-1].id)
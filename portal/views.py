@@ -44,7 +44,7 @@ def unsubscribe(request):
         status, message = 404, "Profile does not exist"
     else:
         profile.emails_enabled = False
-        profile.save()
+        profile.save(update_fields=["emails_enabled"])
         status, message = 200, "You have been successfully unsubscribed!"
 
     return render(